@@ -1,3 +1,10 @@
-from .fields import CachingForeignKey
+from .fields import CachingForeignKey, prefetch_cached
 from .controller import CacheController
 from .related_controller import RelatedCacheController
+from .managers import CachingManager, CachingQuerySet
+from .local import LocalCache
+from .flight import SingleFlight
+from .refresh import RefreshPool
+from .batching import batch, commit_manually, commit_on_success, TransactionMiddleware
+from .stats import MemoryStats, StatsCollector, StatsdCollector
+from .identity import IdentityMapMiddleware, identity_map
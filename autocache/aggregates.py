@@ -0,0 +1,91 @@
+"""
+.. module:aggregates
+   :platform: Django
+   :synopsis: Counts, sums, minimums and maximums kept in cache for a relation, without its list.
+
+A RelatedCacheController created with ``aggregates`` keeps the aggregates
+declared for each relation under keys of their own: ::
+
+    class Person(models.Model):
+        cache = RelatedCacheController(aggregates={
+            'book_set': (Count('pk'), Sum('rank'), Max('rank')),
+        })
+
+    person.cache.count('book_set')
+    person.cache.aggregate('book_set')  # {'pk__count': 3, 'rank__sum': 12, 'rank__max': 5}
+
+Counts, and sums of integer fields, are stored raw and adjusted with ``incr``
+and ``decr`` as objects join and leave the relation or change. A minimum or
+maximum is left alone while it still holds, and dropped when a change may have
+moved it; so are sums of other fields. Dropped aggregates are read back with
+one aggregate query the next time they're asked for.
+"""
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.db import models
+
+from .lookups import _field
+
+KINDS = ('Count', 'Sum', 'Min', 'Max')
+
+
+class Aggregate(object):
+    """ One aggregate declared for a relation holding instances of ``model``.
+    """
+    def __init__(self, aggregate, model, counter_fields):
+        if aggregate.name not in KINDS:
+            raise ValueError("%s can't be kept in cache; use Count, Sum, Min or Max" % aggregate.name)
+        if aggregate.extra.get('distinct'):
+            raise ValueError("Distinct counts can't be kept in cache")
+        self.aggregate = aggregate
+        self.kind = aggregate.name
+        self.alias = aggregate.default_alias
+        self.field = _field(model, aggregate.lookup)
+        self.attname = self.field.attname
+
+        # kept with incr/decr rather than dropped when the relation changes
+        self.counter = self.kind == 'Count' or (self.kind == 'Sum' and isinstance(self.field, counter_fields))
+
+    def __repr__(self):
+        return '<Aggregate: %s>' % self.alias
+
+    def summarize(self, rows):
+        """ The aggregate over ``rows``, a list of dicts of field values by
+            attname. Sums of no values are 0.
+        """
+        values = [row[self.attname] for row in rows if row[self.attname] is not None]
+        if self.kind == 'Count':
+            return len(values)
+        if self.kind == 'Sum':
+            return sum(values)
+        if not values:
+            return None
+        return min(values) if self.kind == 'Min' else max(values)
+
+    def delta(self, added, removed):
+        """ How much a count or sum changes when the objects described by
+            ``added`` join the relation and those in ``removed`` leave it.
+        """
+        return self.summarize(added) - self.summarize(removed)
+
+    def holds(self, current, added, removed):
+        """ Whether ``current``, the cached minimum or maximum, is still right
+            after ``added`` joined the relation and ``removed`` left it.
+        """
+        beyond = (lambda x, y: x < y) if self.kind == 'Min' else (lambda x, y: x > y)
+        added, removed = self.summarize(added), self.summarize(removed)
+        if current is None:
+            return added is None
+        if added is not None and beyond(added, current):
+            return False
+        # removing the current extreme leaves us not knowing the next one
+        return removed is None or beyond(current, removed)
+
+
+def counter_fields(cache):
+    """ The fields whose sums can be kept with ``incr`` and ``decr`` on
+        ``cache``. Memcached can't hold negative numbers, so there only the
+        sums of fields that can't be negative qualify.
+    """
+    if isinstance(cache, BaseMemcachedCache):
+        return (models.PositiveIntegerField, models.PositiveSmallIntegerField)
+    return (models.IntegerField,)
@@ -0,0 +1,340 @@
+"""
+.. module:batching
+   :platform: Django
+   :synopsis: Defers and coalesces cache writes until a block of code, or the surrounding transaction, completes.
+
+While a batch is active, controllers record their writes in it instead of
+sending them to the cache. Later writes to a key replace earlier ones, reads
+see the pending value, and when the batch completes everything is written
+with one ``set_many`` and one ``delete_many`` per controller. Related list
+updates that started from a value read from the shared cache are replayed
+atomically, all at once, so they can't overwrite a concurrent update made by
+another process.
+
+If the block raises, the pending writes are dropped. Batches nest: an inner
+batch is merged into the outer one when it completes.
+
+``commit_on_success()``, ``commit_manually()`` and ``TransactionMiddleware``
+wrap Django's own in a batch, so the writes made inside the transaction are
+flushed once it commits and dropped when it rolls back. Only these are tied
+to the transaction: code that uses ``django.db.transaction`` or Django's
+TransactionMiddleware directly writes to the cache as it saves, before the
+commit, and a rollback leaves those writes in place.
+"""
+import sys
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from django.db import transaction
+from django.middleware.transaction import TransactionMiddleware as DjangoTransactionMiddleware
+
+_state = threading.local()
+
+
+class Entry(object):
+    """ The pending state of one cache key.
+    """
+    def __init__(self):
+        # the encoded value to store, or None to delete the key
+        self.stored = None
+        self.deleted = False
+        # pending change of a counter, added to it with incr
+        self.delta = 0
+        # related list updates to replay if the value was built on what the
+        # cache held outside of this batch
+        self.from_cache = False
+        self.updates = []
+        self.model = None
+        self.load = None
+
+
+class Batch(object):
+    """ Context manager that defers cache writes until it exits.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+
+    def __enter__(self):
+        _stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _stack().pop()
+        if exc_type is not None:
+            self.entries.clear()
+            return False
+
+        self.release()
+        return False
+
+    def parent(self):
+        """ The batch this one is nested in, or None.
+        """
+        stack = _stack()
+        index = stack.index(self) if self in stack else len(stack)
+        if index:
+            return stack[index - 1]
+        return None
+
+    def release(self):
+        """ Writes the pending values to the cache, or hands them on to the
+            batch this one is nested in.
+        """
+        parent = self.parent()
+        if parent is None:
+            self.flush()
+        else:
+            parent.merge(self)
+
+    def entry(self, controller, key):
+        try:
+            return self.entries[(controller, key)]
+        except KeyError:
+            entry = self.entries[(controller, key)] = Entry()
+            return entry
+
+    def set(self, controller, key, stored):
+        entry = self.entry(controller, key)
+        entry.stored = stored
+        entry.deleted = False
+        entry.delta = 0
+        entry.from_cache = False
+        entry.updates = []
+
+    def delete(self, controller, key):
+        entry = self.entry(controller, key)
+        entry.stored = None
+        entry.deleted = True
+        entry.delta = 0
+        entry.from_cache = False
+        entry.updates = []
+
+    def incr(self, controller, key, delta):
+        """ Records a change of a counter. Counters that are being deleted
+            stay deleted.
+        """
+        entry = self.entry(controller, key)
+        if not entry.deleted:
+            entry.delta += delta
+
+    def update(self, controller, key, stored, model, update, load, from_cache):
+        """ Records a related list update. ``stored`` is the list after the
+            update, and ``from_cache`` says whether it was built on a value
+            read from outside this batch rather than loaded from the database.
+        """
+        if (controller, key) not in self.entries:
+            self.entry(controller, key).from_cache = from_cache
+        entry = self.entries[(controller, key)]
+        entry.stored = stored
+        entry.deleted = False
+        entry.model = model
+        entry.load = load
+        if entry.from_cache:
+            entry.updates.append(update)
+
+    def merge(self, other):
+        for (controller, key), entry in other.entries.items():
+            mine = self.entries.get((controller, key))
+            if mine is not None and entry.stored is None and not entry.deleted:
+                # the other batch only changed a counter
+                self.incr(controller, key, entry.delta)
+                continue
+            if mine is not None and entry.from_cache:
+                # the other batch built on our pending value
+                entry.from_cache = mine.from_cache
+                entry.updates = mine.updates + entry.updates if mine.from_cache else []
+            self.entries[(controller, key)] = entry
+        other.entries.clear()
+
+    def flush(self):
+        """ Writes every pending value to the cache.
+        """
+        controllers = OrderedDict()
+        for (controller, key), entry in self.entries.items():
+            controllers.setdefault(controller, []).append((key, entry))
+        self.entries.clear()
+
+        for controller, entries in controllers.items():
+            controller._flush(entries)
+
+
+def batch():
+    """ Returns a context manager that defers and coalesces the cache writes
+        made inside it. ::
+
+            with autocache.batch():
+                for book in books:
+                    book.save()
+    """
+    return Batch()
+
+
+class TransactionBatch(Batch):
+    """ A batch around ``transaction.commit_on_success``: it is flushed after
+        the transaction commits, and dropped if the block raises or the
+        commit fails.
+    """
+
+    def __init__(self, using=None):
+        super(TransactionBatch, self).__init__()
+        self.using = using
+        self.transaction = transaction.commit_on_success(using=using)
+
+    def __enter__(self):
+        self.transaction.__enter__()
+        return super(TransactionBatch, self).__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.transaction.__exit__(exc_type, exc_value, traceback)
+        except:
+            super(TransactionBatch, self).__exit__(*sys.exc_info())
+            raise
+        return super(TransactionBatch, self).__exit__(exc_type, exc_value, traceback)
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with TransactionBatch(self.using):
+                return func(*args, **kwargs)
+        return inner
+
+
+def commit_on_success(using=None):
+    """ Like ``transaction.commit_on_success``, as a decorator or a context
+        manager, but the cache writes made inside it are batched, and only
+        written once the transaction has committed. ::
+
+            with autocache.commit_on_success():
+                for book in books:
+                    book.save()
+    """
+    if callable(using):
+        # used as @commit_on_success, without arguments
+        return TransactionBatch()(using)
+    return TransactionBatch(using)
+
+
+class ManualTransactionBatch(TransactionBatch):
+    """ A batch around ``transaction.commit_manually``. Its ``commit()`` and
+        ``rollback()`` end the transaction like Django's, and write or drop
+        the cache writes made since.
+    """
+
+    def __init__(self, using=None):
+        Batch.__init__(self)
+        self.using = using
+        self.transaction = transaction.commit_manually(using=using)
+
+    def commit(self):
+        transaction.commit(using=self.using)
+        self.release()
+
+    def rollback(self):
+        transaction.rollback(using=self.using)
+        self.entries.clear()
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with ManualTransactionBatch(self.using) as txn:
+                return func(txn, *args, **kwargs)
+        return inner
+
+
+def commit_manually(using=None):
+    """ Like ``transaction.commit_manually``, but the cache writes made inside
+        it are batched. End the transaction with the batch's ``commit()`` or
+        ``rollback()`` rather than Django's, so that the writes are written
+        or dropped along with it. Used as a decorator, the batch is passed
+        to the function first. ::
+
+            with autocache.commit_manually() as txn:
+                book.save()
+                txn.commit()
+    """
+    if callable(using):
+        return ManualTransactionBatch()(using)
+    return ManualTransactionBatch(using)
+
+
+class TransactionMiddleware(DjangoTransactionMiddleware):
+    """ Django's TransactionMiddleware, with the cache writes of each request
+        batched: they are written once the request's transaction commits,
+        and dropped if it rolls back. Use it in place of Django's.
+    """
+
+    def process_request(self, request):
+        super(TransactionMiddleware, self).process_request(request)
+        request._autocache_batch = Batch()
+        request._autocache_batch.__enter__()
+
+    def process_exception(self, request, exception):
+        pending = request.__dict__.pop('_autocache_batch', None)
+        try:
+            super(TransactionMiddleware, self).process_exception(request, exception)
+        finally:
+            if pending is not None:
+                pending.__exit__(type(exception), exception, None)
+
+    def process_response(self, request, response):
+        pending = request.__dict__.pop('_autocache_batch', None)
+        if pending is None:
+            return super(TransactionMiddleware, self).process_response(request, response)
+        try:
+            response = super(TransactionMiddleware, self).process_response(request, response)
+        except:
+            pending.__exit__(*sys.exc_info())
+            raise
+        pending.__exit__(None, None, None)
+        return response
+
+
+def _stack():
+    try:
+        return _state.stack
+    except AttributeError:
+        _state.stack = []
+        return _state.stack
+
+
+def current():
+    """ Returns the batch that writes should be recorded in, or None.
+    """
+    stack = _stack()
+    if stack:
+        return stack[-1]
+    return None
+
+
+def _batches():
+    """ Every active batch, from the innermost out.
+    """
+    return list(reversed(_stack()))
+
+
+def lookup(controller, key):
+    """ Returns the pending Entry for a key, looking through every active
+        batch from the innermost out, or None.
+    """
+    for pending in _batches():
+        entry = pending.entries.get((controller, key))
+        if entry is not None:
+            return entry
+    return None
+
+
+def pending_delta(controller, key):
+    """ Returns the change that the active batches will make to a counter,
+        or None if one of them deletes it.
+    """
+    delta = 0
+    for pending in _batches():
+        entry = pending.entries.get((controller, key))
+        if entry is not None:
+            if entry.deleted:
+                return None
+            delta += entry.delta
+    return delta
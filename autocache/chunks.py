@@ -0,0 +1,154 @@
+"""
+.. module:chunks
+   :platform: Django
+   :synopsis: Stores long related lists across several cache keys, and reads them back lazily.
+
+A RelatedCacheController created with ``chunk_size`` stores any related list
+longer than that as a small ``Chunks`` header under the list's key, and the
+list itself in chunks of ``chunk_size`` objects under keys of their own.
+Chunk keys are never overwritten: a chunk that changes is written under a new
+key, and the header is switched over to it, so a reader always sees the
+chunks of one version of the list. Each chunk has a ``ChunkSummary`` next to
+it, which lets an update find the chunks it touches without reading the
+others.
+
+Reads return a ``ChunkedList``, which fetches only the chunks that the
+indexes and slices asked for need.
+"""
+import bisect
+import os
+from binascii import hexlify
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+from .lookups import Filterable
+
+
+def new_token():
+    """ A random name for a chunk key.
+    """
+    return hexlify(os.urandom(6)).decode('ascii')
+
+
+class Chunks(object):
+    """ Header of a chunked list: the number of objects in it, and the token
+        and length of each chunk.
+    """
+    def __init__(self, count, chunks):
+        self.count = count
+        self.chunks = chunks
+
+    def __eq__(self, other):
+        return isinstance(other, Chunks) and (self.count, self.chunks) == (other.count, other.chunks)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<Chunks: %d objects in %d chunks>' % (self.count, len(self.chunks))
+
+
+class ChunkSummary(object):
+    """ What updates need to know of a chunk without reading it: the pks of
+        its objects, the sort key of its last object, and when it was
+        written. Stored under a key of its own next to the chunk.
+    """
+    def __init__(self, pks, last, written):
+        self.pks = frozenset(pks)
+        self.last = last
+        self.written = written
+        self.length = len(pks)
+
+    def __len__(self):
+        return self.length
+
+
+def split(values, size):
+    """ Splits a list into lists of ``size`` items.
+    """
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+
+class ChunkedList(Filterable, Sequence):
+    """ Read only sequence of the objects in a chunked related list.
+        Supports the same filtering as ``CachedList``.
+
+        Chunks are read from cache the first time one of their objects is
+        needed: an index reads one chunk, and a slice the chunks it covers,
+        with a single ``get_many``. If a chunk is missing from cache, the
+        whole list is loaded with ``load``.
+    """
+    def __init__(self, controller, key, model, header, load=None):
+        self.controller = controller
+        self.key = key
+        self.model = model
+        self.header = header
+        self.load = load
+        self._chunks = {}
+        self._objects = None
+
+        # offset of the first object of each chunk
+        self._offsets = []
+        offset = 0
+        for token, length in header.chunks:
+            self._offsets.append(offset)
+            offset += length
+
+    def __len__(self):
+        if self._objects is not None:
+            return len(self._objects)
+        return self.header.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if start >= stop:
+                return []
+            return self._range(start, stop)[::step]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('list index out of range')
+        return self._range(index, index + 1)[0]
+
+    def __iter__(self):
+        return iter(self._range(0, len(self)))
+
+    def __repr__(self):
+        return '<ChunkedList: %d %s objects>' % (len(self), self.model.__name__)
+
+    def _range(self, start, stop):
+        """ Returns the objects from ``start`` up to ``stop`` as a list.
+        """
+        if self._objects is None:
+            first = bisect.bisect_right(self._offsets, start) - 1
+            last = bisect.bisect_right(self._offsets, stop - 1) - 1
+            if self._fetch(range(first, last + 1)):
+                objects = []
+                for index in range(first, last + 1):
+                    objects.extend(self._chunks[index])
+                base = self._offsets[first]
+                return objects[start - base:stop - base]
+        return self._objects[start:stop]
+
+    def _fetch(self, indexes):
+        """ Reads the chunks in ``indexes`` that weren't read yet. Returns
+            False if the list had to be loaded instead.
+        """
+        indexes = [index for index in indexes if index not in self._chunks]
+        if not indexes:
+            return True
+
+        chunks = self.controller._read_chunks(self.key, self.model, self.header, indexes)
+        if chunks is None:
+            if self.load is None:
+                raise LookupError("Chunks of %s are missing from cache" % self.key)
+            self._objects = list(self.load())
+            self._chunks.clear()
+            return False
+        self._chunks.update(chunks)
+        return True
@@ -0,0 +1,216 @@
+"""
+.. module:codec
+   :platform: Django
+   :synopsis: Provides the codecs that turn cached values into the strings stored in the cache backend.
+
+Every value a controller stores is encoded into a string with a three byte
+header: a marker byte, the format of the payload and the compression applied
+to it. Any codec can decode what any other codec wrote, so switching codecs
+doesn't require flushing the cache.
+"""
+import hashlib
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from lz4.block import compress as lz4_compress, decompress as lz4_decompress
+except ImportError:
+    try:
+        from lz4 import compress as lz4_compress, decompress as lz4_decompress
+    except ImportError:
+        lz4_compress = lz4_decompress = None
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+
+MARKER = b'\x00'
+
+FORMAT_PICKLE = b'P'
+FORMAT_MODEL = b'M'
+
+COMPRESS_NONE = b'-'
+COMPRESS_ZLIB = b'z'
+COMPRESS_LZ4 = b'4'
+
+### Tags used by ModelCodec to describe the packed value
+RAW, INSTANCE, INSTANCE_LIST = 0, 1, 2
+
+
+class SchemaChanged(Exception):
+    """ Raised when a cached model was encoded with different fields than the
+        model currently has.
+    """
+
+
+class Codec(object):
+    """ Base class for codecs.
+
+        Subclasses set ``format`` and implement ``dumps``; ``decode`` handles
+        every format. Payloads larger than ``compress_threshold`` bytes are
+        compressed with ``compression`` ('zlib' or 'lz4').
+
+        The codec counts what it encodes in ``encoded`` (number of values),
+        ``encoded_bytes`` (bytes written to the backend) and
+        ``uncompressed_bytes`` (bytes before compression).
+    """
+    format = None
+
+    def __init__(self, compression='zlib', compress_threshold=None):
+        if compression == 'lz4' and lz4_compress is None:
+            raise ImproperlyConfigured("lz4 compression requires the lz4 package")
+        if compression not in ('zlib', 'lz4'):
+            raise ImproperlyConfigured("Unknown compression %r" % compression)
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+
+        self.encoded = 0
+        self.encoded_bytes = 0
+        self.uncompressed_bytes = 0
+
+    def dumps(self, value):
+        raise NotImplementedError
+
+    def encode(self, value):
+        data = self.dumps(value)
+        self.uncompressed_bytes += len(data)
+
+        compression = COMPRESS_NONE
+        if self.compress_threshold is not None and len(data) > self.compress_threshold:
+            if self.compression == 'lz4':
+                compression, data = COMPRESS_LZ4, lz4_compress(data)
+            else:
+                compression, data = COMPRESS_ZLIB, zlib.compress(data)
+
+        encoded = MARKER + self.format + compression + data
+        self.encoded += 1
+        self.encoded_bytes += len(encoded)
+        return encoded
+
+    def decode(self, stored):
+        """ Returns the value held by ``stored``.
+
+            Values that weren't written by a codec are returned unchanged.
+            Raises SchemaChanged if a model's fields changed since the value
+            was written.
+        """
+        if not isinstance(stored, bytes) or stored[:1] != MARKER:
+            return stored
+
+        format, compression, data = stored[1:2], stored[2:3], stored[3:]
+        if compression == COMPRESS_ZLIB:
+            data = zlib.decompress(data)
+        elif compression == COMPRESS_LZ4:
+            if lz4_decompress is None:
+                raise ImproperlyConfigured("lz4 compression requires the lz4 package")
+            data = lz4_decompress(data)
+
+        value = pickle.loads(data)
+        if format == FORMAT_MODEL:
+            value = unpack(value)
+        return value
+
+    def sizes(self, value):
+        """ Returns the pickled and encoded sizes of ``value``, for measuring
+            what a codec saves over storing the value as it is.
+        """
+        return {
+            'pickled': len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+            'encoded': len(self.encode(value)),
+        }
+
+
+class PickleCodec(Codec):
+    """ Stores values pickled as they are, model state and all.
+    """
+    format = FORMAT_PICKLE
+
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+class ModelCodec(Codec):
+    """ Stores model instances as a tuple of their concrete field values.
+
+        Each model is stored with a fingerprint of its fields; instances
+        written before the fields changed decode as a cache miss. Instances
+        are rebuilt the way a queryset would build them.
+    """
+    format = FORMAT_MODEL
+
+    def dumps(self, value):
+        return pickle.dumps(pack(value), pickle.HIGHEST_PROTOCOL)
+
+
+_fingerprints = {}
+
+def fingerprint(model):
+    """ A short hash of the names and types of a model's fields.
+    """
+    try:
+        return _fingerprints[model]
+    except KeyError:
+        description = ','.join('%s:%s' % (f.attname, f.get_internal_type()) for f in model._meta.fields)
+        _fingerprints[model] = hashlib.md5(description.encode('utf-8')).hexdigest()[:8]
+        return _fingerprints[model]
+
+
+def _packable(value):
+    return isinstance(value, models.Model) and not getattr(value, '_deferred', False)
+
+
+def _describe(model):
+    return (model._meta.app_label, model._meta.object_name, fingerprint(model))
+
+
+def _values(instance):
+    return tuple(getattr(instance, f.attname) for f in instance._meta.fields)
+
+
+def pack(value):
+    """ Turns instances, and lists of instances of a single model, into plain
+        tuples. Anything else is left as it is.
+    """
+    if _packable(value):
+        return (INSTANCE, _describe(value.__class__), value._state.db, _values(value))
+
+    if isinstance(value, list) and value and _packable(value[0]):
+        model = value[0].__class__
+        if all(o.__class__ is model and _packable(o) for o in value):
+            db = value[0]._state.db
+            return (INSTANCE_LIST, _describe(model), db, [_values(o) for o in value])
+
+    return (RAW, value)
+
+
+def _resolve(description):
+    app_label, object_name, print_ = description
+    model = models.get_model(app_label, object_name)
+    if model is None or fingerprint(model) != print_:
+        raise SchemaChanged(description)
+    return model
+
+
+def _build(model, db, values):
+    from_db = getattr(model, 'from_db', None)
+    if from_db is not None:
+        return from_db(db, [f.attname for f in model._meta.fields], values)
+    instance = model(*values)
+    instance._state.adding = False
+    instance._state.db = db
+    return instance
+
+
+def unpack(packed):
+    tag = packed[0]
+    if tag == RAW:
+        return packed[1]
+
+    model = _resolve(packed[1])
+    db = packed[2]
+    if tag == INSTANCE:
+        return _build(model, db, packed[3])
+    return [_build(model, db, values) for values in packed[3]]
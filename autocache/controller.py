@@ -1,17 +1,40 @@
+import hashlib
+import time
 
 import django.core.cache
 from django.db import models
 from django.db.models.manager import ManagerDescriptor
+from django.utils.encoding import smart_str
+
+from . import batching, counters, identity, queries, refresh, stats as stats_module
+from .codec import ModelCodec, SchemaChanged
 
 no_arg = object()
 
+### Maps each model to the controller attached to it, so that other parts of
+### autocache (like CachingForeignKey) can share its keys and settings.
+registry = {}
+
+
+def get_controller(model):
+    """ Returns the CacheController attached to ``model``, or None.
+    """
+    return registry.get(model)
+
+
 class CacheController(object):
     """ Automatically caches model instances on saves
     """
     DNE = 'DOES_NOT_EXIST'
     DEFAULT_TIMEOUT = 60 * 60
+    # seconds a process reuses the namespace generations it read from cache
+    NAMESPACE_INTERVAL = 1
+    # namespace counters should outlive everything they namespace
+    NAMESPACE_TIMEOUT = 60 * 60 * 24 * 30
 
-    def __init__(self, backend='default', timeout=no_arg):
+    def __init__(self, backend='default', timeout=no_arg, local=None, single_flight=None,
+                 soft_timeout=None, refresh_pool=None, codec=None, stats=None, unique=()):
+        self.backend = backend
         if backend is 'default':
             self.cache = django.core.cache.cache
         else:
@@ -22,43 +45,686 @@ class CacheController(object):
         else:
             self.timeout = timeout
 
+        # optional process local LRU tier in front of self.cache
+        self.local = local
+
+        # optional coordination of database loads after a miss
+        self.single_flight = single_flight
+
+        # entries older than soft_timeout are served while being refreshed in
+        # the background; self.timeout is when they finally expire
+        self.soft_timeout = soft_timeout
+        if refresh_pool is None:
+            refresh_pool = refresh.default_pool
+        self.refresh_pool = refresh_pool
+
+        # turns values into what is stored in the backend, and back
+        if codec is None:
+            codec = ModelCodec()
+        self.codec = codec
+
+        # receives hit, miss and latency statistics
+        if stats is None:
+            stats = stats_module.default_collector
+        self.collector = stats
+
+        # names of unique fields that get_by() can look instances up with
+        self.unique = tuple(unique)
+
+        # namespace generations by name (None for the model's own), and when
+        # they need to be read again
+        self._namespaces = {}
+        self._namespaces_expire = 0
+
     def make_key(self, pk):
-        key = "%(app_label)s:%(model)s:%(pk)s" % {
+        key = "%(app_label)s:%(model)s:%(generation)s:%(pk)s" % {
             'app_label': self.model._meta.app_label,
             'model': self.model.__name__,
+            'generation': self._namespace(),
             'pk': pk,
         }
         return key
 
+    def make_index_key(self, field, value):
+        """ Key of the entry that maps a value of the unique ``field`` to the
+            pk of the instance holding it. Values are hashed, so that they
+            needn't be valid cache keys.
+        """
+        return "%(app_label)s:%(model)s:%(generation)s:by:%(field)s:%(value)s" % {
+            'app_label': self.model._meta.app_label,
+            'model': self.model.__name__,
+            'generation': self._namespace(),
+            'field': field,
+            'value': hashlib.md5(smart_str(value)).hexdigest(),
+        }
+
+    def make_query_key(self, queryset):
+        """ Key of the pks matched by ``queryset``. It is built from the
+            query's SQL and parameters and the generations of the tables it
+            reads, so a change to any of them moves it. Raises EmptyResultSet
+            for a queryset that can't match anything.
+        """
+        sql, params, tables = queries.compile_query(queryset)
+        queries.watch_tables(tables)
+        generations = queries.get_tags(self.backend, self.cache).generations(tables)
+        query = '%s|%s|%r|%r' % (queryset.db, sql, tuple(params), generations)
+        return "%(app_label)s:%(model)s:%(generation)s:query:%(query)s" % {
+            'app_label': self.model._meta.app_label,
+            'model': self.model.__name__,
+            'generation': self._namespace(),
+            'query': hashlib.md5(smart_str(query)).hexdigest(),
+        }
+
+    def make_namespace_key(self, name=None):
+        """ Key of the shared counter that namespaces this controller's keys,
+            or the keys of the relation called ``name``.
+        """
+        key = "autocache:namespace:%(app_label)s:%(model)s" % {
+            'app_label': self.model._meta.app_label,
+            'model': self.model.__name__,
+        }
+        if name is not None:
+            key = ':'.join((key, name))
+        return key
+
+    def invalidate_all(self):
+        """ Drops every cached instance of the model at once, by moving its
+            keys to a new namespace.
+        """
+        self._bump_namespace(None)
+
+    def make_generation_key(self):
+        """ Key of the shared counter that tells other processes to drop
+            their local copies of this controller's keys.
+        """
+        return "autocache:generation:%(app_label)s:%(model)s" % {
+            'app_label': self.model._meta.app_label,
+            'model': self.model.__name__,
+        }
+
+    ###
+    ### Cache access. Everything this controller stores goes through these
+    ### methods, so that the local tier stays consistent with the shared one.
+    ### Writes made while filling a miss pass fill=True; any other write is an
+    ### invalidation that other processes need to hear about.
+    ###
+
+    def _check_local(self):
+        if self.local.should_check():
+            self.local.sync(self.cache.get(self.make_generation_key()))
+
+    def _bump_generation(self):
+        generation = counters.incr(self.cache, self.make_generation_key(), self.NAMESPACE_TIMEOUT,
+                                   self.local.generation)
+        self.local.advance(generation)
+
+    ###
+    ### Namespaces. Every key includes a generation number read from a shared
+    ### counter; incrementing the counter orphans all of the old keys, which
+    ### then expire on their own. The counters are read together, at most
+    ### once every NAMESPACE_INTERVAL seconds.
+    ###
+
+    def _namespace_names(self):
+        return [None]
+
+    def _namespace(self, name=None):
+        if time.time() >= self._namespaces_expire or name not in self._namespaces:
+            self._sync_namespaces(set(self._namespace_names()) | set([name]))
+        return self._namespaces[name]
+
+    def _sync_namespaces(self, names):
+        keys = dict((self.make_namespace_key(name), name) for name in names)
+        previous = dict((key, self._namespaces.get(name)) for key, name in keys.items())
+        found = counters.read(self.cache, list(keys), self.NAMESPACE_TIMEOUT, previous)
+
+        self._namespaces = dict((name, found[key]) for key, name in keys.items())
+        self._namespaces_expire = time.time() + self.NAMESPACE_INTERVAL
+
+    def _bump_namespace(self, name):
+        counters.incr(self.cache, self.make_namespace_key(name), self.NAMESPACE_TIMEOUT,
+                      self._namespaces.get(name))
+        # see the new namespace straight away in this process
+        self._namespaces_expire = 0
+
+    ###
+    ### Statistics
+    ###
+
+    def stats(self, relation=None):
+        """ Returns the statistics collected for this controller's model, or
+            for one of its relations, if the collector keeps them.
+        """
+        return self.collector.stats(model=self.model, relation=relation, backend=self.backend)
+
+    def _count(self, value, relation=None):
+        """ Counts a lookup that found ``value`` in cache as a hit, a miss or
+            a cached DoesNotExist.
+        """
+        if value is None:
+            name = 'miss'
+        elif value == self.DNE:
+            name = 'dne'
+        else:
+            name = 'hit'
+        self.collector.incr(name, self.model, relation, self.backend)
+
+    def _timing(self, name, start, relation=None):
+        self.collector.timing(name, time.time() - start, self.model, relation, self.backend)
+
+    def _encode(self, value):
+        stored = self.codec.encode(value)
+        if self.soft_timeout is None:
+            return stored
+        return (time.time() + self.soft_timeout, stored)
+
+    def _decode(self, stored):
+        """ Returns the value held by a stored entry, and whether it is stale.
+            Entries written for an older version of a model decode as None.
+        """
+        fresh_until = None
+        if isinstance(stored, tuple):
+            fresh_until, stored = stored
+        try:
+            value = self.codec.decode(stored)
+        except SchemaChanged:
+            return None, False
+        return value, fresh_until is not None and fresh_until < time.time()
+
+    def _refresh(self, key, refresh):
+        self.refresh_pool.submit((id(self), key), lambda: self._fill(key, refresh))
+
+    def _remembered(self, key):
+        """ Returns the value the active identity map holds for ``key``, or
+            None.
+        """
+        known = identity.current()
+        if known is None:
+            return None
+        return known.get(self, key)
+
+    def _remember(self, key, value):
+        known = identity.current()
+        if known is not None:
+            known.set(self, key, value)
+
+    def _forget(self, key):
+        known = identity.current()
+        if known is not None:
+            known.discard(self, key)
+
+    def _remember_write(self, key, value):
+        if batching.current() is not None:
+            # the batch may still drop the write
+            self._forget(key)
+        else:
+            self._remember(key, value)
+
+    def _cache_get(self, key, refresh=None):
+        """ Returns the value cached under ``key``, or None on a miss.
+
+            If the entry is past the soft timeout, ``refresh`` is scheduled on
+            the refresh pool to reload it and the stale value is returned.
+        """
+        entry = batching.lookup(self, key)
+        if entry is not None:
+            if entry.deleted:
+                return None
+            return self._decode(entry.stored)[0]
+
+        value = self._remembered(key)
+        if value is not None:
+            return value
+
+        stored = None
+        if self.local is not None:
+            self._check_local()
+            stored = self.local.get(key)
+
+        if stored is None:
+            start = time.time()
+            stored = self.cache.get(key)
+            self._timing('cache_get', start)
+            if stored is not None and self.local is not None:
+                self.local.set(key, stored)
+
+        return self._read_stored(key, stored, refresh)
+
+    def _read_stored(self, key, stored, refresh=None):
+        """ Decodes what was read from cache for ``key``, and schedules
+            ``refresh`` if it is stale.
+        """
+        if stored is None:
+            return None
+        value, stale = self._decode(stored)
+        if value is not None and stale and refresh is not None:
+            self._refresh(key, refresh)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def _cache_get_many(self, keys, refresh=None):
+        """ Returns a dict of the values cached under ``keys``.
+
+            ``refresh`` is called with a key to get a function that reloads it,
+            for each entry that is past the soft timeout.
+        """
+        values = {}
+        missed = []
+        for key in keys:
+            entry = batching.lookup(self, key)
+            if entry is None:
+                value = self._remembered(key)
+                if value is None:
+                    missed.append(key)
+                else:
+                    values[key] = value
+            elif not entry.deleted:
+                value = self._decode(entry.stored)[0]
+                if value is not None:
+                    values[key] = value
+        keys = missed
+
+        stored = {}
+        if self.local is not None:
+            self._check_local()
+            for key in keys:
+                value = self.local.get(key)
+                if value is not None:
+                    stored[key] = value
+            keys = [key for key in keys if key not in stored]
+
+        if keys:
+            start = time.time()
+            found = self.cache.get_many(keys)
+            self._timing('cache_get_many', start)
+            if self.local is not None:
+                for key, value in found.items():
+                    self.local.set(key, value)
+            stored.update(found)
+
+        for key, value in stored.items():
+            value = self._read_stored(key, value, refresh(key) if refresh is not None else None)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def _cache_set(self, key, value, fill=False):
+        stored = self._encode(value)
+        self._remember_write(key, value)
+        pending = batching.current()
+        if pending is not None:
+            pending.set(self, key, stored)
+            return
+
+        start = time.time()
+        self.cache.set(key, stored, self.timeout)
+        self._timing('cache_set', start)
+        if self.local is not None:
+            if not fill:
+                self._bump_generation()
+            self.local.set(key, stored)
+
+    def _cache_set_many(self, data, fill=False):
+        for key, value in data.items():
+            self._remember_write(key, value)
+        data = dict((key, self._encode(value)) for key, value in data.items())
+        pending = batching.current()
+        if pending is not None:
+            for key, stored in data.items():
+                pending.set(self, key, stored)
+            return
+
+        start = time.time()
+        self.cache.set_many(data, self.timeout)
+        self._timing('cache_set', start)
+        if self.local is not None:
+            if not fill:
+                self._bump_generation()
+            for key, stored in data.items():
+                self.local.set(key, stored)
+
+    def _cache_delete(self, key):
+        self._forget(key)
+        pending = batching.current()
+        if pending is not None:
+            pending.delete(self, key)
+            return
+
+        self.cache.delete(key)
+        if self.local is not None:
+            self._bump_generation()
+            self.local.delete(key)
+
+    def _cache_delete_many(self, keys):
+        for key in keys:
+            self._forget(key)
+        pending = batching.current()
+        if pending is not None:
+            for key in keys:
+                pending.delete(self, key)
+            return
+
+        self.cache.delete_many(keys)
+        if self.local is not None:
+            self._bump_generation()
+            for key in keys:
+                self.local.delete(key)
+
+    def _cache_incr(self, key, delta):
+        """ Adds ``delta`` to the counter under ``key``. Counters are stored
+            raw, outside the codec and the local tier, so that the backend can
+            change them atomically. A counter missing from cache stays missing,
+            and False is returned; inside a batch that is only known once it
+            is flushed, and ``_missed_counters`` is told then.
+        """
+        pending = batching.current()
+        if pending is not None:
+            pending.incr(self, key, delta)
+            return True
+        return self._incr(key, delta)
+
+    def _incr(self, key, delta):
+        """ Returns False if the counter was missing. Memcached backends only
+            take positive deltas, so negative ones go through decr. A counter
+            the backend fails to change any other way is deleted, and read
+            again from the database.
+        """
+        try:
+            if delta < 0:
+                self.cache.decr(key, -delta)
+            else:
+                self.cache.incr(key, delta)
+        except ValueError:
+            return False
+        except Exception:
+            self.cache.delete(key)
+            return False
+        return True
+
+    def _missed_counters(self, keys):
+        """ Called with the counters that a batch found missing from cache
+            when it was flushed.
+        """
+
+    def _flush(self, entries):
+        """ Writes the pending entries of a batch for this controller.
+        """
+        data = {}
+        deleted = []
+        replayed = []
+        missed = []
+        for key, entry in entries:
+            if entry.deleted:
+                deleted.append(key)
+            elif entry.delta:
+                if not self._incr(key, entry.delta):
+                    missed.append(key)
+            elif entry.updates:
+                replayed.append((key, entry))
+            elif entry.stored is not None:
+                data[key] = entry.stored
+
+        if replayed:
+            self._replay(replayed)
+
+        if data:
+            self.cache.set_many(data, self.timeout)
+        if deleted:
+            self.cache.delete_many(deleted)
+
+        if self.local is not None and (data or deleted):
+            self._bump_generation()
+            for key, stored in data.items():
+                self.local.set(key, stored)
+            for key in deleted:
+                self.local.delete(key)
+
+        if missed:
+            self._missed_counters(missed)
+
+    def _fill(self, key, load, read=None, relation=None):
+        """ Calls ``load`` to fill a key that missed in cache. With single
+            flight configured, concurrent misses on the key share one load,
+            and ``read`` is used to check whether another process filled it.
+        """
+        def timed_load(load=load):
+            start = time.time()
+            value = load()
+            self.collector.fill(key, time.time() - start, self.model, relation, self.backend)
+            return value
+        load = timed_load
+
+        if self.single_flight is None:
+            return load()
+        if read is None:
+            read = lambda: self._cache_get(key)
+        return self.single_flight.fill(self.cache, key, read, load)
+
+    def _load(self, key, pk):
+        try:
+            obj = self.model._default_manager.get(pk=pk)
+        except self.model.DoesNotExist:
+            obj = self.DNE
+        self._cache_set(key, obj, fill=True)
+        return obj
+
     def get(self, pk):
         key = self.make_key(pk)
-        obj = self.cache.get(key)
+        load = lambda: self._load(key, pk)
+        obj = self._cache_get(key, refresh=load)
+        self._count(obj)
         if obj is None:
+            obj = self._fill(key, load)
+        if obj == self.DNE:
+            raise self.model.DoesNotExist()
+        return obj
+
+    def get_many(self, pks):
+        """ Fetch the instances for several primary keys at once.
+
+            All keys are read with a single cache round trip, and every miss is
+            loaded with a single database query. Results are returned in the
+            order of ``pks``; pks with no matching row are left out, and a DNE
+            marker is cached for them just like ``get`` would.
+        """
+        pks = list(pks)
+        keys = [self.make_key(pk) for pk in pks]
+        key_pks = dict(zip(keys, pks))
+        refresh = lambda key: lambda: self._load(key, key_pks[key])
+        cached = self._cache_get_many(keys, refresh=refresh)
+
+        missing = {}
+        for pk, key in zip(pks, keys):
+            obj = cached.get(key)
+            self._count(obj)
+            if obj is None:
+                missing[key] = pk
+
+        if missing:
+            cached.update(self._load_many(missing))
+
+        objects = []
+        for key in keys:
+            obj = cached[key]
+            if obj != self.DNE:
+                objects.append(obj)
+        return objects
+
+    def get_related(self, pk, *paths):
+        """ Fetch an instance by primary key, like ``get``, with the objects
+            along each of ``paths``, like ``'book__author'``, read from cache
+            into its field caches, the way ``select_related`` would read them
+            from the database. Each hop costs one ``get_many``; see
+            ``autocache.prefetch_cached`` to do the same for many instances.
+        """
+        from .fields import prefetch_cached
+        obj = self.get(pk)
+        prefetch_cached([obj], *paths)
+        return obj
+
+    def _load_many(self, missing):
+        """ Loads the pks in ``missing``, a dict of key to pk, with one query
+            and caches them. Returns the cached values by key.
+        """
+        found = {}
+        start = time.time()
+        queryset = self.model._default_manager.filter(pk__in=missing.values())
+        for obj in queryset:
+            found[self.make_key(obj.pk)] = obj
+        self.collector.fill(sorted(missing), time.time() - start, self.model, backend=self.backend,
+                            count=len(missing))
+        for key in missing:
+            found.setdefault(key, self.DNE)
+        self._cache_set_many(found, fill=True)
+        return found
+
+    def get_by(self, **kwargs):
+        """ Fetch an instance by the value of one of the unique fields the
+            controller was created with, e.g. ``get_by(slug='dickens')``.
+
+            The value is resolved to a pk through a cached index entry, and the
+            pk through the instance key, so a hit costs two cache reads. Index
+            entries left behind by bulk updates are caught by checking the
+            instance still holds the value, and reloaded.
+        """
+        if len(kwargs) != 1:
+            raise TypeError("get_by() takes exactly one field")
+        (name, value), = kwargs.items()
+        if name not in self.unique:
+            raise TypeError("%s is not a unique field of %s's cache" % (name, self.model.__name__))
+        field = self.model._meta.get_field(name)
+        value = field.to_python(value)
+
+        key = self.make_index_key(name, value)
+        load = lambda: self._load_index(key, name, value)
+        pk = self._cache_get(key, refresh=load)
+        self._count(pk, name)
+        if pk is None:
+            pk = self._fill(key, load, relation=name)
+        if pk != self.DNE:
             try:
-                obj = self.model._default_manager.get(pk=pk)
+                obj = self.get(pk)
             except self.model.DoesNotExist:
-                self.cache.set(key, self.DNE, self.timeout)
-                raise
-            self.cache.set(key, obj, self.timeout)
-        elif obj == self.DNE:
+                pass
+            else:
+                if getattr(obj, field.attname) == value:
+                    return obj
+
+            # the index is out of date
+            pk = load()
+        if pk == self.DNE:
             raise self.model.DoesNotExist()
-        return obj
+        return self.get(pk)
+
+    def _load_index(self, key, name, value):
+        try:
+            obj = self.model._default_manager.get(**{name: value})
+        except self.model.DoesNotExist:
+            self._cache_set(key, self.DNE, fill=True)
+            return self.DNE
+        self._cache_set_many({key: obj.pk, self.make_key(obj.pk): obj}, fill=True)
+        return obj.pk
+
+    def _index_keys(self, values):
+        """ Returns the index keys for ``values``, a dict of unique field
+            names to values.
+        """
+        return [self.make_index_key(name, value) for name, value in values.items() if value is not None]
+
+    def _unique_values(self, instance):
+        return dict((name, getattr(instance, self.model._meta.get_field(name).attname)) for name in self.unique)
+
+    def query(self, queryset):
+        """ Returns the instances matched by ``queryset``, a queryset of the
+            model, as a list.
+
+            The pks of the result are cached under ``make_query_key``, and the
+            instances read back from their own keys with ``get_many``. Saves,
+            deletes and many to many changes on any table the query reads move
+            it to a new key. ::
+
+                books = Book.cache.query(Book.objects.filter(rank__gte=5)[:50])
+        """
+        if queryset.model is not self.model:
+            raise TypeError("query() takes a queryset of %s, not %s" % (self.model.__name__, queryset.model.__name__))
+        try:
+            key = self.make_query_key(queryset)
+        except queries.EmptyResultSet:
+            return []
+
+        def load():
+            objects = list(queryset.all())
+            self.warm(objects)
+            self._cache_set(key, [obj.pk for obj in objects], fill=True)
+            return objects
+
+        def read():
+            pks = self._cache_get(key)
+            if pks is None:
+                return None
+            return self.get_many(pks)
+
+        pks = self._cache_get(key, refresh=load)
+        self._count(pks, 'query')
+        if pks is None:
+            return self._fill(key, load, read, relation='query')
+        return self.get_many(pks)
+
+    def warm(self, objects):
+        """ Caches ``objects``, instances of the model, with one ``set_many``.
+        """
+        data = {}
+        for obj in objects:
+            data[self.make_key(obj.pk)] = obj
+            for key in self._index_keys(self._unique_values(obj)):
+                data[key] = obj.pk
+        self._cache_set_many(data, fill=True)
 
     def contribute_to_class(self, model, name):
         self.model = model
+        registry[model] = self
 
         # The ManagerDescriptor attribute prevents this controller from being accessed via model instances.
         setattr(model, name, ManagerDescriptor(self))
 
         models.signals.post_save.connect(self.post_save, sender=model)
         models.signals.post_delete.connect(self.post_delete, sender=model)
+        queries.connect()
+        if self.unique:
+            models.signals.post_init.connect(self.post_init, sender=model)
+
+    def post_init(self, instance, **kwargs):
+        # remember the indexed values, to drop their entries if they change
+        instance._autocache_unique = self._unique_values(instance)
 
     def post_save(self, instance, **kwargs):
         key = self.make_key(instance.pk)
-        self.cache.set(key, instance, self.timeout)
+        if not self.unique:
+            self._cache_set(key, instance)
+            return
+
+        values = self._unique_values(instance)
+        old = getattr(instance, '_autocache_unique', {})
+        changed = dict((name, value) for name, value in old.items() if values.get(name) != value)
+        for old_key in self._index_keys(changed):
+            self._cache_delete(old_key)
+
+        data = {key: instance}
+        for index_key in self._index_keys(values):
+            data[index_key] = instance.pk
+        self._cache_set_many(data)
+        instance._autocache_unique = values
 
     def post_delete(self, instance, **kwargs):
         key = self.make_key(instance.pk)
-        self.cache.set(key, self.DNE, self.timeout)
+        if not self.unique:
+            self._cache_set(key, self.DNE)
+            return
+
+        data = {key: self.DNE}
+        for index_key in self._index_keys(self._unique_values(instance)):
+            data[index_key] = self.DNE
+        self._cache_set_many(data)
 
 
@@ -0,0 +1,53 @@
+"""
+.. module:counters
+   :platform: Django
+   :synopsis: Shared counters kept in a cache backend, that version keys and tell processes what changed.
+
+Namespace generations, the generation that tells other processes to drop
+their local copies of a controller's keys, and the generations of tables
+tagging cached query results are all counters like these. A counter can be
+evicted or expire at any time, and must never go back to a value that was
+used before, or keys orphaned by an earlier increment would be read again.
+So a missing counter restarts from the last value the process knew, or if it
+knew none, from a value taken from the clock; whoever adds it first wins.
+"""
+import time
+
+
+def start(previous=None):
+    """ Value for a counter missing from cache, given the last value this
+        process read from it, if any.
+    """
+    if previous is None:
+        return int(time.time() * 1000)
+    return previous
+
+
+def read(cache, keys, timeout, previous=None):
+    """ Returns the values of the counters under ``keys`` by key, with one
+        ``get_many``. Missing counters are added. ``previous`` maps keys to
+        the values last read from them.
+    """
+    previous = previous or {}
+    found = cache.get_many(keys)
+    values = {}
+    for key in keys:
+        value = found.get(key)
+        if value is None:
+            value = start(previous.get(key))
+            cache.add(key, value, timeout)
+            value = cache.get(key, value)
+        values[key] = value
+    return values
+
+
+def incr(cache, key, timeout, previous=None, delta=1):
+    """ Increments the counter under ``key`` and returns its new value.
+    """
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        value = start(previous) + delta
+        if cache.add(key, value, timeout):
+            return value
+        return cache.incr(key, delta)
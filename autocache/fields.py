@@ -1,6 +1,9 @@
-import django.core.cache
+from django.db import router
 from django.db.models import ForeignKey
 from django.db.models.fields.related import ReverseSingleRelatedObjectDescriptor, ManyToOneRel
+from django.db.models.query import QuerySet
+
+from .controller import CacheController, get_controller
 
 def key_factory(model, to):
     try:
@@ -42,51 +45,42 @@ class CachingReverseSingleRelatedObjectDescriptor(ReverseSingleRelatedObjectDesc
                 raise self.field.rel.to.DoesNotExist
 
             # try to get the object from cache
-            key = self.field.make_key(val)
-            rel_obj = self.field.cache.get(key)
-            if rel_obj is self.field.DNE:
-                raise self.field.rel.to.DoesNotExist
+            controller = self.field.controller
+            key = controller.make_key(val)
+            load = lambda: self.field.load(key, val, instance)
+            rel_obj = controller._cache_get(key, refresh=load)
+            controller._count(rel_obj, self.field.name)
             if rel_obj is None:
-                try:
-                    other_field = self.field.rel.get_related_field()
-                    if other_field.rel:
-                        params = {'%s__pk' % self.field.rel.field_name: val}
-                    else:
-                        params = {'%s__exact' % self.field.rel.field_name: val}
-
-                    # If the related manager indicates that it should be used for
-                    # related fields, respect that.
-                    rel_mgr = self.field.rel.to._default_manager
-                    db = router.db_for_read(self.field.rel.to, instance=instance)
-                    if getattr(rel_mgr, 'use_for_related_fields', False):
-                        rel_obj = rel_mgr.using(db).get(**params)
-                    else:
-                        rel_obj = QuerySet(self.field.rel.to).using(db).get(**params)
-                except self.field.rel.to.DoesNotExist:
-                    self.field.cache.set(key, self.field.DNE, self.field.TIMEOUT)
-                    raise
-
-            self.field.cache.set(key, rel_obj, self.field.TIMEOUT)
+                rel_obj = controller._fill(key, load, relation=self.field.name)
+            if rel_obj == controller.DNE:
+                raise self.field.rel.to.DoesNotExist
+
             setattr(instance, cache_name, rel_obj)
             return rel_obj
 
 
 class CachingForeignKey(ForeignKey):
+    """ A ForeignKey that reads related objects from cache.
+
+        If the related model has a CacheController, the field shares it (and
+        so its keys, backend and settings). Otherwise the field keeps a
+        private controller built from its own ``backend``, ``make_key``,
+        ``single_flight`` and ``stats`` arguments.
+    """
 
-    DNE = 'DOES_NOT_EXIST'
+    DNE = CacheController.DNE
     TIMEOUT = 60 * 60
 
     def __init__(self, to, to_field=None, rel_class=ManyToOneRel, **kwargs):
         # pop kwargs super.__init__ can't handle
         backend = kwargs.pop('backend', 'default')
         self.make_key = kwargs.pop('make_key', None)
+        single_flight = kwargs.pop('single_flight', None)
+        stats = kwargs.pop('stats', None)
 
         super(CachingForeignKey, self).__init__(to, to_field, rel_class, **kwargs)
 
-        if backend is 'default':
-            self.cache = django.core.cache.cache
-        else:
-            self.cache = django.core.cache.get_cache(backend)
+        self._controller = CacheController(backend, self.TIMEOUT, single_flight=single_flight, stats=stats)
 
     def contribute_to_class(self, cls, name):
         super(CachingForeignKey, self).contribute_to_class(cls, name)
@@ -94,3 +88,146 @@ class CachingForeignKey(ForeignKey):
 
         if self.make_key is None:
             self.make_key = key_factory(self.model, self.rel.to)
+
+    @property
+    def controller(self):
+        """ The CacheController that related objects are read through.
+        """
+        controller = get_controller(self.rel.to)
+        if controller is None:
+            controller = self._controller
+            # self.rel.to may have been a lazy reference when we were built
+            controller.model = self.rel.to
+            controller.make_key = self.make_key
+        return controller
+
+    def related_queryset(self, instance=None):
+        """ Returns the queryset used to load related objects on cache misses.
+        """
+        # If the related manager indicates that it should be used for
+        # related fields, respect that.
+        rel_mgr = self.rel.to._default_manager
+        db = router.db_for_read(self.rel.to, instance=instance)
+        if getattr(rel_mgr, 'use_for_related_fields', False):
+            return rel_mgr.using(db)
+        return QuerySet(self.rel.to).using(db)
+
+    def load(self, key, val, instance=None):
+        """ Loads the related object for ``val`` from the database and caches
+            it, returning the cached value.
+        """
+        other_field = self.rel.get_related_field()
+        if other_field.rel:
+            params = {'%s__pk' % self.rel.field_name: val}
+        else:
+            params = {'%s__exact' % self.rel.field_name: val}
+
+        try:
+            rel_obj = self.related_queryset(instance).get(**params)
+        except self.rel.to.DoesNotExist:
+            rel_obj = self.DNE
+        self.controller._cache_set(key, rel_obj, fill=True)
+        return rel_obj
+
+    def get_many_cached(self, values, instance=None):
+        """ Resolves several values of this field to related objects at once.
+
+            Returns a dict mapping each value to its related object. Cached
+            objects are read with a single round trip, and all misses are
+            loaded with a single query. Values with no related row are left
+            out of the result, and a DNE marker is cached for them.
+        """
+        controller = self.controller
+        keys = dict((controller.make_key(val), val) for val in values)
+        refresh = lambda key: lambda: self.load(key, keys[key], instance)
+        cached = controller._cache_get_many(keys.keys(), refresh=refresh)
+
+        missing = [val for key, val in keys.items() if cached.get(key) is None]
+        if missing:
+            found = {}
+            other_field = self.rel.get_related_field()
+            params = {'%s__in' % self.rel.field_name: missing}
+            for rel_obj in self.related_queryset(instance).filter(**params):
+                found[controller.make_key(getattr(rel_obj, other_field.attname))] = rel_obj
+            for val in missing:
+                found.setdefault(controller.make_key(val), self.DNE)
+            controller._cache_set_many(found, fill=True)
+            cached.update(found)
+
+        related = {}
+        for key, val in keys.items():
+            rel_obj = cached[key]
+            if rel_obj != self.DNE:
+                related[val] = rel_obj
+        return related
+
+
+def _resolver(field):
+    """ Returns a function resolving values of the forward relation ``field``
+        to related objects from cache, or None if it can't be.
+    """
+    if isinstance(field, CachingForeignKey):
+        return field.get_many_cached
+    if not isinstance(field, ForeignKey):
+        return None
+    controller = get_controller(field.rel.to)
+    if controller is None or not field.rel.get_related_field().primary_key:
+        return None
+
+    def resolve(values, instance=None):
+        return dict((obj.pk, obj) for obj in controller.get_many(values))
+    return resolve
+
+
+def _prefetch_field(instances, name):
+    """ Resolves the relation ``name`` for every instance in ``instances``
+        with one ``get_many``, and returns the related objects.
+    """
+    if not instances:
+        return []
+
+    opts = instances[0]._meta
+    field = opts.get_field(name)
+    resolve = _resolver(field)
+    if resolve is None:
+        raise ValueError("%s.%s can't be read from cache" % (opts.object_name, name))
+
+    cache_name = field.get_cache_name()
+    related = []
+    pending = {}
+    for instance in instances:
+        if hasattr(instance, cache_name):
+            rel_obj = getattr(instance, cache_name)
+            if rel_obj is not None:
+                related.append(rel_obj)
+            continue
+        val = getattr(instance, field.attname)
+        if val is not None:
+            pending.setdefault(val, []).append(instance)
+
+    if pending:
+        found = resolve(pending.keys(), instances[0])
+        for val, rel_obj in found.items():
+            for instance in pending[val]:
+                setattr(instance, cache_name, rel_obj)
+            related.append(rel_obj)
+    return related
+
+
+def prefetch_cached(instances, *names):
+    """ Resolves the named relations for a list of instances in bulk.
+
+        Each name is a CachingForeignKey, or a ForeignKey or OneToOneField to
+        a model with a CacheController, or a path of them separated by
+        ``__``, like ``'book__author'``. A path is walked one hop at a time:
+        the distinct values of each hop are resolved with a single cache
+        round trip plus at most one query for the misses, and the results
+        are stored in each instance's field cache; later attribute access
+        won't touch the cache or the database.
+    """
+    instances = list(instances)
+    for name in names:
+        level = instances
+        for hop in name.split('__'):
+            level = _prefetch_field(level, hop)
+    return instances
@@ -0,0 +1,90 @@
+"""
+.. module:flight
+   :platform: Django
+   :synopsis: Provides single flight handling of cache misses, so that a hot key which expires is only loaded from the database once.
+"""
+import threading
+import time
+
+
+class _Call(object):
+    """ A fill in progress in this process.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """ Coordinates the loading of missed cache keys.
+
+        Within a process, concurrent misses on the same key wait for a single
+        load and share its result. Across processes, a lease key is taken with
+        ``cache.add``; the process that gets it loads the value, while the
+        others poll the cache every ``retry_interval`` seconds for up to
+        ``wait`` seconds before giving up and loading the value themselves.
+        The lease expires after ``lease_timeout`` seconds, so a filler that
+        dies can't hold it forever.
+    """
+
+    def __init__(self, lease_timeout=10, wait=1.0, retry_interval=0.05):
+        self.lease_timeout = lease_timeout
+        self.wait = wait
+        self.retry_interval = retry_interval
+
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def make_lease_key(self, key):
+        return 'lease:' + key
+
+    def fill(self, cache, key, read, load):
+        """ Fills ``key`` after a miss.
+
+            ``read`` is called to re-read the key from cache, and ``load`` to
+            load the value from the database and write it to cache; both return
+            the value as it is stored in cache. Exceptions raised by ``load``
+            are raised to every caller waiting on it in this process.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait(self.lease_timeout)
+            if not call.event.is_set():
+                return load()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = self._fill(cache, key, read, load)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.value
+
+    def _fill(self, cache, key, read, load):
+        lease_key = self.make_lease_key(key)
+        if cache.add(lease_key, 1, self.lease_timeout):
+            try:
+                return load()
+            finally:
+                cache.delete(lease_key)
+
+        # another process is loading the value; give it a moment to land
+        deadline = time.time() + self.wait
+        while time.time() < deadline:
+            time.sleep(self.retry_interval)
+            value = read()
+            if value is not None:
+                return value
+        return load()
@@ -0,0 +1,160 @@
+"""
+.. module:identity
+   :platform: Django
+   :synopsis: Request scoped identity map, so repeated cache reads in one request return the same objects.
+
+Inside ``identity_map()``, or a request handled by ``IdentityMapMiddleware``,
+every value a controller reads from cache, or writes to it, is remembered by
+key. Reading the key again returns the same object, without a round trip or
+unpickling. ::
+
+    with autocache.identity_map():
+        assert Person.cache.get(pk) is Person.cache.get(pk)
+
+Writes replace what is remembered, and deletes forget it. Writes recorded in
+a batch are forgotten until the batch is written, since it may be dropped.
+
+The map belongs to the context it was entered in: the current thread, or on
+Python 3.7 and later, the current asyncio task and the tasks it starts. Other
+threads and tasks don't see it.
+
+The middleware leaves the map when the response passes through it, when the
+view raises, and in any case when Django signals that the request finished,
+so a map never outlives its request on a thread that goes on to serve others.
+"""
+import threading
+
+from django.core import signals
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+
+if contextvars is not None:
+    _current = contextvars.ContextVar('autocache_identity_map', default=None)
+
+    def current():
+        """ Returns the active IdentityMap, or None.
+        """
+        return _current.get()
+
+    def _activate(identity_map):
+        return _current.set(identity_map)
+
+    def _deactivate(token):
+        _current.reset(token)
+
+else:
+    _state = threading.local()
+
+    def current():
+        """ Returns the active IdentityMap, or None.
+        """
+        return getattr(_state, 'identity_map', None)
+
+    def _activate(identity_map):
+        previous = current()
+        _state.identity_map = identity_map
+        return previous
+
+    def _deactivate(previous):
+        _state.identity_map = previous
+
+
+class IdentityMap(object):
+    """ Context manager holding the values read and written while it is
+        active. A map entered while another is active shares its values.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self._token = None
+        self._active = False
+
+    def __enter__(self):
+        outer = current()
+        if outer is not None:
+            self.objects = outer.objects
+        self._token = _activate(self)
+        self._active = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # the middleware may leave a map both from a response and from the
+        # request_finished signal
+        if self._active:
+            _deactivate(self._token)
+            self._token = None
+            self._active = False
+        return False
+
+    def get(self, controller, key):
+        return self.objects.get((controller.backend, key))
+
+    def set(self, controller, key, value):
+        self.objects[(controller.backend, key)] = value
+
+    def discard(self, controller, key):
+        self.objects.pop((controller.backend, key), None)
+
+
+def identity_map():
+    """ Returns a context manager that makes repeated cache reads inside it
+        return the same objects. ::
+
+            with autocache.identity_map():
+                render_page()
+    """
+    return IdentityMap()
+
+
+# the map the middleware entered for the request being handled by each thread
+_requests = threading.local()
+
+
+class IdentityMapMiddleware(object):
+    """ Gives every request an identity map. Works in ``MIDDLEWARE`` as well
+        as in ``MIDDLEWARE_CLASSES``.
+    """
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with identity_map():
+            return self.get_response(request)
+
+    def process_request(self, request):
+        # a request whose map was never left must not share it with this one
+        _finish()
+        active = request._autocache_identity_map = _requests.identity_map = identity_map()
+        active.__enter__()
+
+    def process_exception(self, request, exception):
+        self._exit(request)
+
+    def process_response(self, request, response):
+        self._exit(request)
+        return response
+
+    def _exit(self, request):
+        active = request.__dict__.pop('_autocache_identity_map', None)
+        if active is not None:
+            if getattr(_requests, 'identity_map', None) is active:
+                _requests.identity_map = None
+            active.__exit__(None, None, None)
+
+
+def _finish(**kwargs):
+    """ Leaves the map the middleware entered for the current thread's
+        request, if nothing else has.
+    """
+    active = getattr(_requests, 'identity_map', None)
+    if active is not None:
+        _requests.identity_map = None
+        active.__exit__(None, None, None)
+
+
+signals.request_finished.connect(_finish, dispatch_uid='autocache.identity.request_finished')
@@ -0,0 +1,115 @@
+"""
+.. module:local
+   :platform: Django
+   :synopsis: Provides a bounded, process local LRU cache used as a first tier in front of the shared cache backend.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class LocalCache(object):
+    """ A process local LRU cache with a short timeout.
+
+        Values are stored pickled, so every read returns a fresh copy that the
+        caller is free to modify, and the pickled size is used to enforce the
+        ``max_bytes`` bound.
+
+        The cache also remembers the invalidation generation of the controller
+        it is attached to. The controller re-reads the shared generation at
+        most once every ``check_interval`` seconds and drops every local entry
+        when another process has moved it on.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, timeout=5, check_interval=1):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.check_interval = check_interval
+
+        self.generation = None
+        self.size = 0
+        self._data = OrderedDict()
+        self._next_check = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, data = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                self.size -= len(data)
+                return None
+            # re-insert to mark the key as most recently used
+            self._data[key] = (expires, data)
+        return pickle.loads(data)
+
+    def set(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._delete(key)
+            if self.max_bytes is not None and len(data) > self.max_bytes:
+                return
+            self._data[key] = (time.time() + self.timeout, data)
+            self.size += len(data)
+            self._cull()
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _delete(self, key):
+        try:
+            expires, data = self._data.pop(key)
+        except KeyError:
+            return
+        self.size -= len(data)
+
+    def _cull(self):
+        while self._data and (len(self._data) > self.max_entries or
+                (self.max_bytes is not None and self.size > self.max_bytes)):
+            key, (expires, data) = self._data.popitem(last=False)
+            self.size -= len(data)
+
+    def should_check(self):
+        """ Returns True when the shared generation is due to be re-read.
+        """
+        now = time.time()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        return True
+
+    def sync(self, generation):
+        """ Drops every local entry if ``generation`` isn't the one we know.
+        """
+        with self._lock:
+            if generation != self.generation:
+                self.clear()
+                self.generation = generation
+
+    def advance(self, generation):
+        """ Records a generation this process moved the shared counter to.
+
+            If another process moved the counter in the meantime we may be
+            holding stale entries, so everything is dropped.
+        """
+        with self._lock:
+            if self.generation is None or generation != self.generation + 1:
+                self.clear()
+            self.generation = generation
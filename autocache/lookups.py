@@ -0,0 +1,216 @@
+"""
+.. module:lookups
+   :platform: Django
+   :synopsis: Filters and orders cached related lists in memory, with a subset of the queryset API.
+
+The lists returned by a RelatedCacheController's instance manager support
+``filter()``, ``exclude()``, ``order_by()``, ``count()`` and ``exists()``,
+evaluated in Python against the cached objects: ::
+
+    person.cache.book_set.filter(rank__gt=5).order_by('title')
+
+Lookups may name any concrete field of the model, or ``pk``, followed by one
+of ``exact``, ``in``, ``gt``, ``gte``, ``lt``, ``lte``, ``isnull`` and
+``startswith``. Lookups that span relations aren't supported and raise
+FieldError. The predicate for each model and set of lookups is compiled once
+and reused.
+
+Ordering by a foreign key sorts by the related pk, the value held by the
+cached object, rather than by the related model's ordering as a queryset
+would.
+"""
+from operator import attrgetter
+
+from django.core.exceptions import FieldError
+from django.db import models
+
+LOOKUPS = ('exact', 'in', 'gt', 'gte', 'lt', 'lte', 'isnull', 'startswith')
+
+
+class SortKey(object):
+    """ Composite sort key of an instance: compares the values of each field
+        of an ordering in turn, in that field's direction.
+    """
+    __slots__ = ('values', 'reverse')
+
+    def __init__(self, values, reverse):
+        self.values = values
+        self.reverse = reverse
+
+    def __lt__(self, other):
+        for x, y, reverse in zip(self.values, other.values, self.reverse):
+            if x != y:
+                return x > y if reverse else x < y
+        return False
+
+
+_sort_keys = {}
+
+def sort_key(ordering):
+    """ Returns a function giving the sort key of an instance for a model's
+        ordering. Orderings without descending fields get plain tuples.
+    """
+    ordering = tuple(ordering)
+    try:
+        return _sort_keys[ordering]
+    except KeyError:
+        pass
+    names = [order_by.lstrip('-') for order_by in ordering]
+    reverse = tuple(order_by[0] == '-' for order_by in ordering)
+    values = attrgetter(*names)
+    if len(names) == 1:
+        values = lambda o, get=values: (get(o),)
+    if any(reverse):
+        key = lambda o: SortKey(values(o), reverse)
+    else:
+        key = values
+    _sort_keys[ordering] = key
+    return key
+
+
+def _field(model, name):
+    """ Returns the concrete field of ``model`` called ``name``.
+    """
+    if name == 'pk':
+        return model._meta.pk
+    try:
+        return model._meta.get_field(name, many_to_many=False)
+    except models.FieldDoesNotExist:
+        raise FieldError("Cannot filter or order cached %s objects by '%s'" % (model.__name__, name))
+
+
+def _parse(model, lookup):
+    """ Splits ``lookup`` into the field it reads and the lookup type.
+    """
+    parts = lookup.split('__')
+    lookup_type = 'exact'
+    if len(parts) > 1 and parts[-1] in LOOKUPS:
+        lookup_type = parts.pop()
+    if len(parts) != 1:
+        raise FieldError("Cached lists can't be filtered across relations: '%s'" % lookup)
+    return _field(model, parts[0]), lookup_type
+
+
+def _prepare(field, lookup_type, value):
+    """ Turns a lookup value into what the attribute is compared with.
+    """
+    if lookup_type == 'isnull':
+        return bool(value)
+    if lookup_type == 'in':
+        return set(_prepare(field, 'exact', v) for v in value)
+    if isinstance(value, models.Model):
+        return value.pk
+    if value is None or lookup_type == 'startswith':
+        return value
+    if isinstance(field, models.ForeignKey):
+        field = field.rel.get_related_field()
+    return field.to_python(value)
+
+
+def _test(lookup_type):
+    """ Returns a function testing an attribute value against a prepared
+        lookup value.
+    """
+    if lookup_type == 'exact':
+        return lambda x, y: x == y
+    if lookup_type == 'in':
+        return lambda x, y: x in y
+    if lookup_type == 'isnull':
+        return lambda x, y: (x is None) == y
+    if lookup_type == 'startswith':
+        return lambda x, y: x is not None and x.startswith(y)
+    compare = {
+        'gt': lambda x, y: x > y,
+        'gte': lambda x, y: x >= y,
+        'lt': lambda x, y: x < y,
+        'lte': lambda x, y: x <= y,
+    }[lookup_type]
+    # NULL is never greater or less than anything
+    return lambda x, y: x is not None and y is not None and compare(x, y)
+
+
+_predicates = {}
+
+def compile_lookups(model, lookups):
+    """ Returns a function that takes the values for ``lookups``, a sorted
+        tuple of lookup names, and returns a predicate matching the objects
+        that pass all of them. Compiled functions are kept per model and
+        lookups, so repeated filters only prepare their values.
+    """
+    try:
+        return _predicates[(model, lookups)]
+    except KeyError:
+        pass
+
+    parsed = [_parse(model, lookup) for lookup in lookups]
+    checks = [(attrgetter(field.attname), _test(lookup_type)) for field, lookup_type in parsed]
+
+    def bind(values):
+        values = [_prepare(field, lookup_type, value)
+                  for (field, lookup_type), value in zip(parsed, values)]
+        bound = list(zip(checks, values))
+        if len(bound) == 1:
+            (get, test), value = bound[0]
+            return lambda o: test(get(o), value)
+        return lambda o: all(test(get(o), value) for (get, test), value in bound)
+
+    _predicates[(model, lookups)] = bind
+    return bind
+
+
+class Filterable(object):
+    """ Queryset style filtering and ordering for a cached list of instances
+        of ``self.model``. Results are ``CachedList`` objects, so calls can
+        be chained.
+    """
+
+    def _matching(self, kwargs):
+        lookups = tuple(sorted(kwargs))
+        return compile_lookups(self.model, lookups)([kwargs[lookup] for lookup in lookups])
+
+    def filter(self, **kwargs):
+        if not kwargs:
+            return self.all()
+        predicate = self._matching(kwargs)
+        return CachedList([o for o in self if predicate(o)], self.model)
+
+    def exclude(self, **kwargs):
+        if not kwargs:
+            return self.all()
+        predicate = self._matching(kwargs)
+        return CachedList([o for o in self if not predicate(o)], self.model)
+
+    def order_by(self, *fields):
+        """ Returns the objects sorted by ``fields``. Foreign keys sort by
+            the related pk.
+        """
+        ordering = []
+        for order_by in fields:
+            direction = '-' if order_by[0] == '-' else ''
+            ordering.append(direction + _field(self.model, order_by.lstrip('-')).attname)
+        objects = CachedList(self, self.model)
+        if ordering:
+            objects.sort(key=sort_key(ordering))
+        return objects
+
+    def all(self):
+        return CachedList(self, self.model)
+
+    def count(self, *args):
+        """ Returns the number of objects, like ``QuerySet.count()``; with an
+            argument, counts occurrences of it like ``list.count()``.
+        """
+        if args:
+            return super(Filterable, self).count(*args)
+        return len(self)
+
+    def exists(self):
+        return len(self) > 0
+
+
+class CachedList(Filterable, list):
+    """ A list of cached instances of ``model``.
+    """
+    def __init__(self, objects=(), model=None):
+        super(CachedList, self).__init__(objects)
+        self.model = model
@@ -0,0 +1,149 @@
+"""
+.. module:autocache_warm
+   :platform: Django
+   :synopsis: Management command that fills the cache from the database, for use after a cache restart.
+"""
+import threading
+import time
+from optparse import make_option
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from autocache.controller import registry
+
+
+class RateLimiter(object):
+    """ Spaces out reads so that at most ``rate`` rows a second are read from
+        the database, across all threads. A rate of 0 doesn't limit anything.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self, rows):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(self._next, now)
+            self._next = start + rows / float(self.rate)
+        if start > now:
+            time.sleep(start - now)
+
+
+class Command(BaseCommand):
+    help = ("Fills the cache with every instance of the models that have a "
+            "CacheController, and optionally their related lists.")
+    args = '[app_label[.ModelName] ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Rows read and cached at a time. Defaults to 1000.'),
+        make_option('--workers', dest='workers', type='int', default=1,
+            help='Models warmed in parallel. Defaults to 1.'),
+        make_option('--rate', dest='rate', type='float', default=0,
+            help='Rows read from the database a second, across all workers. Defaults to no limit.'),
+        make_option('--related', dest='related', action='store_true', default=False,
+            help='Also rebuild the lists of every RelatedCacheController.'),
+    )
+
+    def handle(self, *labels, **options):
+        self.chunk_size = options['chunk_size']
+        self.related = options['related']
+        self.verbosity = int(options.get('verbosity', 1))
+        self.limiter = RateLimiter(options['rate'])
+        self._lock = threading.Lock()
+
+        if self.chunk_size < 1:
+            raise CommandError("--chunk-size must be at least 1")
+
+        pending = queue.Queue()
+        for model, controller in self.select(labels):
+            pending.put((model, controller))
+
+        errors = []
+        def work(close):
+            while True:
+                try:
+                    model, controller = pending.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    self.warm(model, controller)
+                except Exception as e:
+                    errors.append((model, e))
+            if close:
+                # worker threads get their own connection; don't leak it
+                connection.close()
+
+        workers = max(1, options['workers'])
+        if workers == 1:
+            work(close=False)
+        else:
+            threads = [threading.Thread(target=work, args=(True,)) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            model, error = errors[0]
+            raise CommandError("Failed to warm %s: %s" % (self.label(model), error))
+
+    def select(self, labels):
+        """ Returns the registered (model, controller) pairs matching the
+            ``app_label`` or ``app_label.ModelName`` labels, or all of them.
+        """
+        selected = []
+        for model, controller in sorted(registry.items(), key=lambda item: self.label(item[0])):
+            if not labels or model._meta.app_label in labels or self.label(model) in labels:
+                selected.append((model, controller))
+
+        for label in labels:
+            if not any(label in (model._meta.app_label, self.label(model)) for model, _ in selected):
+                raise CommandError("No model with a CacheController matches %r" % label)
+        return selected
+
+    def label(self, model):
+        return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+    def warm(self, model, controller):
+        """ Streams the model's rows in pk order, one chunk at a time, and
+            caches each chunk with one ``set_many``.
+        """
+        queryset = model._default_manager.order_by('pk')
+        warm_related = self.related and hasattr(controller, 'warm_related')
+        count = 0
+        last = None
+
+        while True:
+            chunk = queryset if last is None else queryset.filter(pk__gt=last)
+            self.limiter.wait(self.chunk_size)
+            objects = list(chunk[:self.chunk_size])
+            if not objects:
+                break
+
+            controller.warm(objects)
+            if warm_related:
+                controller.warm_related([obj.pk for obj in objects])
+
+            count += len(objects)
+            last = objects[-1].pk
+            self.progress("%s: %d rows\n" % (self.label(model), count), 2)
+            if len(objects) < self.chunk_size:
+                break
+
+        self.progress("Warmed %s (%d rows)\n" % (self.label(model), count), 1)
+
+    def progress(self, message, verbosity):
+        if self.verbosity >= verbosity:
+            with self._lock:
+                self.stdout.write(message)
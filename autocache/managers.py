@@ -0,0 +1,135 @@
+from django.db import models
+from django.db.models.query import QuerySet
+
+from . import batching, queries
+from .controller import get_controller, registry
+from .fields import prefetch_cached
+
+
+def _foreign_keys(model):
+    return [f for f in model._meta.fields if isinstance(f, models.ForeignKey)]
+
+
+def _invalidate_rows(model, rows, m2m=True):
+    """ Drops the cached instances, related lists and query results affected
+        by a bulk change to ``rows`` of ``model``. Call it inside a batch, so
+        that every controller drops its keys with one ``delete_many``.
+    """
+    queries.invalidate(model)
+
+    controller = get_controller(model)
+    if controller is not None:
+        for row in rows:
+            if row['pk'] is not None:
+                controller._cache_delete(controller.make_key(row['pk']))
+            values = dict((name, row.get(model._meta.get_field(name).attname)) for name in controller.unique)
+            for key in controller._index_keys(values):
+                controller._cache_delete(key)
+
+    for controller in set(registry.values()):
+        if not hasattr(controller, 'bulk_keys'):
+            continue
+        for key in controller.bulk_keys(model, rows, m2m):
+            controller._cache_delete(key)
+
+
+def _row_names(model):
+    """ Returns the attnames of the foreign keys and unique index fields of
+        ``model``, the values ``_invalidate_rows`` needs besides the pk.
+    """
+    names = [f.attname for f in _foreign_keys(model)]
+    controller = get_controller(model)
+    if controller is not None:
+        for name in controller.unique:
+            attname = model._meta.get_field(name).attname
+            if attname not in names:
+                names.append(attname)
+    return names
+
+
+class CachingQuerySet(QuerySet):
+    """ QuerySet with bulk operations that are aware of autocache.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CachingQuerySet, self).__init__(*args, **kwargs)
+        self._prefetch_cached = ()
+
+    def prefetch_cached(self, *names):
+        """ Resolves the named CachingForeignKeys from cache in bulk when the
+            queryset is evaluated. See ``autocache.fields.prefetch_cached``.
+        """
+        return self._clone(_prefetch_cached=self._prefetch_cached + names)
+
+    def iterator(self):
+        iterator = super(CachingQuerySet, self).iterator()
+        if not self._prefetch_cached:
+            return iterator
+        return iter(prefetch_cached(iterator, *self._prefetch_cached))
+
+    def _rows(self, queryset=None):
+        """ Returns the pk, foreign key and unique index values of the rows in
+            ``queryset`` with a single query.
+        """
+        if queryset is None:
+            queryset = self
+        names = _row_names(self.model)
+        values = queryset.values_list(self.model._meta.pk.attname, *names)
+        return [dict(zip(['pk'] + names, row)) for row in values]
+
+    def update(self, **kwargs):
+        """ Updates the rows and drops the cached instances and related lists
+            holding them, including the lists of any new foreign keys and the
+            index entries of any new unique values.
+        """
+        rows = self._rows()
+        with batching.batch():
+            count = super(CachingQuerySet, self).update(**kwargs)
+            _invalidate_rows(self.model, rows)
+
+            names = _row_names(self.model)
+            moved = [f for f in self.model._meta.fields
+                     if f.attname in names and (f.name in kwargs or f.attname in kwargs)]
+            if moved and rows:
+                queryset = self.model._base_manager.using(self.db)
+                queryset = queryset.filter(pk__in=[row['pk'] for row in rows])
+                _invalidate_rows(self.model, self._rows(queryset), m2m=False)
+        return count
+    update.alters_data = True
+
+    def delete(self):
+        """ Deletes the rows, coalescing the invalidations their post_delete
+            signals trigger. The lists holding them are dropped up front
+            rather than updated one row at a time.
+        """
+        rows = self._rows()
+        with batching.batch():
+            _invalidate_rows(self.model, rows)
+            return super(CachingQuerySet, self).delete()
+    delete.alters_data = True
+
+    if hasattr(QuerySet, 'bulk_create'):
+        def bulk_create(self, objs, *args, **kwargs):
+            """ Inserts the objects and drops the related lists they join.
+            """
+            names = _row_names(self.model)
+            with batching.batch():
+                objs = super(CachingQuerySet, self).bulk_create(objs, *args, **kwargs)
+                rows = [dict([('pk', obj.pk)] + [(name, getattr(obj, name)) for name in names]) for obj in objs]
+                _invalidate_rows(self.model, rows, m2m=False)
+            return objs
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_prefetch_cached', self._prefetch_cached)
+        return super(CachingQuerySet, self)._clone(klass, setup, **kwargs)
+
+
+class CachingManager(models.Manager):
+    """ Manager that returns CachingQuerySets.
+    """
+
+    def get_query_set(self):
+        return CachingQuerySet(self.model, using=self._db)
+
+    def prefetch_cached(self, *names):
+        return self.get_query_set().prefetch_cached(*names)
@@ -0,0 +1,155 @@
+"""
+.. module:queries
+   :platform: Django
+   :synopsis: Tags cached query results with the tables they read, and moves the tags on when those tables change.
+
+``CacheController.query()`` caches the pks a queryset matched under a key
+built from its SQL, its parameters and the generation of each table it reads.
+Every table has a generation counter in each cache backend. Saving or
+deleting a row, or changing a many to many relation, increments the counters
+of the tables written, so every query result that read them is orphaned and
+expires on its own.
+
+The tables of every model with a controller, and of the many to many
+relations between them, are watched from the moment the controller is set
+up. Other tables are watched once a cached query has read them in this
+process, or once they are named with ``watch()``.
+"""
+from django.db import models
+
+from . import batching, counters
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+# table counters should outlive the query results they tag
+TAG_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def compile_query(queryset):
+    """ Returns the SQL and parameters of ``queryset``, and the names of the
+        tables it reads. Raises EmptyResultSet if it can't match anything.
+    """
+    query = queryset.query.clone()
+    sql, params = query.get_compiler(queryset.db).as_sql()
+    tables = set()
+    for join in query.alias_map.values():
+        tables.add(getattr(join, 'table_name', None) or join[0])
+    return sql, params, sorted(tables)
+
+
+def tables(model):
+    """ The tables a save of ``model`` writes to.
+    """
+    return [model._meta.db_table] + [parent._meta.db_table for parent in model._meta.get_parent_list()]
+
+
+class Tags(object):
+    """ The generation counters of tables in one cache backend.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def make_key(self, table):
+        return 'autocache:table:%s' % table
+
+    def generations(self, tables):
+        """ Returns the current generation of each of ``tables``, including
+            changes a batch has yet to apply.
+        """
+        keys = [self.make_key(table) for table in tables]
+        found = counters.read(self.cache, keys, TAG_TIMEOUT)
+        generations = []
+        for key in keys:
+            delta = batching.pending_delta(self, key)
+            generations.append(found[key] if delta is None else found[key] + delta)
+        return generations
+
+    def bump(self, tables):
+        pending = batching.current()
+        for table in tables:
+            key = self.make_key(table)
+            if pending is not None:
+                pending.incr(self, key, 1)
+            else:
+                self._incr(key)
+
+    def _incr(self, key, delta=1):
+        counters.incr(self.cache, key, TAG_TIMEOUT, delta=delta)
+
+    def _flush(self, entries):
+        """ Applies the increments a batch recorded.
+        """
+        for key, entry in entries:
+            if entry.delta:
+                self._incr(key, entry.delta)
+
+
+_tags = {}
+
+def get_tags(backend, cache):
+    """ Returns the table counters kept in the cache backend ``backend``.
+    """
+    try:
+        return _tags[backend]
+    except KeyError:
+        tags = _tags[backend] = Tags(cache)
+        return tags
+
+
+_watched = set()
+
+def watch_tables(names):
+    """ Moves on the generations of the tables in ``names`` from now on when
+        they are written, even if no model writing them has a controller.
+    """
+    _watched.update(names)
+
+
+def watch(*watched):
+    """ Watches the tables of the given models, so that writes to them move
+        cached query results on even in processes that haven't cached a
+        query reading them yet. Models with a controller are always
+        watched. ::
+
+            autocache.queries.watch(Book, Person)
+    """
+    watch_tables([table for model in watched for table in tables(model)])
+
+
+def invalidate(model, related=()):
+    """ Moves on the generations of the watched tables of ``model`` in every
+        cache backend a controller uses. The tables of models with a
+        controller are always watched, and so is the table of a many to
+        many through model if one of the ``related`` models it joins has one.
+    """
+    from .controller import registry
+    joins = any(other in registry for other in related)
+    written = [owner._meta.db_table for owner in [model] + list(model._meta.get_parent_list())
+               if joins or owner in registry or owner._meta.db_table in _watched]
+    if not written:
+        return
+    backends = dict((controller.backend, controller.cache) for controller in registry.values())
+    for backend, cache in backends.items():
+        get_tags(backend, cache).bump(written)
+
+
+def _changed(sender, **kwargs):
+    invalidate(sender)
+
+
+def _m2m_changed(sender, action, instance, model, **kwargs):
+    if action.startswith('post_'):
+        invalidate(sender, related=(instance.__class__, model))
+
+
+def connect():
+    """ Hooks up the signals that invalidate query results. Saves and deletes
+        of every model are heard, and ``invalidate`` picks out the watched
+        tables they write.
+    """
+    models.signals.post_save.connect(_changed, weak=False, dispatch_uid='autocache.queries.post_save')
+    models.signals.post_delete.connect(_changed, weak=False, dispatch_uid='autocache.queries.post_delete')
+    models.signals.m2m_changed.connect(_m2m_changed, weak=False, dispatch_uid='autocache.queries.m2m_changed')
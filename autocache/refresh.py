@@ -0,0 +1,90 @@
+"""
+.. module:refresh
+   :platform: Django
+   :synopsis: Provides a bounded thread pool that refreshes stale cache entries in the background.
+"""
+import logging
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from django.db import connection
+
+logger = logging.getLogger('autocache')
+
+
+class RefreshPool(object):
+    """ Runs cache refreshes on a small pool of daemon threads.
+
+        At most ``max_pending`` refreshes are queued at a time, and a key that
+        is already queued isn't queued again; refreshes submitted beyond that
+        are dropped, since the stale value is still being served. With
+        ``workers=0`` refreshes run synchronously in the submitting thread,
+        which is mostly useful in tests.
+    """
+
+    def __init__(self, workers=2, max_pending=1000):
+        self.workers = workers
+        self.max_pending = max_pending
+
+        self._queue = queue.Queue(max_pending)
+        self._pending = set()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, key, func):
+        """ Schedules ``func`` to refresh ``key``. Returns False if the refresh
+            was dropped.
+        """
+        if not self.workers:
+            self._run(func)
+            return True
+
+        with self._lock:
+            if key in self._pending:
+                return False
+            try:
+                self._queue.put_nowait((key, func))
+            except queue.Full:
+                return False
+            self._pending.add(key)
+            self._start()
+        return True
+
+    def join(self):
+        """ Blocks until every queued refresh has run.
+        """
+        self._queue.join()
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name='autocache-refresh')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            key, func = self._queue.get()
+            try:
+                self._run(func)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                self._queue.task_done()
+
+    def _run(self, func):
+        try:
+            func()
+        except Exception:
+            logger.exception("autocache: background refresh failed")
+        finally:
+            if self.workers:
+                # worker threads get their own connection; don't leak it
+                connection.close()
+
+
+default_pool = RefreshPool()
@@ -5,15 +5,20 @@
 
 .. moduleauthor:: Noah Silas
 """
-from operator import attrgetter
+import time
 
+from django.core.cache.backends.memcached import PyLibMCCache
 from django.db import models
 from django.db.models.fields.related import RelatedField
 from django.db.models.manager import ManagerDescriptor
 from django.utils.functional import curry
 
+from . import batching
+from .aggregates import Aggregate, counter_fields
+from .chunks import Chunks, ChunkedList, ChunkSummary, new_token, split
+from .lookups import CachedList, sort_key
 from .relation import Relation
-from .controller import CacheController, no_arg
+from .controller import CacheController, get_controller, no_arg
 
 ### Module level variable used to track lazy relations during
 ### model initialization.
@@ -23,14 +28,206 @@ pending_lookups = {}
 def _sort(objects, ordering):
     """ Given an ordering for a model, sort a list of instances of the model.
     """
-    for order_by in reversed(ordering):
-        reverse = False
-        if order_by[0] == '-':
-            order_by = order_by[1:]
-            reverse = True
-        objects.sort(key=attrgetter(order_by), reverse=reverse)
+    objects.sort(key=sort_key(ordering))
 
 
+def _bisect(objects, key, target, right=True):
+    """ Returns where an object with the sort key ``target`` goes in the
+        sorted list ``objects``, after (or before) any with an equal key.
+        Only computes the keys of the objects it compares against.
+    """
+    lo, hi = 0, len(objects)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if right:
+            before = target < key(objects[mid])
+        else:
+            before = not key(objects[mid]) < target
+        if before:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def _upsert(objects, obj, key):
+    """ Puts ``obj`` into the sorted list ``objects``, replacing the object
+        with the same pk. The old object is looked for among those with the
+        same sort key first, since saves rarely change it.
+    """
+    target = key(obj)
+    index = None
+    for i in range(_bisect(objects, key, target, right=False), _bisect(objects, key, target)):
+        if objects[i].pk == obj.pk:
+            index = i
+            break
+    else:
+        for i, o in enumerate(objects):
+            if o.pk == obj.pk:
+                index = i
+                break
+
+    if index is not None:
+        # the old object may have been read with the new values already, so
+        # check its neighbours before keeping its place
+        if ((index == 0 or not target < key(objects[index - 1])) and
+                (index == len(objects) - 1 or not key(objects[index + 1]) < target)):
+            objects[index] = obj
+            return
+        del objects[index]
+    objects.insert(_bisect(objects, key, target), obj)
+
+
+class Change(object):
+    """ An update to a cached related list: drops the objects whose pks are
+        in ``remove``, puts the objects in ``upsert`` in the list, replacing
+        any with the same pk, and keeps the list sorted by ``ordering``.
+        ``upsert`` may also be a function returning the objects, which is
+        only called if the list is cached.
+
+        Changes are applied to plain lists by calling them, and to chunked
+        lists one chunk at a time with ``apply_chunks``.
+    """
+    def __init__(self, remove=(), upsert=(), ordering=()):
+        self.steps = [(set(remove), upsert)]
+        self.ordering = ordering
+
+    @classmethod
+    def combine(cls, changes):
+        """ Returns a change that applies ``changes`` in turn.
+        """
+        combined = cls()
+        combined.steps = [step for change in changes for step in change.steps]
+        combined.ordering = changes[-1].ordering if changes else ()
+        return combined
+
+    def _resolve(self, index):
+        remove, upsert = self.steps[index]
+        if callable(upsert):
+            upsert = list(upsert())
+            self.steps[index] = (remove, upsert)
+        return remove, upsert
+
+    def __call__(self, objects):
+        objects = list(objects)
+        for index in range(len(self.steps)):
+            remove, upsert = self._resolve(index)
+            if remove:
+                objects = [o for o in objects if o.pk not in remove]
+            if self.ordering:
+                # the list is kept sorted, so each object is bisected into it
+                key = sort_key(self.ordering)
+                for o in upsert:
+                    _upsert(objects, o, key)
+                continue
+
+            replace = dict((o.pk, o) for o in upsert)
+            if replace:
+                objects = [replace.pop(o.pk) if o.pk in replace else o for o in objects]
+                objects.extend(o for o in upsert if o.pk in replace)
+        return objects
+
+    def chunks_needed(self, summaries):
+        """ Returns the indexes of the chunks, described by ``summaries``,
+            that applying the change reads: those holding an object it
+            removes or replaces, and those the objects it upserts go into.
+        """
+        key = sort_key(self.ordering) if self.ordering else None
+        needed = set()
+        for index in range(len(self.steps)):
+            remove, upsert = self._resolve(index)
+            pks = remove | set(o.pk for o in upsert)
+            for i, summary in enumerate(summaries):
+                if not pks.isdisjoint(summary.pks):
+                    needed.add(i)
+            for o in upsert:
+                target = len(summaries) - 1
+                if key is not None:
+                    for i, summary in enumerate(summaries):
+                        if key(o) < summary.last:
+                            target = i
+                            break
+                needed.add(target)
+        return needed
+
+    def apply_chunks(self, chunks, size, read=None):
+        """ Applies the change to ``chunks``, a list of (token, objects)
+            pairs, and returns the new list of pairs. Chunks that changed get
+            None as their token; chunks left with more than twice ``size``
+            objects are split, and empty ones dropped.
+
+            A chunk that wasn't read can be given as a ``ChunkSummary``
+            instead of its objects. It is passed on as it is if the change
+            doesn't touch it, and read with ``read(token)`` if it does.
+        """
+        chunks = [[token, objects if isinstance(objects, ChunkSummary) else list(objects)]
+                  for token, objects in chunks]
+
+        def objects_of(chunk):
+            if isinstance(chunk[1], ChunkSummary):
+                chunk[1] = list(read(chunk[0]))
+            return chunk[1]
+
+        for index in range(len(self.steps)):
+            remove, upsert = self._resolve(index)
+            replace = dict((o.pk, o) for o in upsert)
+            touched = remove | set(replace)
+            place = []
+            for chunk in chunks:
+                if isinstance(chunk[1], ChunkSummary) and chunk[1].pks.isdisjoint(touched):
+                    continue
+                result = []
+                for o in objects_of(chunk):
+                    if o.pk in replace:
+                        new = replace.pop(o.pk)
+                        if self.ordering:
+                            # it may have to move; put it back in order below
+                            place.append(new)
+                        else:
+                            result.append(new)
+                    elif o.pk not in remove:
+                        result.append(o)
+                        continue
+                    chunk[0] = None
+                chunk[1] = result
+            place.extend(o for o in upsert if o.pk in replace)
+
+            key = sort_key(self.ordering) if self.ordering else None
+            for o in place:
+                target = None
+                if key is not None:
+                    # the first chunk ending with an object that sorts after it
+                    for chunk in chunks:
+                        if isinstance(chunk[1], ChunkSummary):
+                            last = chunk[1].last
+                        elif chunk[1]:
+                            last = key(chunk[1][-1])
+                        else:
+                            continue
+                        if key(o) < last:
+                            target = chunk
+                            break
+                if target is None:
+                    if not chunks:
+                        chunks.append([None, []])
+                    target = chunks[-1]
+                objects = objects_of(target)
+                target[0] = None
+                if key is None:
+                    objects.append(o)
+                else:
+                    objects.insert(_bisect(objects, key, key(o)), o)
+
+        result = []
+        for token, objects in chunks:
+            if not len(objects):
+                continue
+            if len(objects) > 2 * size:
+                result.extend([None, part] for part in split(objects, size))
+            else:
+                result.append((token, objects))
+        return [tuple(chunk) for chunk in result]
+
 
 class FieldCachingDescriptor(object):
     def __init__(self, name):
@@ -57,44 +254,99 @@ class InstanceCacheManager(object):
         self.manager = manager
 
     def __getattr__(self, name):
-        relation = None
+        relation, model, key, load = self._lookup(name)
         manager = self.manager
 
-        names = dict((rel.get_accessor_name(), rel) for rel in manager.relations)
-        for rel in manager.m2m_relations:
-            if rel.model == self.manager.model:
-                names[rel.field.name] = rel
-            else:
-                names[rel.get_accessor_name()] = rel
+        if isinstance(relation.field, models.OneToOneField):
+            obj = manager._cache_get(key, refresh=load)
+            manager._count(obj, name)
+            if obj is None:
+                obj = manager._fill(key, load, relation=name)
+            if obj == manager.DNE:
+                raise relation.model.DoesNotExist()
+            return obj
 
+        objects = manager._get_objects(key, model, refresh=load)
+        manager._count(objects, name)
+        if objects is None:
+            read = lambda: manager._get_objects(key, model, load=load)
+            objects = manager._fill(key, load, read, relation=name)
+        if objects is not None and not isinstance(objects, ChunkedList):
+            objects = CachedList(objects, model)
+        return objects
+
+    def aggregate(self, name):
+        """ Returns the aggregates kept for the relation ``name``, by alias,
+            like ``QuerySet.aggregate()`` would. Only the ones missing from
+            cache are read from the database, with one query.
+        """
+        return self.manager._get_aggregates(self.instance, name, self.manager._declared(name))
+
+    def count(self, name):
+        """ Returns the number of objects in the relation ``name``, which
+            needs a ``Count`` of its primary key declared.
+        """
+        counts = [a for a in self.manager._declared(name) if a.kind == 'Count' and a.field.primary_key]
+        if not counts:
+            raise TypeError("No count of %s is kept in %s's cache" % (name, self.manager.model.__name__))
+        return self.manager._get_aggregates(self.instance, name, counts[:1])[counts[0].alias]
+
+    def _lookup(self, name):
+        """ Returns the relation called ``name``, the model of the objects it
+            holds, its cache key and a function that loads and caches it.
+        """
+        manager = self.manager
+        names = manager.related_names()
         if name not in names:
             raise AttributeError("Attempting to access an unknown relation (%s)" % name)
 
-        relation = names[name]
+        relation, model = names[name]
+        key = manager.make_related_key(self.instance.pk, name)
 
-        key = '%s:%s' % (manager.make_key(self.instance.pk), name)
-        objects = self.manager.cache.get(key)
-
-        prepare = lambda x: list(x.all())
         if isinstance(relation.field, models.OneToOneField):
-            prepare = lambda x: x
-            if objects == self.manager.DNE:
-                raise relation.model.DoesNotExist()
-
-        if objects is None:
-            objects = prepare(getattr(self.instance, name))
-            self.manager.cache.set(key, objects, self.manager.timeout)
+            def load():
+                try:
+                    obj = getattr(self.instance, name)
+                except relation.model.DoesNotExist:
+                    obj = manager.DNE
+                manager._cache_set(key, obj, fill=True)
+                return obj
+        else:
+            def load():
+                objects = list(getattr(self.instance, name).all())
+                manager._set_objects(key, model, objects, fill=True)
+                return objects
 
-        return objects
+        return relation, model, key, load
 
 
 class RelatedCacheController(CacheController):
-
-    def __init__(self, backend='default', timeout=no_arg):
-        super(RelatedCacheController, self).__init__(backend, timeout)
+    # attempts made to update a related list before giving up and deleting it
+    UPDATE_RETRIES = 10
+    # seconds a lock guarding a related list update is held at most
+    LOCK_TIMEOUT = 5
+    # seconds between attempts; each attempt waits a little longer
+    RETRY_INTERVAL = 0.005
+
+    def __init__(self, backend='default', timeout=no_arg, local=None, single_flight=None,
+                 soft_timeout=None, refresh_pool=None, codec=None, stats=None, normalized=False,
+                 unique=(), chunk_size=None, aggregates=None):
+        super(RelatedCacheController, self).__init__(backend, timeout, local, single_flight,
+                                                     soft_timeout, refresh_pool, codec, stats,
+                                                     unique)
         self.relations = []
         self.m2m_relations = []
 
+        # store related lists as pk lists, hydrated from instance keys
+        self.normalized = normalized
+
+        # store related lists longer than this in chunks of this many objects
+        self.chunk_size = chunk_size
+
+        # aggregates to keep for each relation, as declared and once set up
+        self.aggregates = dict(aggregates or {})
+        self._aggregates = {}
+
     def __get__(self, instance, owner):
         if instance is None:
             return self
@@ -166,6 +418,701 @@ class RelatedCacheController(CacheController):
             else:
                 self._setup_relation(field.related)
 
+    def make_related_key(self, pk, name):
+        """ Key of the list of objects related to ``pk`` through the relation
+            called ``name``.
+        """
+        return ':'.join((self.make_key(pk), name, str(self._namespace(name))))
+
+    def make_aggregate_key(self, pk, name, alias):
+        """ Key of the aggregate ``alias`` of the relation ``name`` of ``pk``.
+        """
+        return '%s:%s' % (self.make_related_key(pk, name), alias)
+
+    def invalidate_all(self, relation=None):
+        """ Drops every cached instance of the model at once, or with
+            ``relation``, every cached list of that relation.
+        """
+        self._bump_namespace(relation)
+
+    def related_names(self):
+        """ Maps the name of each cached relation to the relation and the
+            model of the objects it holds.
+        """
+        names = dict((rel.get_accessor_name(), (rel, rel.model)) for rel in self.relations)
+        for rel in self.m2m_relations:
+            if rel.model == self.model:
+                names[rel.field.name] = (rel, rel.parent_model)
+            else:
+                names[rel.get_accessor_name()] = (rel, rel.model)
+        return names
+
+    def load_related(self, name, pks):
+        """ Loads the related objects of relation ``name`` for every pk in
+            ``pks``, grouped by pk, with one query for foreign keys and two
+            for many to many relations. One to one relations map each pk to
+            the object or DNE; other relations to a list in the model's order.
+        """
+        relation, model = self.related_names()[name]
+        field = relation.field
+        pks = list(pks)
+
+        if not isinstance(field, models.ManyToManyField):
+            objects = model._default_manager.filter(**{field.name + '__in': pks})
+            if isinstance(field, models.OneToOneField):
+                grouped = dict.fromkeys(pks, self.DNE)
+                for obj in objects:
+                    grouped[getattr(obj, field.attname)] = obj
+                return grouped
+            grouped = dict((pk, []) for pk in pks)
+            for obj in objects:
+                grouped[getattr(obj, field.attname)].append(obj)
+            return grouped
+
+        # read the pairs from the through table, then the objects themselves
+        source, target = field.m2m_reverse_field_name(), field.m2m_field_name()
+        if model is relation.parent_model:
+            source, target = target, source
+        pairs = field.rel.through._default_manager.filter(**{source + '__in': pks})
+        pairs = list(pairs.values_list(source, target))
+
+        members = {}
+        for pk, member in pairs:
+            members.setdefault(member, []).append(pk)
+        grouped = dict((pk, []) for pk in pks)
+        for obj in model._default_manager.filter(pk__in=members.keys()):
+            for pk in members[obj.pk]:
+                grouped[pk].append(obj)
+        return grouped
+
+    def warm_related(self, pks, names=None):
+        """ Caches the related lists of every pk in ``pks``, for the relations
+            in ``names`` or all of them, with one ``set_many`` per relation.
+        """
+        pks = list(pks)
+        related = self.related_names()
+        if names is None:
+            names = related.keys()
+        for name in names:
+            relation, model = related[name]
+            single = isinstance(relation.field, models.OneToOneField)
+            data = {}
+            for pk, objects in self.load_related(name, pks).items():
+                key = self.make_related_key(pk, name)
+                if not single:
+                    objects = self._chunk(key, model, objects)
+                data[key] = objects
+            self._cache_set_many(data, fill=True)
+
+    def _namespace_names(self):
+        names = [None] + [rel.get_accessor_name() for rel in self.relations]
+        return names + [rel.field.name for rel in self.m2m_relations]
+
+    ###
+    ### Related list storage. Normalized controllers store a list of pks for
+    ### each relation whose model has a CacheController of its own, and read
+    ### the instances back from that controller's instance keys.
+    ###
+
+    def _instance_controller(self, model):
+        """ Returns the controller holding instances of ``model`` when lists
+            of them are stored normalized, or None.
+        """
+        if not self.normalized:
+            return None
+        return get_controller(model)
+
+    def _pack_objects(self, model, objects):
+        objects = list(objects)
+        if self._instance_controller(model) is None:
+            return objects
+        return [o.pk for o in objects]
+
+    def _unpack_objects(self, model, value):
+        controller = self._instance_controller(model)
+        if value is None or controller is None:
+            return value
+        return controller.get_many(value)
+
+    def _get_objects(self, key, model, refresh=None, load=None):
+        """ Returns the cached list of ``model`` instances under ``key``, or
+            None on a miss. Chunked lists are returned as a ``ChunkedList``,
+            which calls ``load``, or ``refresh``, if its chunks are missing.
+        """
+        value = self._cache_get(key, refresh=refresh)
+        if isinstance(value, Chunks):
+            return ChunkedList(self, key, model, value, load or refresh)
+        return self._unpack_objects(model, value)
+
+    def _set_objects(self, key, model, objects, fill=False, previous=None):
+        """ Caches a list of ``model`` instances under ``key``.
+
+            When the list is stored normalized and ``previous`` holds the pks
+            it had before, it is only written if its pks or their order
+            changed; the instances themselves live in their own keys.
+        """
+        objects = list(objects)
+        value = self._pack_objects(model, objects)
+        if previous is not None and value == previous:
+            return
+        self._cache_set(key, self._chunk(key, model, objects), fill=fill)
+
+    ###
+    ### Chunked lists. With chunk_size set, a list longer than that is stored
+    ### as a Chunks header under its key, and its objects in chunks under
+    ### keys named by random tokens. A chunk key is written once; changes go
+    ### to new keys, and the old ones expire. Chunks are kept twice as long
+    ### as headers, and a header is only written along with fresh copies of
+    ### the chunks older than the timeout, so no chunk expires before a header
+    ### that names it.
+    ###
+
+    def make_chunk_key(self, key, token):
+        """ Key of the chunk named ``token`` of the list under ``key``.
+        """
+        return '%s:chunk:%s' % (key, token)
+
+    def make_summary_key(self, key, token):
+        """ Key of the ``ChunkSummary`` of the chunk named ``token``.
+        """
+        return '%s:chunk:%s:summary' % (key, token)
+
+    def _chunk(self, key, model, objects):
+        """ Returns what to store under ``key`` for the list ``objects``: the
+            packed list, or if it is longer than ``chunk_size``, a header for
+            the chunks it is written to.
+        """
+        objects = list(objects)
+        if self.chunk_size is None or len(objects) <= self.chunk_size:
+            return self._pack_objects(model, objects)
+        return self._write_chunks(key, model, [(None, part) for part in split(objects, self.chunk_size)])
+
+    def _write_chunks(self, key, model, chunks):
+        """ Writes the chunks in ``chunks``, a list of (token, objects) pairs,
+            whose token is None, with their summaries, and returns the header
+            for all of them.
+        """
+        ordering = model._meta.ordering
+        now = time.time()
+        data = {}
+        header = []
+        for token, objects in chunks:
+            if token is None:
+                token = new_token()
+                last = sort_key(ordering)(objects[-1]) if ordering else None
+                data[self.make_chunk_key(key, token)] = self._pack_objects(model, objects)
+                data[self.make_summary_key(key, token)] = ChunkSummary([o.pk for o in objects], last, now)
+            header.append((token, len(objects)))
+
+        # chunk keys are never rewritten, so they can be written straight
+        # away, even inside a batch; only the header makes them visible
+        timeout = self.timeout * 2 if self.timeout else self.timeout
+        start = time.time()
+        self.cache.set_many(dict((k, self._encode(value)) for k, value in data.items()), timeout)
+        self._timing('cache_set', start)
+        return Chunks(sum(length for token, length in header), header)
+
+    def _read_chunks(self, key, model, header, indexes):
+        """ Returns the objects of the chunks of ``header`` in ``indexes``, by
+            index, or None if any of them is missing from cache.
+        """
+        keys = dict((self.make_chunk_key(key, header.chunks[index][0]), index) for index in indexes)
+        found = self._cache_get_many(keys.keys())
+        if len(found) < len(keys):
+            return None
+        return dict((keys[chunk_key], self._unpack_objects(model, value)) for chunk_key, value in found.items())
+
+    def _read_summaries(self, key, header):
+        """ Returns the summaries of the chunks of ``header``, in order, or
+            None if any of them is missing from cache.
+        """
+        keys = [self.make_summary_key(key, token) for token, length in header.chunks]
+        found = self._cache_get_many(keys)
+        if len(found) < len(keys):
+            return None
+        return [found[k] for k in keys]
+
+    def _apply_chunks(self, key, model, header, update, load):
+        """ Returns the header to store after applying ``update`` to a chunked
+            list, or None if it didn't change.
+
+            A ``Change`` reads the summaries of the chunks, then only the
+            chunks it touches. The chunks that changed are written, and if
+            the header is, so are copies of the chunks older than the timeout.
+        """
+        summaries = None
+        if isinstance(update, Change):
+            summaries = self._read_summaries(key, header)
+        if summaries is None:
+            # every chunk is read, and written again if the header is
+            indexes = range(len(header.chunks))
+            aged = set(indexes)
+        else:
+            expired = time.time() - self.timeout if self.timeout else None
+            aged = set(i for i, summary in enumerate(summaries) if expired is not None and summary.written < expired)
+            indexes = update.chunks_needed(summaries) | aged
+        found = self._read_chunks(key, model, header, indexes)
+        if found is None:
+            return self._chunk(key, model, load())
+
+        def read(token):
+            index = [t for t, length in header.chunks].index(token)
+            objects = self._read_chunks(key, model, header, [index])
+            if objects is None:
+                raise LookupError("Chunks of %s are missing from cache" % key)
+            return objects[index]
+
+        chunks = []
+        for index, (token, length) in enumerate(header.chunks):
+            chunks.append((token, found[index] if index in found else summaries[index]))
+        try:
+            if isinstance(update, Change):
+                chunks = update.apply_chunks(chunks, self.chunk_size, read)
+            else:
+                objects = update([o for token, objects in chunks for o in objects])
+                chunks = [(None, part) for part in split(objects, self.chunk_size)]
+
+            if len(chunks) == len(header.chunks) and all(token is not None for token, objects in chunks):
+                return None
+            if sum(len(objects) for token, objects in chunks) <= self.chunk_size:
+                objects = []
+                for token, chunk in chunks:
+                    objects.extend(read(token) if isinstance(chunk, ChunkSummary) else chunk)
+                return self._pack_objects(model, objects)
+        except LookupError:
+            return self._chunk(key, model, load())
+
+        # the header is rewritten; so are the chunks it would outlive
+        aged_tokens = set(header.chunks[index][0] for index in aged)
+        return self._write_chunks(key, model, [(None if token in aged_tokens else token, objects)
+                                               for token, objects in chunks])
+
+    def _update_objects(self, key, model, update, load):
+        """ Applies ``update`` to the cached list under ``key`` without losing
+            concurrent updates made by other processes.
+
+            ``update``, usually a ``Change``, is called with the cached list of
+            instances and returns the new list; if the key isn't cached the list returned by ``load``
+            is stored instead.
+        """
+        self._update_many([(key, model, update, load)])
+
+    def _update_many(self, items, load_many=None):
+        """ Applies updates to cached lists without losing concurrent updates
+            made by other processes. ``items`` are (key, model, update, load)
+            tuples, as taken by ``_update_objects``. ``load_many``, if given,
+            is called with the keys that aren't cached and returns their lists
+            by key, loaded together.
+
+            Inside a batch the updates are recorded there. Memcached backends
+            using pylibmc with the ``cas`` behavior are updated with gets/cas,
+            two round trips per list. Other backends take a lock key for every
+            list with ``cache.add``, then read and write the lists they hold
+            with one ``get_many`` and one ``set_many``. Lists whose update
+            keeps conflicting are deleted, so that the next read loads them
+            from the database.
+        """
+        for key, model, update, load in items:
+            # the list may be rewritten outside of _cache_set, with cas
+            self._forget(key)
+
+        pending = batching.current()
+        if pending is not None:
+            self._record_updates(pending, items, load_many)
+            return
+
+        cas = self._uses_cas()
+        if cas:
+            apply = self._update_many_cas
+        else:
+            apply = self._update_many_locked
+
+        for attempt in range(self.UPDATE_RETRIES):
+            items = apply(items, load_many)
+            if not items:
+                return
+            time.sleep(self.RETRY_INTERVAL * (attempt + 1))
+
+        keys = [key for key, model, update, load in items]
+        if not cas:
+            # whoever holds a lock may write back a list read before this
+            # delete; the mark tells it to delete the list again once written
+            self.cache.set_many(dict((self.make_stale_key(key), 1) for key in keys), self.LOCK_TIMEOUT)
+        # a cas write based on the list before the delete fails
+        for key in keys:
+            self._cache_delete(key)
+
+    def _uses_cas(self):
+        """ Whether related lists are updated with gets/cas. pylibmc clients
+            only allow it with the ``cas`` behavior set in the backend's
+            OPTIONS.
+        """
+        if not isinstance(self.cache, PyLibMCCache):
+            return False
+        return bool(self.cache._cache.behaviors.get('cas'))
+
+    def make_lock_key(self, key):
+        """ Key of the lock guarding updates of the list under ``key``.
+        """
+        return 'lock:' + key
+
+    def make_stale_key(self, key):
+        """ Key of the mark left on the list under ``key`` by an update that
+            gave up on taking its lock.
+        """
+        return 'stale:' + key
+
+    def make_fill_key(self, key):
+        """ Key of the mark set while the aggregate under ``key`` is read from
+            the database to fill it.
+        """
+        return 'fill:' + key
+
+    def _replay(self, entries):
+        """ Applies the related list updates recorded by a batch, for every
+            (key, entry) pair in ``entries``, in one go.
+        """
+        self._update_many([(key, entry.model, Change.combine(entry.updates), entry.load)
+                           for key, entry in entries])
+
+    def _apply_update(self, key, model, value, update, load):
+        """ Returns the value to store after applying ``update`` to a cached
+            list, or None if a normalized or chunked list didn't change.
+        """
+        if isinstance(value, Chunks):
+            return self._apply_chunks(key, model, value, update, load)
+        objects = self._unpack_objects(model, value)
+        previous = self._pack_objects(model, objects)
+        objects = update(objects)
+        if self._instance_controller(model) is not None and self._pack_objects(model, objects) == previous:
+            return None
+        return self._chunk(key, model, objects)
+
+    def _apply_updates(self, items, values, load_many):
+        """ Returns the value to store for the key of each of ``items``, by
+            key: its update applied to the list found in ``values``, None if
+            that list didn't change, or for a key missing from ``values``, the
+            list loaded from the database.
+        """
+        missing = [key for key, model, update, load in items if key not in values]
+        loaded = {}
+        if missing and load_many is not None:
+            loaded = load_many(missing)
+
+        updated = {}
+        for key, model, update, load in items:
+            if key in values:
+                updated[key] = self._apply_update(key, model, values[key], update, load)
+            else:
+                objects = loaded[key] if key in loaded else load()
+                updated[key] = self._chunk(key, model, objects)
+        return updated
+
+    def _record_updates(self, pending, items, load_many):
+        """ Records the updates in ``items`` in the batch ``pending``, to be
+            replayed when it is flushed.
+        """
+        # lists that are being dropped anyway are reloaded by the next read
+        items = [item for item in items if not getattr(batching.lookup(self, item[0]), 'deleted', False)]
+        values = self._cache_get_many([key for key, model, update, load in items])
+        updated = self._apply_updates(items, values, load_many)
+        for key, model, update, load in items:
+            value = updated[key]
+            if value is None:
+                value = values[key]
+            pending.update(self, key, self._encode(value), model, update, load, key in values)
+
+    def _read_raw(self, stored):
+        """ Decodes a list read straight from the backend.
+        """
+        if stored is None:
+            return None
+        return self._decode(stored)[0]
+
+    def _update_many_cas(self, items, load_many):
+        """ Applies the updates in ``items`` with gets/cas, and returns the
+            ones that conflicted with another write.
+        """
+        client = self.cache._cache
+        values = {}
+        tokens = {}
+        for key, model, update, load in items:
+            stored, token = client.gets(self.cache.make_key(key))
+            value = self._read_raw(stored)
+            if value is not None:
+                values[key], tokens[key] = value, token
+        updated = self._apply_updates(items, values, load_many)
+
+        filled = dict((key, value) for key, value in updated.items() if key not in values)
+        if filled:
+            self._cache_set_many(filled)
+
+        conflicts = []
+        timeout = self.cache._get_memcache_timeout(self.timeout)
+        for item in items:
+            key = item[0]
+            if key not in values or updated[key] is None:
+                continue
+            stored = self._encode(updated[key])
+            if not client.cas(self.cache.make_key(key), stored, tokens[key], timeout):
+                conflicts.append(item)
+            elif self.local is not None:
+                self._bump_generation()
+                self.local.set(key, stored)
+        return conflicts
+
+    def _update_many_locked(self, items, load_many):
+        """ Applies the updates in ``items`` whose lists could be locked, and
+            returns the others.
+        """
+        locked = []
+        busy = []
+        for item in items:
+            if self.cache.add(self.make_lock_key(item[0]), 1, self.LOCK_TIMEOUT):
+                locked.append(item)
+            else:
+                busy.append(item)
+        if not locked:
+            return busy
+
+        keys = [key for key, model, update, load in locked]
+        try:
+            values = {}
+            for key, stored in self.cache.get_many(keys).items():
+                value = self._read_raw(stored)
+                if value is not None:
+                    values[key] = value
+            updated = self._apply_updates(locked, values, load_many)
+            data = dict((key, value) for key, value in updated.items() if value is not None)
+            if data:
+                self._cache_set_many(data)
+                # updates that gave up while we held the locks, and that what
+                # we wrote misses
+                stale = self.cache.get_many([self.make_stale_key(key) for key in data])
+                for key in data:
+                    if self.make_stale_key(key) in stale:
+                        self._cache_delete(key)
+        finally:
+            self.cache.delete_many([self.make_lock_key(key) for key in keys])
+        return busy
+
+    ###
+    ### Aggregates. Each aggregate declared for a relation is kept under a key
+    ### of its own for every instance. Counts and sums of integer fields are
+    ### counters changed with incr/decr; the rest are dropped when a change
+    ### may have made them wrong, and read again with one aggregate query.
+    ###
+
+    def _setup_aggregates(self, relation, name, model):
+        """ Prepares the aggregates declared for the relation ``name``, which
+            holds instances of ``model``.
+        """
+        if name not in self.aggregates:
+            return
+        if isinstance(relation.field, models.OneToOneField):
+            raise ValueError("Aggregates can't be kept for the one to one relation %s" % name)
+        fields = counter_fields(self.cache)
+        self._aggregates[name] = [Aggregate(aggregate, model, fields) for aggregate in self.aggregates[name]]
+
+        f = curry(self._remember_aggregated, name)
+        models.signals.post_init.connect(f, sender=model, weak=False)
+
+    def _declared(self, name):
+        if name not in self.related_names():
+            raise AttributeError("Attempting to access an unknown relation (%s)" % name)
+        if name not in self._aggregates:
+            raise TypeError("No aggregates of %s are kept in %s's cache" % (name, self.model.__name__))
+        return self._aggregates[name]
+
+    def _aggregate_keys(self, pk, name):
+        return [self.make_aggregate_key(pk, name, a.alias) for a in self._aggregates.get(name, ())]
+
+    def _relation_keys(self, pk, name):
+        """ The key of the list of the relation ``name`` of ``pk``, and of its
+            aggregates.
+        """
+        return [self.make_related_key(pk, name)] + self._aggregate_keys(pk, name)
+
+    def _aggregated(self, name, instance):
+        """ The values of ``instance`` that the aggregates of ``name`` read.
+        """
+        return dict((a.attname, getattr(instance, a.attname)) for a in self._aggregates[name])
+
+    def _remember_aggregated(self, name, instance, **kwargs):
+        # remember the aggregated values, to know what a save changes
+        remembered = instance.__dict__.setdefault('_autocache_aggregated', {})
+        remembered[(self.model, name)] = self._aggregated(name, instance)
+
+    def _previous(self, name, instance):
+        """ The aggregated values ``instance`` had when it was loaded or last
+            saved, as a list of one row, or None if they aren't known.
+        """
+        row = getattr(instance, '_autocache_aggregated', {}).get((self.model, name))
+        if row is None:
+            return None
+        return [row]
+
+    def _aggregated_rows(self, name, model, pks):
+        """ The aggregated values of the ``model`` instances in ``pks``, read
+            with one query unless only their pks are needed.
+        """
+        pk = model._meta.pk
+        aggregates = self._aggregates[name]
+        if all(a.field is pk for a in aggregates):
+            return [{pk.attname: value} for value in pks]
+        fields = []
+        for a in aggregates:
+            if a.field not in fields:
+                fields.append(a.field)
+        rows = model._default_manager.filter(pk__in=pks).values_list(*[f.name for f in fields])
+        return [dict(zip([f.attname for f in fields], row)) for row in rows]
+
+    def _read_aggregates(self, keys):
+        """ Returns the aggregates cached under ``keys``, including the
+            changes pending in a batch.
+        """
+        values = {}
+        keys = [key for key in keys if batching.pending_delta(self, key) is not None]
+        for key, value in self.cache.get_many(keys).items():
+            if value == self.DNE:
+                value = None
+            else:
+                value += batching.pending_delta(self, key)
+            values[key] = value
+        return values
+
+    def _get_aggregates(self, instance, name, aggregates):
+        keys = dict((self.make_aggregate_key(instance.pk, name, a.alias), a) for a in aggregates)
+        values = self._read_aggregates(keys)
+        missing = dict((key, a) for key, a in keys.items() if key not in values)
+        self._count(None if missing else values, name)
+
+        if missing:
+            # the database may already hold changes a batch has yet to apply
+            fills = {}
+            if batching.current() is None:
+                token = new_token()
+                for key in missing:
+                    if self.cache.add(self.make_fill_key(key), token, self.LOCK_TIMEOUT):
+                        fills[key] = self.make_fill_key(key)
+            loaded = getattr(instance, name).aggregate(*[a.aggregate for a in missing.values()])
+            for key, a in missing.items():
+                value = loaded[a.alias]
+                if value is None and a.kind == 'Sum':
+                    value = 0
+                values[key] = value
+            if fills:
+                for key in fills:
+                    self.cache.add(key, self.DNE if values[key] is None else values[key], self.timeout)
+                # a change that found the key missing while we read the
+                # database deleted the mark, and may be in neither the values
+                # read nor the cache
+                marks = self.cache.get_many(fills.values())
+                for key, fill_key in fills.items():
+                    if marks.get(fill_key) != token:
+                        self.cache.delete(key)
+                self.cache.delete_many([fill_key for fill_key in fills.values() if marks.get(fill_key) == token])
+        return dict((a.alias, values[key]) for key, a in keys.items())
+
+    def _missed_counters(self, keys):
+        """ Tells fills of the counters under ``keys``, which a change found
+            missing, that they may have read the database too early.
+        """
+        self.cache.delete_many([self.make_fill_key(key) for key in keys])
+
+    def _drop_aggregates(self, keys):
+        if keys:
+            self._cache_delete_many(keys + [self.make_fill_key(key) for key in keys])
+
+    def _update_aggregates(self, name, pks, added=(), removed=()):
+        """ Updates the aggregates of the relation ``name`` of every pk in
+            ``pks`` for the objects in ``added`` joining it and the ones in
+            ``removed`` leaving it. Both are lists of the objects' aggregated
+            values; if either is None, the aggregates are dropped.
+        """
+        aggregates = self._aggregates.get(name)
+        pks = [pk for pk in pks if pk is not None]
+        if not aggregates or not pks:
+            return
+        if added is None or removed is None:
+            self._drop_aggregates([key for pk in pks for key in self._aggregate_keys(pk, name)])
+            return
+
+        extremes = [a for a in aggregates if a.kind in ('Min', 'Max')]
+        current = {}
+        if extremes and (added or removed):
+            current = self._read_aggregates([self.make_aggregate_key(pk, name, a.alias)
+                                             for pk in pks for a in extremes])
+
+        dropped = []
+        missed = []
+        for a in aggregates:
+            if a in extremes:
+                if not (added or removed):
+                    continue
+                for pk in pks:
+                    key = self.make_aggregate_key(pk, name, a.alias)
+                    if key not in current or not a.holds(current[key], added, removed):
+                        dropped.append(key)
+                continue
+            delta = a.delta(added, removed)
+            if not delta:
+                continue
+            for pk in pks:
+                key = self.make_aggregate_key(pk, name, a.alias)
+                if not a.counter:
+                    dropped.append(key)
+                elif not self._cache_incr(key, delta):
+                    missed.append(key)
+        self._drop_aggregates(dropped)
+        if missed:
+            self._missed_counters(missed)
+
+    ###
+    ### Bulk operations. QuerySet.update() and friends don't send signals, so
+    ### CachingQuerySet works out which rows they touch and drops the lists
+    ### holding them.
+    ###
+
+    def bulk_keys(self, model, rows, m2m=True):
+        """ Returns the keys of the related lists, and their aggregates,
+            holding the rows of ``model`` described by ``rows``, a list of
+            dicts of each row's pk and foreign key values. Lists of many to
+            many relations are only included with ``m2m``, and cost a query on
+            the through table per relation.
+        """
+        keys = set()
+        for relation in self.relations:
+            if relation.model is not model:
+                continue
+            name = relation.get_accessor_name()
+            if isinstance(relation.field, models.ManyToManyField):
+                if not m2m:
+                    continue
+                field = relation.field
+                parents = self._m2m_parents(field, field.m2m_field_name(), field.m2m_reverse_field_name(), rows)
+            else:
+                parents = [row[relation.field.attname] for row in rows]
+            for pk in parents:
+                if pk is not None:
+                    keys.update(self._relation_keys(pk, name))
+
+        for relation in self.m2m_relations:
+            if relation.parent_model is not model or not m2m:
+                continue
+            field = relation.field
+            parents = self._m2m_parents(field, field.m2m_reverse_field_name(), field.m2m_field_name(), rows)
+            for pk in parents:
+                keys.update(self._relation_keys(pk, field.name))
+        return keys
+
+    def _m2m_parents(self, field, source, target, rows):
+        """ Returns the pks the rows are related to through ``field``.
+        """
+        filters = {source + '__in': [row['pk'] for row in rows]}
+        through = field.rel.through._default_manager.filter(**filters)
+        return set(through.values_list(target, flat=True))
+
     def _setup_relation(self, relation):
         """ Given a relation to this model, hooks up cache invalidation functions
         """
@@ -178,30 +1125,22 @@ class RelatedCacheController(CacheController):
         f = curry(self.related_post_delete_invalidate, relation)
         models.signals.post_delete.connect(f, sender=relation.model, weak=False)
 
-    def _invalidate_delete(self, relation, pk, instance_pk):
-        key = ':'.join((self.make_key(pk), relation.get_accessor_name()))
+        self._setup_aggregates(relation, relation.get_accessor_name(), relation.model)
+
+    def _invalidate_delete(self, relation, pk, instance):
+        name = relation.get_accessor_name()
+        key = self.make_related_key(pk, name)
 
         if isinstance(relation.field, models.OneToOneField):
-            self.cache.set(key, self.DNE, self.timeout)
+            self._cache_set(key, self.DNE)
             return
 
-        objects = self.cache.get(key)
-        if objects is None:
-            filters = {relation.field.name: pk}
-            objects = relation.model.objects.filter(**filters)
-            self.cache.set(key, list(objects), self.timeout)
+        filters = {relation.field.name: pk}
+        load = lambda: relation.model.objects.filter(**filters)
+        self._update_objects(key, relation.model, Change(remove=[instance.pk]), load)
+        self._update_aggregates(name, [pk], removed=self._previous(name, instance))
 
-        else:
-            try:
-                # try to remove the object in the cache list
-                pks = [o.pk for o in objects]
-                index = pks.index(instance_pk)
-                del objects[index]
-            except ValueError:
-                pass
-            self.cache.set(key, objects, self.timeout)
-
-    def _invalidate(self, relation, instance):
+    def _invalidate(self, relation, instance, created=False):
         field_name = relation.field.name + '_id'
         pk_cache_name = FieldCachingDescriptor.cachename(field_name)
         pk = getattr(instance, field_name)
@@ -213,55 +1152,48 @@ class RelatedCacheController(CacheController):
                 # that an object has been created, and we don't have to worry
                 # about removing it from an existing cache key. Unfortunately,
                 # nullable fields don't give us that option.
-                self._invalidate_delete(relation, pk_cache, instance.pk)
-
-        key = ':'.join((self.make_key(pk), relation.get_accessor_name()))
+                self._invalidate_delete(relation, pk_cache, instance)
 
-        objects = self.cache.get(key)
+        name = relation.get_accessor_name()
+        key = self.make_related_key(pk, name)
 
-        if objects is None:
-            if isinstance(relation.field, models.OneToOneField):
+        if isinstance(relation.field, models.OneToOneField):
+            if self._cache_get(key) is None:
                 filters = {relation.field.name: pk}
                 try:
                     obj = relation.model.objects.get(**filters)
                 except relation.model.DoesNotExist:
-                    self.cache.set(key, self.DNE, self.timeout)
+                    self._cache_set(key, self.DNE)
                     raise
 
-                self.cache.set(key, obj, self.timeout)
+                self._cache_set(key, obj)
             else:
-                filters = {relation.field.name: pk}
-                objects = relation.model.objects.filter(**filters)
-                self.cache.set(key, list(objects), self.timeout)
+                self._cache_set(key, instance)
+
         else:
-            if isinstance(relation.field, models.OneToOneField):
-                self.cache.set(key, instance, self.timeout)
+            filters = {relation.field.name: pk}
+            load = lambda: relation.model.objects.filter(**filters)
+            # replace the object in the cache list, or add it
+            update = Change(upsert=[instance], ordering=relation.model._meta.ordering)
+            self._update_objects(key, relation.model, update, load)
 
-            else:
-                try:
-                    # try to replace the object in the cache list
-                    pks = [o.pk for o in objects]
-                    index = pks.index(instance.pk)
-                    objects[index] = instance
-                except ValueError:
-                    # the object isn't in the list; add it
-                    objects.append(instance)
-                if relation.model._meta.ordering:
-                    _sort(objects, relation.model._meta.ordering)
-
-                self.cache.set(key, objects, self.timeout)
+            if name in self._aggregates:
+                # a new member of the list, or a change to one of its members
+                removed = [] if created or pk != pk_cache else self._previous(name, instance)
+                self._update_aggregates(name, [pk], [self._aggregated(name, instance)], removed)
+                self._remember_aggregated(name, instance)
 
         # update the cached relation value so another .save() won't try
         # to do cache invalidations again
         setattr(instance, pk_cache_name, pk)
 
-    def related_post_save_invalidate(self, relation, instance, **kwargs):
-        self._invalidate(relation, instance)
+    def related_post_save_invalidate(self, relation, instance, created=False, **kwargs):
+        self._invalidate(relation, instance, created)
 
     def related_post_delete_invalidate(self, relation, instance, **kwargs):
         field_name = relation.field.name + '_id'
         pk = getattr(instance, field_name)
-        self._invalidate_delete(relation, pk, instance.pk)
+        self._invalidate_delete(relation, pk, instance)
 
 
     ###
@@ -274,8 +1206,10 @@ class RelatedCacheController(CacheController):
 
         if field.model is self.model:
             self.m2m_relations.append(field.related)
+            self._setup_aggregates(field.related, field.name, field.related.parent_model)
         else:
             self.relations.append(field.related)
+            self._setup_aggregates(field.related, field.related.get_accessor_name(), field.model)
 
         f = curry(self.post_m2m_invalidate, field.related)
         models.signals.m2m_changed.connect(f, sender=field.rel.through, weak=False)
@@ -289,6 +1223,10 @@ class RelatedCacheController(CacheController):
         """ Signal handler for django.db.models.signals.m2m_changed
         """
 
+        if action in ('pre_clear', 'post_clear'):
+            self._m2m_clear(relation, instance, action, reverse)
+            return
+
         funcs = {
             'post_add': {
                 True: self._m2m_add_local,
@@ -316,84 +1254,78 @@ class RelatedCacheController(CacheController):
 
         f(relation, instance, pk_set, accessor_name, attribute_name)
 
+    def _m2m_clear(self, relation, instance, action, reverse):
+        """ Drops the lists changed by a RelatedManager.clear(). The signal
+            doesn't say which objects are removed, so when they hold lists of
+            our own, their pks are read before the clear.
+        """
+        # name is the manager that was cleared, other_name the opposite end
+        name, other_name = relation.field.name, relation.get_accessor_name()
+        if reverse:
+            name, other_name = other_name, name
+        cleared = '_autocache_cleared_' + name
+        local = self.model is instance.__class__
+
+        if action == 'pre_clear':
+            if not local:
+                setattr(instance, cleared, list(getattr(instance, name).values_list('pk', flat=True)))
+            return
+
+        with batching.batch():
+            if local:
+                for key in self._relation_keys(instance.pk, name):
+                    self._cache_delete(key)
+            else:
+                for pk in getattr(instance, cleared, ()):
+                    for key in self._relation_keys(pk, other_name):
+                        self._cache_delete(key)
+
     def _m2m_add_local(self, relation, instance, pk_set, attribute_name, accessor_name):
         """ add the model instances matching pk_set to instance's cache set """
-        key = ':'.join((self.make_key(instance.pk), attribute_name))
-        objects = self.cache.get(key)
-        if objects is None:
-            objects = getattr(instance, attribute_name).all()
-            self.cache.set(key, list(objects), self.timeout)
-        else:
-            pks = [o.pk for o in objects]
-            instances = relation.parent_model._default_manager.filter(pk__in=pk_set)
-            for instance in instances:
-                if instance.pk not in pks:
-                    objects.append(instance)
-            if relation.parent_model._meta.ordering:
-                _sort(objects, relation.parent_model._meta.ordering)
-            self.cache.set(key, objects, self.timeout)
+        key = self.make_related_key(instance.pk, attribute_name)
+        related_manager = getattr(instance, attribute_name)
+        model = related_manager.model
+
+        instances = lambda: model._default_manager.filter(pk__in=pk_set)
+        update = Change(upsert=instances, ordering=model._meta.ordering)
+        self._update_objects(key, model, update, related_manager.all)
+
+        if attribute_name in self._aggregates:
+            added = self._aggregated_rows(attribute_name, model, pk_set)
+            self._update_aggregates(attribute_name, [instance.pk], added)
 
     def _m2m_add_remote(self, relation, instance, pk_set, attribute_name, accessor_name):
-        """add instance to the cache set for each object in pk_set """
+        """ add instance to the cache set for each object in pk_set """
         model = instance.__class__
+        update = Change(upsert=[instance], ordering=model._meta.ordering)
+        self._update_lists(attribute_name, model, pk_set, update)
 
-        for pk in pk_set:
-            key = ':'.join((self.make_key(pk), accessor_name))
-            objects = self.cache.get(key)
-            if objects is None:
-                filters = {accessor_name: pk}
-                objects = model._default_manager.filter(**filters)
-                self.cache.set(key, list(objects), self.timeout)
-            else:
-                pks = [o.pk for o in objects]
-                if pk not in pks:
-                    objects.append(instance)
-                if model._meta.ordering:
-                    _sort(objects, model._meta.ordering)
-                self.cache.set(key, objects, self.timeout)
+        if attribute_name in self._aggregates:
+            added = self._previous(attribute_name, instance) or [self._aggregated(attribute_name, instance)]
+            self._update_aggregates(attribute_name, pk_set, added)
 
 
     def _m2m_remove_local(self, relation, instance, pk_set, attribute_name, accessor_name):
         """ remove the model instances matching pk_set from instance's cache set """
-        key = ':'.join((self.make_key(instance.pk), attribute_name))
-        objects = self.cache.get(key)
-        if objects is None:
-            objects = getattr(instance, attribute_name).all()
-            self.cache.set(key, list(objects), self.timeout)
-        else:
-            pks = [o.pk for o in objects]
-            for pk in pk_set:
-                try:
-                    index = pks.index(pk)
-                    del objects[index]
-                    del pks[index]
-                except ValueError:
-                    pass
-            self.cache.set(key, objects, self.timeout)
+        key = self.make_related_key(instance.pk, attribute_name)
+        related_manager = getattr(instance, attribute_name)
+        model = related_manager.model
+        self._update_objects(key, model, Change(remove=pk_set), related_manager.all)
 
-    def _m2m_remove_remote(self, relation, instance, pk_set, attribute_name, accessor_name):
-        """remove instance from the cache set for each object in pk_set """
-        model = instance.__class__
+        if attribute_name in self._aggregates:
+            removed = self._aggregated_rows(attribute_name, model, pk_set)
+            self._update_aggregates(attribute_name, [instance.pk], removed=removed)
 
-        for pk in pk_set:
-            key = ':'.join((self.make_key(pk), accessor_name))
-            objects = self.cache.get(key)
-            if objects is None:
-                filters = {accessor_name: pk}
-                objects = model._default_manager.filter(**filters)
-                self.cache.set(key, list(objects), self.timeout)
-            else:
-                pks = [o.pk for o in objects]
-                for pk in pk_set:
-                    try:
-                        index = pks.index(pk)
-                        del objects[index]
-                        del pks[index]
-                    except ValueError:
-                        pass
-                self.cache.set(key, objects, self.timeout)
+    def _m2m_remove_remote(self, relation, instance, pk_set, attribute_name, accessor_name):
+        """ remove instance from the cache set for each object in pk_set """
+        self._update_lists(attribute_name, instance.__class__, pk_set, Change(remove=[instance.pk]))
+        self._update_aggregates(attribute_name, pk_set, removed=self._previous(attribute_name, instance))
 
     def m2m_post_save_invalidate(self, relation, instance, **kwargs):
+        """ Updates the saved instance in the lists of every object it is
+            related to through ``relation``: cached lists are updated in
+            place, and missing ones are loaded with one grouped query.
+        """
         assert self.model is not instance.__class__
 
         reverse = instance.__class__ is relation.parent_model
@@ -405,14 +1337,29 @@ class RelatedCacheController(CacheController):
             accessor_name, field_name = field_name, accessor_name
             model = relation.model
 
-        related_objects = getattr(instance, accessor_name).all()
+        pks = list(getattr(instance, accessor_name).values_list('pk', flat=True))
+        update = Change(upsert=[instance], ordering=model._meta.ordering)
+        self._update_lists(field_name, model, pks, update)
 
+        if field_name in self._aggregates:
+            added = [self._aggregated(field_name, instance)]
+            self._update_aggregates(field_name, pks, added, self._previous(field_name, instance))
+            self._remember_aggregated(field_name, instance)
 
-        for object in related_objects:
-            key = ':'.join((self.make_key(object.pk), field_name))
-            objects = self.cache.get(key)
-            objects = None
-            if objects is None:
-                filters = {accessor_name: object.pk}
-                objects = model._default_manager.filter(**filters)
-                self.cache.set(key, list(objects), self.timeout)
+    def _update_lists(self, name, model, pks, update):
+        """ Applies ``update`` to the lists of relation ``name`` of every pk in
+            ``pks`` atomically, with ``_update_many``. The lists that aren't
+            cached are loaded together with one grouped query.
+        """
+        keys = dict((self.make_related_key(pk, name), pk) for pk in pks)
+        if not keys:
+            return
+
+        def load(pk):
+            return self.load_related(name, [pk])[pk]
+
+        def load_many(missing):
+            loaded = self.load_related(name, [keys[key] for key in missing])
+            return dict((key, loaded[keys[key]]) for key in missing)
+
+        self._update_many([(key, model, update, curry(load, pk)) for key, pk in keys.items()], load_many)
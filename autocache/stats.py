@@ -0,0 +1,195 @@
+"""
+.. module:stats
+   :platform: Django
+   :synopsis: Collects hit, miss and latency statistics from the cache controllers.
+
+Controllers report to a collector: counters through ``incr``, durations
+through ``timing``, and database fallbacks through ``fill``. Each report is
+keyed by the model, the relation (None for instances) and the cache backend
+alias. ``MemoryStats`` keeps everything in process memory and is used by
+default; subclass ``StatsCollector`` to export the numbers elsewhere, the way
+``StatsdCollector`` does.
+
+Counters: ``hit``, ``miss``, ``dne`` (a cached DoesNotExist marker was
+found) and ``fill`` (objects loaded from the database). Timings: ``cache_get``,
+``cache_get_many``, ``cache_set`` and ``db``, in seconds.
+"""
+import bisect
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger('autocache')
+
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+class StatsCollector(object):
+    """ Receives statistics from the controllers and throws them away.
+
+        Fills that take at least ``slow_fill_threshold`` seconds are passed
+        to ``slow_fill``, which logs a warning; None disables the check.
+    """
+
+    def __init__(self, slow_fill_threshold=0.1):
+        self.slow_fill_threshold = slow_fill_threshold
+
+    def incr(self, name, model, relation=None, backend=None, count=1):
+        pass
+
+    def timing(self, name, seconds, model, relation=None, backend=None):
+        pass
+
+    def fill(self, key, seconds, model, relation=None, backend=None, count=1):
+        """ Records ``count`` objects loaded from the database for ``key``, or
+            for every key in the list ``key`` when they were loaded together.
+        """
+        self.incr('fill', model, relation, backend, count)
+        self.timing('db', seconds, model, relation, backend)
+        if self.slow_fill_threshold is not None and seconds >= self.slow_fill_threshold:
+            self.slow_fill(key, seconds, model, relation, backend, count)
+
+    def slow_fill(self, key, seconds, model, relation=None, backend=None, count=1):
+        if isinstance(key, list):
+            key = '%d keys of %s' % (len(key), model_label(model))
+        logger.warning("autocache: filling %s (%d objects) took %.3fs", key, count, seconds)
+
+    def stats(self, model=None, relation=None, backend=None):
+        """ Returns the statistics kept by the collector; none by default.
+        """
+        return {}
+
+
+class Histogram(object):
+    """ Counts durations in fixed buckets, along with their sum and maximum.
+    """
+    # upper bounds of the buckets, in seconds; the last bucket is unbounded
+    BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'buckets': list(zip(self.BOUNDS + (None,), self.buckets)),
+        }
+
+
+class MemoryStats(StatsCollector):
+    """ Keeps counters, latency histograms and the most recent ``slow_log``
+        slow fills in memory.
+    """
+
+    def __init__(self, slow_fill_threshold=0.1, slow_log=100):
+        super(MemoryStats, self).__init__(slow_fill_threshold)
+        self.slow_log = slow_log
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.slow_fills = deque(maxlen=self.slow_log)
+
+    def incr(self, name, model, relation=None, backend=None, count=1):
+        key = (name, model_label(model), relation, backend)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + count
+
+    def timing(self, name, seconds, model, relation=None, backend=None):
+        key = (name, model_label(model), relation, backend)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.add(seconds)
+
+    def slow_fill(self, key, seconds, model, relation=None, backend=None, count=1):
+        super(MemoryStats, self).slow_fill(key, seconds, model, relation, backend, count)
+        with self._lock:
+            self.slow_fills.append({
+                'key': key,
+                'seconds': seconds,
+                'model': model_label(model),
+                'relation': relation,
+                'backend': backend,
+                'count': count,
+            })
+
+    def stats(self, model=None, relation=None, backend=None):
+        """ Returns the counters and timings matching the given model (a class
+            or an 'app_label.ModelName' label), relation and backend, summed
+            over whatever isn't given. Counters map to numbers, timings to a
+            dict of their count, sum, max and buckets.
+        """
+        if hasattr(model, '_meta'):
+            model = model_label(model)
+
+        def matches(key):
+            return ((model is None or key[1] == model) and
+                    (relation is None or key[2] == relation) and
+                    (backend is None or key[3] == backend))
+
+        result = {}
+        timings = {}
+        with self._lock:
+            for key, count in self.counters.items():
+                if matches(key):
+                    result[key[0]] = result.get(key[0], 0) + count
+            for key, histogram in self.histograms.items():
+                if matches(key):
+                    timings.setdefault(key[0], Histogram()).merge(histogram)
+        for name, histogram in timings.items():
+            result[name] = histogram.as_dict()
+        return result
+
+
+class StatsdCollector(StatsCollector):
+    """ Forwards statistics to a statsd client, or anything else with
+        ``incr(name, count)`` and ``timing(name, milliseconds)`` methods.
+
+        Metrics are named ``prefix.app_label.ModelName[.relation].name``; the
+        backend alias isn't part of the name.
+    """
+
+    def __init__(self, client, prefix='autocache', slow_fill_threshold=0.1):
+        super(StatsdCollector, self).__init__(slow_fill_threshold)
+        self.client = client
+        self.prefix = prefix
+
+    def metric(self, name, model, relation=None):
+        parts = [self.prefix, model_label(model)]
+        if relation is not None:
+            parts.append(relation)
+        parts.append(name)
+        return '.'.join(parts)
+
+    def incr(self, name, model, relation=None, backend=None, count=1):
+        self.client.incr(self.metric(name, model, relation), count)
+
+    def timing(self, name, seconds, model, relation=None, backend=None):
+        self.client.timing(self.metric(name, model, relation), seconds * 1000)
+
+
+default_collector = MemoryStats()
@@ -0,0 +1,195 @@
+import socket
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from . import memcached
+
+
+class LatencyCache(LocMemCache):
+    """ A local memory cache that sleeps for ``LATENCY`` seconds on every
+        call, to stand in for the round trip to a memcached server. Bulk
+        calls pay for a single round trip.
+    """
+
+    def __init__(self, name, params):
+        super(LatencyCache, self).__init__(name, params)
+        self.latency = float(params.get('LATENCY', 0.0005))
+        self.round_trips = 0
+
+    def _round_trip(self):
+        self.round_trips += 1
+        time.sleep(self.latency)
+
+    def add(self, *args, **kwargs):
+        self._round_trip()
+        return super(LatencyCache, self).add(*args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        self._round_trip()
+        return super(LatencyCache, self).get(*args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        self._round_trip()
+        return super(LatencyCache, self).set(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        self._round_trip()
+        return super(LatencyCache, self).delete(*args, **kwargs)
+
+    def incr(self, key, delta=1, version=None):
+        self._round_trip()
+        value = LocMemCache.get(self, key, version=version)
+        if value is None:
+            raise ValueError("Key '%s' not found" % key)
+        LocMemCache.set(self, key, value + delta, version=version)
+        return value + delta
+
+    def get_many(self, keys, version=None):
+        self._round_trip()
+        found = {}
+        for key in keys:
+            value = LocMemCache.get(self, key, version=version)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set_many(self, data, timeout=None, version=None):
+        self._round_trip()
+        for key, value in data.items():
+            LocMemCache.set(self, key, value, timeout, version=version)
+
+    def delete_many(self, keys, version=None):
+        self._round_trip()
+        for key in keys:
+            LocMemCache.delete(self, key, version=version)
+
+
+class ProtocolCache(BaseCache):
+    """ A cache backend speaking the memcached text protocol over a socket,
+        with no client library needed. A ``LOCATION`` of 'inprocess' starts
+        the stand-in server from ``test_project.benchmarks.memcached``;
+        otherwise it is the 'host:port' of a memcached server. Like
+        LatencyCache, every round trip sleeps for ``LATENCY`` seconds, and
+        bulk calls are pipelined into a single round trip.
+    """
+
+    def __init__(self, location, params):
+        super(ProtocolCache, self).__init__(params)
+        if location == 'inprocess':
+            location = memcached.start()
+        host, port = location.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.latency = float(params.get('LATENCY', 0))
+        self.round_trips = 0
+        self._local = threading.local()
+
+    def _file(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection(self.address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self._local.conn = (sock, sock.makefile('rb'))
+        return conn
+
+    def _send(self, payload):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+        sock, f = self._file()
+        sock.sendall(payload)
+        return f
+
+    def _line(self, f):
+        return f.readline().rstrip(b'\r\n').decode('ascii')
+
+    def _timeout(self, timeout):
+        return int(timeout or self.default_timeout)
+
+    def _encode(self, value):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return 0, str(value).encode('ascii')
+        return 1, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, flags, data):
+        if flags == 0:
+            return int(data)
+        return pickle.loads(data)
+
+    def _store(self, command, key, value, timeout, noreply=False):
+        flags, data = self._encode(value)
+        line = '%s %s %d %d %d%s\r\n' % (command, key, flags, self._timeout(timeout), len(data),
+                                         ' noreply' if noreply else '')
+        return line.encode('ascii') + data + b'\r\n'
+
+    def add(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version=version)
+        f = self._send(self._store('add', key, value, timeout))
+        return self._line(f) == 'STORED'
+
+    def get(self, key, default=None, version=None):
+        raw_key = self.make_key(key, version=version)
+        return self._get_many([raw_key]).get(raw_key, default)
+
+    def _get_many(self, keys):
+        f = self._send(('get %s\r\n' % ' '.join(keys)).encode('ascii'))
+        found = {}
+        while True:
+            line = self._line(f)
+            if line == 'END':
+                return found
+            _, key, flags, length = line.split()
+            data = f.read(int(length) + 2)[:-2]
+            found[key] = self._decode(int(flags), data)
+
+    def get_many(self, keys, version=None):
+        if not keys:
+            return {}
+        raw_keys = dict((self.make_key(key, version=version), key) for key in keys)
+        found = self._get_many(list(raw_keys))
+        return dict((raw_keys[key], value) for key, value in found.items())
+
+    def set(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version=version)
+        self._line(self._send(self._store('set', key, value, timeout)))
+
+    def set_many(self, data, timeout=None, version=None):
+        if not data:
+            return
+        payload = [self._store('set', self.make_key(key, version=version), value, timeout, noreply=True)
+                   for key, value in data.items()]
+        # a final reply tells us the pipeline has been processed
+        f = self._send(b''.join(payload) + b'delete autocache:sync\r\n')
+        self._line(f)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self._line(self._send(('delete %s\r\n' % key).encode('ascii')))
+
+    def delete_many(self, keys, version=None):
+        if not keys:
+            return
+        payload = ''.join('delete %s noreply\r\n' % self.make_key(key, version=version) for key in keys)
+        f = self._send((payload + 'delete autocache:sync\r\n').encode('ascii'))
+        self._line(f)
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        command = 'incr' if delta >= 0 else 'decr'
+        result = self._line(self._send(('%s %s %d\r\n' % (command, key, abs(delta))).encode('ascii')))
+        if result == 'NOT_FOUND':
+            raise ValueError("Key '%s' not found" % key)
+        return int(result)
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version=version)
+
+    def clear(self):
+        self._line(self._send(b'flush_all\r\n'))
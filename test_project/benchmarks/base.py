@@ -0,0 +1,48 @@
+import json
+import platform
+import subprocess
+import sys
+import time
+
+
+def setup():
+    """ Creates the benchmark database tables.
+    """
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+
+
+def timed(func, *args, **kwargs):
+    """ Returns the result of calling ``func`` and the seconds it took.
+    """
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def environment():
+    """ Describes what the benchmarks ran on, so results can be told apart.
+    """
+    import django
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'time': time.time(),
+    }
+
+
+def report(name, results, output=None):
+    """ Writes benchmark results as JSON, to ``output`` or stdout.
+    """
+    data = {'benchmark': name, 'environment': environment(), 'results': results}
+    data = json.dumps(data, indent=2, sort_keys=True)
+    if output is None:
+        sys.stdout.write(data + '\n')
+    else:
+        with open(output, 'w') as f:
+            f.write(data + '\n')
@@ -0,0 +1,60 @@
+"""
+Compares two benchmark result files, such as the output of the suite on two
+commits, and prints the relative change of every timing they share.
+
+    python -m test_project.benchmarks.compare before.json after.json [threshold]
+
+Timings that got slower by more than ``threshold`` (0.1, that is 10%, by
+default) are flagged, and the exit status is 1 if there are any.
+"""
+import json
+import sys
+
+
+def flatten(data, prefix=''):
+    """ Maps the dotted path of every number in nested dicts to the number.
+    """
+    values = {}
+    for key, value in data.items():
+        path = prefix + str(key)
+        if isinstance(value, dict):
+            values.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def compare(before, after, threshold=0.1):
+    """ Returns (path, before, after, change, regressed) for every seconds
+        per operation timing found in both results.
+    """
+    before = flatten(before['results'])
+    after = flatten(after['results'])
+    rows = []
+    for path in sorted(set(before) & set(after)):
+        if not path.endswith('seconds_per_op') or not before[path]:
+            continue
+        change = (after[path] - before[path]) / before[path]
+        rows.append((path, before[path], after[path], change, change > threshold))
+    return rows
+
+
+def main(argv):
+    if len(argv) < 3:
+        sys.stderr.write(__doc__)
+        return 2
+    with open(argv[1]) as f:
+        before = json.load(f)
+    with open(argv[2]) as f:
+        after = json.load(f)
+    threshold = float(argv[3]) if len(argv) > 3 else 0.1
+
+    rows = compare(before, after, threshold)
+    for path, old, new, change, regressed in rows:
+        flag = '  REGRESSION' if regressed else ''
+        sys.stdout.write('%-60s %12.6f %12.6f %+8.1f%%%s\n' % (path, old, new, change * 100, flag))
+    return 1 if any(row[4] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,93 @@
+"""
+Stress test for concurrent updates of one related list.
+
+Several threads append to the cached ``book_set`` of a single person at
+once, through a backend with artificial latency. Each thread first records
+the book in a stand-in for the database, which is also what a miss reloads
+from. The naive read-modify-write loses updates;
+RelatedCacheController._update_objects shouldn't lose any.
+
+    DJANGO_SETTINGS_MODULE=test_project.benchmarks.settings \
+        python -m test_project.benchmarks.concurrency [threads] [updates]
+"""
+import sys
+import threading
+
+from django.core.cache import get_cache
+
+from test_project.sample_app.models import Person, Book
+from .base import report, setup, timed
+
+
+def naive_append(controller, key, book, load):
+    objects = controller._get_objects(key, Book)
+    if objects is None:
+        objects = load()
+    else:
+        objects.append(book)
+    controller._set_objects(key, Book, objects)
+
+
+def atomic_append(controller, key, book, load):
+    def update(objects):
+        objects.append(book)
+        return objects
+    controller._update_objects(key, Book, update, load)
+
+
+def run(append, threads, updates):
+    controller = Person.cache
+    key = controller.make_related_key(1, 'book_set')
+    controller._set_objects(key, Book, [])
+
+    database = []
+    lock = threading.Lock()
+
+    def load():
+        with lock:
+            return list(database)
+
+    def work(offset):
+        for i in range(updates):
+            pk = offset * updates + i + 1
+            book = Book(pk=pk, author_id=1, rank=0, title='Book %s' % pk)
+            with lock:
+                database.append(book)
+            append(controller, key, book, load)
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+
+    def start():
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    result, elapsed = timed(start)
+    objects = controller._get_objects(key, Book)
+    if objects is None:
+        # the key was dropped after too many conflicts; a read reloads it
+        objects = load()
+    lost = set(b.pk for b in database) - set(b.pk for b in objects)
+    return {
+        'updates': threads * updates,
+        'lost': len(lost),
+        'seconds': elapsed,
+    }
+
+
+def main(argv):
+    threads = int(argv[1]) if len(argv) > 1 else 8
+    updates = int(argv[2]) if len(argv) > 2 else 25
+
+    setup()
+    Person.cache.cache = get_cache('latency')
+    results = {
+        'naive': run(naive_append, threads, updates),
+        'atomic': run(atomic_append, threads, updates),
+    }
+    report('concurrency', results)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
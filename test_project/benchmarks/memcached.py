@@ -0,0 +1,168 @@
+"""
+A small in-process server speaking the memcached text protocol, so that the
+benchmarks can exercise a real socket round trip without a memcached
+install. It supports get, gets, set, add, cas, delete, incr, decr and
+flush_all; values expire like they do in memcached.
+"""
+import atexit
+import socket
+import threading
+import time
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+# relative expiry times larger than this are unix timestamps
+MAX_RELATIVE = 60 * 60 * 24 * 30
+
+
+class Store(object):
+
+    def __init__(self):
+        self.items = {}
+        self.cas_counter = 0
+        self.lock = threading.Lock()
+
+    def _expires(self, exptime):
+        if exptime == 0:
+            return None
+        if exptime > MAX_RELATIVE:
+            return exptime
+        return time.time() + exptime
+
+    def _get(self, key):
+        item = self.items.get(key)
+        if item is not None and item[2] is not None and item[2] <= time.time():
+            del self.items[key]
+            return None
+        return item
+
+    def _set(self, key, flags, exptime, data):
+        self.cas_counter += 1
+        self.items[key] = (flags, data, self._expires(exptime), self.cas_counter)
+
+    def get(self, keys):
+        with self.lock:
+            return [(key, self._get(key)) for key in keys]
+
+    def store(self, command, key, flags, exptime, data, cas=None):
+        with self.lock:
+            item = self._get(key)
+            if command == 'add' and item is not None:
+                return 'NOT_STORED'
+            if command == 'cas':
+                if item is None:
+                    return 'NOT_FOUND'
+                if item[3] != cas:
+                    return 'EXISTS'
+            self._set(key, flags, exptime, data)
+            return 'STORED'
+
+    def delete(self, key):
+        with self.lock:
+            if self._get(key) is None:
+                return 'NOT_FOUND'
+            del self.items[key]
+            return 'DELETED'
+
+    def incr(self, key, delta):
+        with self.lock:
+            item = self._get(key)
+            if item is None:
+                return 'NOT_FOUND'
+            flags, data, expires, _ = item
+            value = max(0, int(data) + delta)
+            self.cas_counter += 1
+            self.items[key] = (flags, str(value).encode('ascii'), expires, self.cas_counter)
+            return str(value)
+
+    def flush(self):
+        with self.lock:
+            self.items.clear()
+            return 'OK'
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode('ascii').split()
+            if not parts:
+                continue
+            command, args = parts[0], parts[1:]
+
+            if command in ('get', 'gets'):
+                chunks = []
+                for key, item in store.get(args):
+                    if item is None:
+                        continue
+                    flags, data, _, cas = item
+                    header = 'VALUE %s %d %d' % (key, flags, len(data))
+                    if command == 'gets':
+                        header += ' %d' % cas
+                    chunks.append(header.encode('ascii') + b'\r\n' + data + b'\r\n')
+                chunks.append(b'END\r\n')
+                self.wfile.write(b''.join(chunks))
+                continue
+            elif command in ('set', 'add', 'cas'):
+                key, flags, exptime, length = args[0], int(args[1]), int(args[2]), int(args[3])
+                cas = int(args[4]) if command == 'cas' else None
+                data = self.rfile.read(length + 2)[:-2]
+                result = store.store(command, key, flags, exptime, data, cas)
+            elif command == 'delete':
+                result = store.delete(args[0])
+            elif command in ('incr', 'decr'):
+                delta = int(args[1])
+                result = store.incr(args[0], delta if command == 'incr' else -delta)
+            elif command == 'flush_all':
+                result = store.flush()
+            else:
+                result = 'ERROR'
+            if args[-1:] != ['noreply']:
+                self.reply(result)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        socketserver.TCPServer.__init__(self, address, Handler)
+        self.store = Store()
+
+    def handle_error(self, request, client_address):
+        # clients going away, mostly at interpreter shutdown
+        pass
+
+
+_server = None
+_lock = threading.Lock()
+
+
+def start():
+    """ Starts the shared server on a free port, once, and returns its
+        address as 'host:port'.
+    """
+    global _server
+    with _lock:
+        if _server is None:
+            _server = Server()
+            thread = threading.Thread(target=_server.serve_forever, name='memcached-stand-in')
+            thread.daemon = True
+            thread.start()
+            # Python 2 can crash tearing down daemon threads still serving
+            atexit.register(_server.shutdown)
+        return '%s:%d' % _server.server_address
@@ -0,0 +1,101 @@
+"""
+Compares the ways a cached related list can be kept in order when one of its
+objects is saved: the original approach, which finds the object with
+``list.index`` and then re-sorts the list one ``Meta.ordering`` field at a
+time, and ``Change``, which bisects the object into place on a composite
+sort key. Runs in memory; no database or cache is used.
+
+    DJANGO_SETTINGS_MODULE=test_project.benchmarks.settings \\
+        python -m test_project.benchmarks.ordering [sizes] [saves]
+"""
+import random
+import sys
+from operator import attrgetter
+
+from autocache.related_controller import Change
+from test_project.sample_app.models import Book
+from .base import report, timed
+
+SIZES = (100, 1000, 10000, 100000)
+
+
+def multi_pass_sort(objects, ordering):
+    for order_by in reversed(ordering):
+        reverse = False
+        if order_by[0] == '-':
+            order_by = order_by[1:]
+            reverse = True
+        objects.sort(key=attrgetter(order_by), reverse=reverse)
+
+
+def index_and_sort(objects, instance, ordering):
+    """ The update ``_invalidate`` used to make.
+    """
+    try:
+        pks = [o.pk for o in objects]
+        index = pks.index(instance.pk)
+        objects[index] = instance
+    except ValueError:
+        objects.append(instance)
+    multi_pass_sort(objects, ordering)
+    return objects
+
+
+def make_books(count):
+    books = [Book(pk=i, author_id=1, rank=random.randint(0, 100), title='Book %d' % i)
+             for i in range(count)]
+    multi_pass_sort(books, Book._meta.ordering)
+    return books
+
+
+def saves(books, count):
+    """ Copies of random books, half with a new title and half with a new
+        rank, as a view saving them would pass to the update.
+    """
+    saved = []
+    for i in range(count):
+        book = random.choice(books)
+        copy = Book(pk=book.pk, author_id=1, rank=book.rank, title=book.title)
+        if i % 2:
+            copy.rank = random.randint(0, 100)
+        else:
+            copy.title = book.title + '!'
+        saved.append(copy)
+    return saved
+
+
+def run(update, books, saved):
+    def apply():
+        objects = list(books)
+        for book in saved:
+            objects = update(objects, book)
+        return objects
+    return timed(apply)
+
+
+def main(argv):
+    sizes = [int(size) for size in argv[1].split(',')] if len(argv) > 1 else SIZES
+    count = int(argv[2]) if len(argv) > 2 else 20
+    ordering = Book._meta.ordering
+
+    random.seed(0)
+    results = {}
+    for size in sizes:
+        books = make_books(size)
+        saved = saves(books, count)
+
+        old, old_elapsed = run(lambda objects, book: index_and_sort(objects, book, ordering), books, saved)
+        new, new_elapsed = run(lambda objects, book: Change(upsert=[book], ordering=ordering)(objects),
+                               books, saved)
+        assert [(b.pk, b.rank, b.title) for b in old] == [(b.pk, b.rank, b.title) for b in new]
+
+        results[str(size)] = {
+            'index_and_sort': {'saves': count, 'seconds_per_op': old_elapsed / count},
+            'change': {'saves': count, 'seconds_per_op': new_elapsed / count},
+            'speedup': old_elapsed / new_elapsed if new_elapsed else None,
+        }
+    report('ordering', results)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,34 @@
+# Settings for running the benchmarks against local stand-in backends; no
+# memcached servers are needed.
+from test_project.settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': '/tmp/autocache_benchmarks.sqlite',
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'default',
+        'OPTIONS': {'MAX_ENTRIES': 10 ** 6},
+    },
+    'other': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'other',
+        'OPTIONS': {'MAX_ENTRIES': 10 ** 6},
+    },
+    'latency': {
+        'BACKEND': 'test_project.benchmarks.backends.LatencyCache',
+        'LOCATION': 'latency',
+        'LATENCY': 0.0005,
+        'OPTIONS': {'MAX_ENTRIES': 10 ** 6},
+    },
+    'memcached': {
+        'BACKEND': 'test_project.benchmarks.backends.ProtocolCache',
+        'LOCATION': 'inprocess',
+        'LATENCY': 0.0002,
+    },
+}
@@ -0,0 +1,281 @@
+"""
+Benchmark suite for the sample_app models.
+
+Measures instance reads, related list reads, reads of the first page of a
+related list, the cost of invalidating a related list when a child is saved
+as the list grows, many to many adds and removes, saves of an instance held
+in many to many lists, and CachingForeignKey resolution. Each benchmark runs
+against every backend named with --backends: 'default' is a local memory
+cache, 'latency' adds an artificial round trip to it, and 'memcached' talks
+the memcached protocol to an in-process stand-in server. Pass --chunk-size to
+store related lists in chunks.
+
+    DJANGO_SETTINGS_MODULE=test_project.benchmarks.settings \\
+        python -m test_project.benchmarks.suite --output results.json
+
+Compare two result files with ``test_project.benchmarks.compare``.
+"""
+import sys
+from optparse import OptionParser
+
+from django.core.cache import get_cache
+from django.db import connection, transaction
+
+from test_project.sample_app.models import Person, Book
+from .base import report, setup, timed
+
+BACKENDS = ('default', 'latency', 'memcached')
+SIZES = (10, 100, 1000, 10000)
+
+
+def use_backend(alias):
+    """ Points the sample_app controllers at the cache backend ``alias``.
+    """
+    backend = get_cache(alias)
+    backend.clear()
+    for controller in (Person.cache, Book.cache):
+        controller.cache = backend
+        controller._namespaces_expire = 0
+    return backend
+
+
+def truncate():
+    """ Empties the tables, and the caches, since the pks will be reused.
+    """
+    cursor = connection.cursor()
+    for model in (Book.editors.through, Book, Person):
+        cursor.execute('DELETE FROM %s' % model._meta.db_table)
+    transaction.commit_unless_managed()
+    for controller in (Person.cache, Book.cache):
+        controller.cache.clear()
+        controller._namespaces_expire = 0
+
+
+def create_people(count):
+    people = []
+    for i in range(count):
+        person = Person(name='Person %d' % i)
+        person.save()
+        people.append(person)
+    return people
+
+
+def create_books(author, count):
+    """ Inserts ``count`` books for ``author`` without going through save(),
+        so that large lists are quick to set up.
+    """
+    cursor = connection.cursor()
+    cursor.executemany(
+        'INSERT INTO %s (title, author_id, rank) VALUES (%%s, %%s, %%s)' % Book._meta.db_table,
+        [('Book %d' % i, author.pk, i % 100) for i in range(count)])
+    transaction.commit_unless_managed()
+
+
+def round_trips(backend):
+    return getattr(backend, 'round_trips', 0)
+
+
+def per_op(elapsed, count, backend, trips_before):
+    result = {
+        'operations': count,
+        'seconds': elapsed,
+        'seconds_per_op': elapsed / count,
+        'ops_per_second': count / elapsed if elapsed else None,
+    }
+    if hasattr(backend, 'round_trips'):
+        result['round_trips_per_op'] = (round_trips(backend) - trips_before) / float(count)
+    return result
+
+
+def bench_instance_get(backend, options):
+    person = create_people(1)[0]
+    Person.cache.get(person.pk)
+
+    count = options.iterations
+    trips = round_trips(backend)
+    _, elapsed = timed(lambda: [Person.cache.get(person.pk) for i in range(count)])
+    return per_op(elapsed, count, backend, trips)
+
+
+def bench_get_many(backend, options):
+    pks = [person.pk for person in create_people(100)]
+    Person.cache.get_many(pks)
+
+    count = max(1, options.iterations // 100)
+    trips = round_trips(backend)
+    _, elapsed = timed(lambda: [Person.cache.get_many(pks) for i in range(count)])
+    return per_op(elapsed, count, backend, trips)
+
+
+def bench_related_read(backend, options):
+    results = {}
+    for size in options.sizes:
+        truncate()
+        author = create_people(1)[0]
+        create_books(author, size)
+        author.cache.book_set
+
+        count = max(1, options.iterations // size)
+        trips = round_trips(backend)
+        _, elapsed = timed(lambda: [author.cache.book_set for i in range(count)])
+        results[str(size)] = per_op(elapsed, count, backend, trips)
+    return results
+
+
+def bench_related_page(backend, options):
+    """ Reads the first 20 objects of a related list, which only needs the
+        first chunk of a chunked list.
+    """
+    results = {}
+    for size in options.sizes:
+        truncate()
+        author = create_people(1)[0]
+        create_books(author, size)
+        author.cache.book_set
+
+        count = max(1, options.iterations // 20)
+        trips = round_trips(backend)
+        _, elapsed = timed(lambda: [author.cache.book_set[:20] for i in range(count)])
+        results[str(size)] = per_op(elapsed, count, backend, trips)
+    return results
+
+
+def bench_child_save(backend, options):
+    results = {}
+    for size in options.sizes:
+        truncate()
+        author = create_people(1)[0]
+        create_books(author, size)
+        author.cache.book_set
+        book = Book.objects.filter(author=author)[0]
+
+        count = options.saves
+
+        def save():
+            for i in range(count):
+                book.rank = (book.rank + 1) % 100
+                book.save()
+
+        trips = round_trips(backend)
+        _, elapsed = timed(save)
+        results[str(size)] = per_op(elapsed, count, backend, trips)
+    return results
+
+
+def bench_m2m(backend, options):
+    results = {}
+    for size in (10, 100):
+        truncate()
+        people = create_people(size)
+        book = Book(author=people[0], rank=1, title='Book')
+        book.save()
+        book.cache.editors
+        for person in people:
+            person.cache.edited
+
+        trips = round_trips(backend)
+        _, elapsed = timed(book.editors.add, *people)
+        results['add_%d' % size] = per_op(elapsed, size, backend, trips)
+
+        trips = round_trips(backend)
+        _, elapsed = timed(book.editors.remove, *people)
+        results['remove_%d' % size] = per_op(elapsed, size, backend, trips)
+    return results
+
+
+def bench_m2m_save(backend, options):
+    results = {}
+    for size in (10, 100):
+        truncate()
+        people = create_people(size)
+        book = Book(author=people[0], rank=1, title='Book')
+        book.save()
+        book.editors.add(*people)
+        for person in people:
+            person.cache.edited
+
+        count = options.saves
+
+        def save():
+            for i in range(count):
+                book.rank = (book.rank + 1) % 100
+                book.save()
+
+        trips = round_trips(backend)
+        _, elapsed = timed(save)
+        results[str(size)] = per_op(elapsed, count, backend, trips)
+    return results
+
+
+def bench_fk_descriptor(backend, options):
+    author = create_people(1)[0]
+    create_books(author, 100)
+    books = list(Book.objects.all())
+    Person.cache.get(author.pk)
+    cache_name = Book._meta.get_field('author').get_cache_name()
+
+    count = max(1, options.iterations // len(books))
+
+    def resolve():
+        for i in range(count):
+            for book in books:
+                book.__dict__.pop(cache_name, None)
+                book.author
+
+    trips = round_trips(backend)
+    _, elapsed = timed(resolve)
+    return per_op(elapsed, count * len(books), backend, trips)
+
+
+BENCHMARKS = (
+    ('instance_get', bench_instance_get),
+    ('get_many', bench_get_many),
+    ('related_read', bench_related_read),
+    ('related_page', bench_related_page),
+    ('child_save', bench_child_save),
+    ('m2m', bench_m2m),
+    ('m2m_save', bench_m2m_save),
+    ('fk_descriptor', bench_fk_descriptor),
+)
+
+
+def main(argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--backends', default=','.join(BACKENDS),
+        help='Comma separated cache aliases to run against.')
+    parser.add_option('--sizes', default=','.join(str(size) for size in SIZES),
+        help='Comma separated related list sizes, e.g. 10,100,1000,10000,100000.')
+    parser.add_option('--iterations', type='int', default=2000,
+        help='Reads made by the read benchmarks.')
+    parser.add_option('--saves', type='int', default=20,
+        help='Child saves timed per list size.')
+    parser.add_option('--chunk-size', type='int', default=None,
+        help='Store related lists longer than this in chunks.')
+    parser.add_option('--only', default=None,
+        help='Comma separated benchmarks to run.')
+    parser.add_option('--output', default=None,
+        help='File to write the JSON results to; stdout by default.')
+    options, args = parser.parse_args(argv[1:])
+    options.sizes = [int(size) for size in options.sizes.split(',')]
+
+    benchmarks = BENCHMARKS
+    if options.only:
+        names = options.only.split(',')
+        benchmarks = [(name, func) for name, func in BENCHMARKS if name in names]
+
+    setup()
+    Person.cache.chunk_size = options.chunk_size
+    results = {}
+    for alias in options.backends.split(','):
+        results[alias] = {}
+        for name, func in benchmarks:
+            truncate()
+            backend = use_backend(alias)
+            sys.stderr.write('%s: %s\n' % (alias, name))
+            results[alias][name] = func(backend, options)
+    truncate()
+    report('suite', results, options.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
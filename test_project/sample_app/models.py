@@ -1,12 +1,16 @@
 from django.db import models
+from django.db.models import Count, Max, Min, Sum
 
-from autocache import RelatedCacheController, CachingForeignKey
+from autocache import CacheController, RelatedCacheController, CachingForeignKey, CachingManager
 
 
 class Person(models.Model):
     name = models.CharField(max_length=64)
 
-    cache = RelatedCacheController()
+    cache = RelatedCacheController(aggregates={
+        'book_set': (Count('pk'), Sum('rank'), Max('rank')),
+        'edited': (Count('pk'), Min('rank')),
+    })
 
     def __unicode__(self):
         return self.name
@@ -18,6 +22,7 @@ class Book(models.Model):
     editors = models.ManyToManyField("Person", related_name='edited')
     rank = models.IntegerField()
 
+    objects = CachingManager()
     cache = RelatedCacheController(backend='other')
 
     class Meta:
@@ -32,6 +37,18 @@ class Volume(models.Model):
     book = models.OneToOneField(Book)
     order_in_series = models.PositiveIntegerField(default=1)
 
+    cache = CacheController()
+
     def __unicode__(self):
         return "%s: %s" % (self.order_in_series, self.book.title)
 
+
+class Publisher(models.Model):
+    name = models.CharField(max_length=64)
+    slug = models.SlugField(unique=True)
+
+    objects = CachingManager()
+    cache = CacheController(unique=('slug',))
+
+    def __unicode__(self):
+        return self.name
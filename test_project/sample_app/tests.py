@@ -1,202 +1,1861 @@
+import threading
+import time
+
+from StringIO import StringIO
+
+from django.core.exceptions import FieldError
+from django.core.management import call_command
 from django.test import TestCase
 from django.core.cache import cache, get_cache
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.db.models import Count, Max, Min, Sum
+
+from autocache import LocalCache, RefreshPool, SingleFlight, prefetch_cached
+from autocache import MemoryStats, batch, codec, commit_manually, commit_on_success, counters, lookups
+from autocache import TransactionMiddleware, batching, queries, refresh, stats
+from autocache import IdentityMapMiddleware, identity, identity_map
+from autocache.chunks import Chunks, ChunkedList
+from autocache.controller import registry
+from autocache.related_controller import Change
+
+from .models import Person, Book, Volume, Publisher
+
+other_cache = get_cache('other')
+
+class CacheControllerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+
+    def test_save(self):
+        """
+        Tests that objects which are saved get cached correctly and are retrievable via CacheController.get.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        author_id = author.id
+
+        with self.assertNumQueries(0):
+            person = Person.cache.get(author_id)
+
+    def test_delete_invalidate(self):
+        """
+        Tests that objects which are deleted get invalidated in cache.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        author_id = author.id
+
+        author.delete()
+
+        with self.assertNumQueries(0):
+            with self.assertRaises(Person.DoesNotExist):
+                Person.cache.get(author_id)
+
+    def test_save_updated_value(self):
+        """
+        Tests that objects which are saved update cache correctly.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+        author_id = author.id
+
+        author.name = "Jane Austin"
+        author.save()
+
+        with self.assertNumQueries(0):
+            person = Person.cache.get(author_id)
+
+        self.assertEquals(person.name, "Jane Austin")
+
+
+    def test_save_cache_miss(self):
+        """
+        Tests that objects which are not in cache are retreived correctly via CacheController.get.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        author_id = author.id
+
+        cache_key = Person.cache.make_key(author.id)
+        cache.delete(cache_key)
+
+        with self.assertNumQueries(1):
+            person = Person.cache.get(author_id)
+        self.assertEquals(person.name, author.name)
+
+
+    def test_delete_cache_miss(self):
+        """
+        Tests that CacheController.get properly raises a DoesNotExist when an object is neither in cache nor the database.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        author_id = author.id
+
+        author.delete()
+
+        cache_key = Person.cache.make_key(author_id)
+        cache.delete(cache_key)
+
+        with self.assertNumQueries(1):
+            with self.assertRaises(Person.DoesNotExist):
+                person = Person.cache.get(author_id)
+
+    def test_get_many(self):
+        """
+        Tests that CacheController.get_many returns cached instances in the order requested.
+        """
+        authors = [
+            Person(name="Charles Dickens"),
+            Person(name="Jane Austin"),
+            Person(name="Mark Twain"),
+        ]
+        for author in authors:
+            author.save()
+
+        pks = [authors[2].pk, authors[0].pk, authors[1].pk]
+        with self.assertNumQueries(0):
+            people = Person.cache.get_many(pks)
+
+        self.assertEqual([p.pk for p in people], pks)
+
+    def test_get_many_cache_miss(self):
+        """
+        Tests that CacheController.get_many loads all misses with one query and caches them, including rows that don't exist.
+        """
+        authors = [
+            Person(name="Charles Dickens"),
+            Person(name="Jane Austin"),
+            Person(name="Mark Twain"),
+        ]
+        for author in authors:
+            author.save()
+
+        deleted_id = authors[1].id
+        authors[1].delete()
+
+        for author_id in (authors[0].id, authors[2].id, deleted_id):
+            cache.delete(Person.cache.make_key(author_id))
+
+        pks = [authors[2].id, deleted_id, authors[0].id]
+        with self.assertNumQueries(1):
+            people = Person.cache.get_many(pks)
+        self.assertEqual([p.name for p in people], ["Mark Twain", "Charles Dickens"])
+
+        with self.assertNumQueries(0):
+            people = Person.cache.get_many(pks)
+            with self.assertRaises(Person.DoesNotExist):
+                Person.cache.get(deleted_id)
+        self.assertEqual([p.name for p in people], ["Mark Twain", "Charles Dickens"])
+
+
+class LocalCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+        Person.cache.local = LocalCache(max_entries=2)
+
+    def tearDown(self):
+        Person.cache.local = None
+
+    def test_lru_eviction(self):
+        local = LocalCache(max_entries=2)
+        local.set('a', 1)
+        local.set('b', 2)
+        local.get('a')
+        local.set('c', 3)
+
+        self.assertEqual(local.get('a'), 1)
+        self.assertEqual(local.get('b'), None)
+        self.assertEqual(local.get('c'), 3)
+
+    def test_byte_bound(self):
+        local = LocalCache(max_bytes=200)
+        local.set('a', 'x' * 100)
+        local.set('b', 'y' * 100)
+        local.set('c', 'z' * 1000)
+
+        self.assertEqual(local.get('a'), None)
+        self.assertEqual(local.get('b'), 'y' * 100)
+        self.assertEqual(local.get('c'), None)
+        self.assertTrue(local.size <= 200)
+
+    def test_timeout(self):
+        local = LocalCache(timeout=-1)
+        local.set('a', 1)
+        self.assertEqual(local.get('a'), None)
+
+    def test_get_served_locally(self):
+        """
+        Tests that CacheController.get reads from the local tier without touching the shared cache.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        cache.delete(Person.cache.make_key(author.pk))
+
+        with self.assertNumQueries(0):
+            person = Person.cache.get(author.pk)
+        self.assertEqual(person.name, "Charles Dickens")
+
+    def test_remote_invalidation(self):
+        """
+        Tests that a write from another process drops local copies once the generation is re-read.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+        Person.cache.get(author.pk)
+
+        # simulate another process saving the author
+        local, Person.cache.local = Person.cache.local, LocalCache()
+        author.name = "Jane Austin"
+        author.save()
+        Person.cache.local = local
+
+        self.assertEqual(Person.cache.get(author.pk).name, "Charles Dickens")
+
+        local._next_check = 0
+        self.assertEqual(Person.cache.get(author.pk).name, "Jane Austin")
+
+
+class SingleFlightTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+
+    def test_concurrent_misses_share_one_load(self):
+        flight = SingleFlight()
+        loads = []
+
+        def load():
+            loads.append(1)
+            time.sleep(0.05)
+            cache.set('flight-key', 'value')
+            return 'value'
+
+        results = []
+        read = lambda: cache.get('flight-key')
+        fill = lambda: results.append(flight.fill(cache, 'flight-key', read, load))
+        threads = [threading.Thread(target=fill) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, ['value'] * 5)
+
+    def test_waits_for_lease_holder(self):
+        """
+        Tests that a miss waits for the value when another process holds the lease.
+        """
+        flight = SingleFlight(wait=1.0, retry_interval=0.01)
+        cache.add(flight.make_lease_key('flight-key'), 1)
+
+        reads = []
+        def read():
+            reads.append(1)
+            if len(reads) == 3:
+                cache.set('flight-key', 'filled elsewhere')
+            return cache.get('flight-key')
+
+        def load():
+            self.fail("the lease holder should fill the key")
+
+        self.assertEqual(flight.fill(cache, 'flight-key', read, load), 'filled elsewhere')
+
+    def test_loads_after_waiting(self):
+        flight = SingleFlight(wait=0.05, retry_interval=0.01)
+        cache.add(flight.make_lease_key('flight-key'), 1)
+
+        read = lambda: None
+        load = lambda: 'loaded'
+        self.assertEqual(flight.fill(cache, 'flight-key', read, load), 'loaded')
+
+    def test_controller_get(self):
+        author = Person(name="Charles Dickens")
+        author.save()
+        deleted = Person(name="Jane Austin")
+        deleted.save()
+        deleted.delete()
+        cache.clear()
+
+        Person.cache.single_flight = SingleFlight()
+        try:
+            with self.assertNumQueries(2):
+                self.assertEqual(Person.cache.get(author.pk).name, "Charles Dickens")
+                with self.assertRaises(Person.DoesNotExist):
+                    Person.cache.get(deleted.pk)
+            with self.assertNumQueries(0):
+                Person.cache.get(author.pk)
+            self.assertEqual(cache.get(Person.cache.single_flight.make_lease_key(Person.cache.make_key(author.pk))), None)
+        finally:
+            Person.cache.single_flight = None
+
+
+class SoftTimeoutTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+        # every entry is stale as soon as it is written
+        Person.cache.soft_timeout = -1
+        Person.cache.refresh_pool = RefreshPool(workers=0)
+
+    def tearDown(self):
+        Person.cache.soft_timeout = None
+        Person.cache.refresh_pool = refresh.default_pool
+
+    def test_stale_value_is_served_and_refreshed(self):
+        author = Person(name="Charles Dickens")
+        author.save()
+        Person.objects.filter(pk=author.pk).update(name="Jane Austin")
+
+        # the refresh runs inline, so it shows up here
+        with self.assertNumQueries(1):
+            person = Person.cache.get(author.pk)
+        self.assertEqual(person.name, "Charles Dickens")
+
+        self.assertEqual(Person.cache.get(author.pk).name, "Jane Austin")
+
+    def test_foreign_key_refresh(self):
+        author = Person(name="Charles Dickens")
+        author.save()
+        book = Book(author=author, rank=1, title="Our Mutual Friend")
+        book.save()
+        Person.objects.filter(pk=author.pk).update(name="Jane Austin")
+
+        book = Book.objects.get(pk=book.pk)
+        self.assertEqual(book.author.name, "Charles Dickens")
+        book = Book.objects.get(pk=book.pk)
+        self.assertEqual(book.author.name, "Jane Austin")
+
+    def test_pool_bounds(self):
+        pool = RefreshPool(workers=1, max_pending=1)
+        started = threading.Event()
+        release = threading.Event()
+        ran = []
+
+        def block():
+            started.set()
+            release.wait(5)
+            ran.append('a')
+
+        self.assertTrue(pool.submit('a', block))
+        started.wait(5)
+        self.assertTrue(pool.submit('b', lambda: ran.append('b')))
+        # already pending
+        self.assertFalse(pool.submit('b', lambda: ran.append('b')))
+        # queue is full
+        self.assertFalse(pool.submit('c', lambda: ran.append('c')))
+
+        release.set()
+        pool.join()
+        self.assertEqual(ran, ['a', 'b'])
+
+
+class CodecTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+
+    def test_instance_stored_as_field_values(self):
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        stored = cache.get(Person.cache.make_key(author.pk))
+        self.assertTrue(stored.startswith(codec.MARKER + codec.FORMAT_MODEL))
+
+        person = Person.cache.get(author.pk)
+        self.assertEqual((person.pk, person.name), (author.pk, author.name))
+        self.assertFalse(person._state.adding)
+
+    def test_compact_related_list(self):
+        author = Person(name="Charles Dickens")
+        author.save()
+        for rank in range(20):
+            Book(author=author, rank=rank, title="Book %s" % rank).save()
+
+        books = list(author.book_set.all())
+        sizes = codec.ModelCodec().sizes(books)
+        self.assertTrue(sizes['encoded'] < sizes['pickled'])
+
+        with self.assertNumQueries(0):
+            cached = author.cache.book_set
+        self.assertEqual([b.title for b in cached], [b.title for b in books])
+
+    def test_compression(self):
+        books = [Book(pk=i, author_id=1, rank=i, title="Book") for i in range(50)]
+        model_codec = codec.ModelCodec(compress_threshold=100)
+
+        stored = model_codec.encode(books)
+        self.assertEqual(stored[2:3], codec.COMPRESS_ZLIB)
+        self.assertTrue(model_codec.encoded_bytes < model_codec.uncompressed_bytes)
+        self.assertEqual([b.pk for b in model_codec.decode(stored)], range(50))
+
+    def test_schema_change_is_a_miss(self):
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        codec._fingerprints[Person] = 'changed'
+        try:
+            with self.assertNumQueries(1):
+                Person.cache.get(author.pk)
+        finally:
+            del codec._fingerprints[Person]
+
+
+class RelatedCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+
+    def test_create_ordering(self):
+        """
+        Tests that objects created out of order get cached in the correct
+        order.
+        """
+
+        # save an author
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        # save some books
+        books = [
+            Book(author=author, rank=1, title="Our Mutual Friend"),
+            Book(author=author, rank=1, title="David Copperfield"),
+            Book(author=author, rank=2, title="A Christmas Carol"),
+        ]
+        for book in books:
+            book.save()
+
+        with self.assertNumQueries(0):
+            bs = author.cache.book_set
+
+        # Books should be ordered by rank descending, title ascending
+        titles = [
+            "A Christmas Carol",
+            "David Copperfield",
+            "Our Mutual Friend"
+        ]
+        self.assertEqual([b.title for b in bs], titles)
+
+
+    def test_update_ordering(self):
+        """
+        Tests that objects updated get cached in the correct order.
+        """
+
+        # save an author
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        # save some books
+        books = [
+            Book(author=author, rank=2, title="A Christmas Carol"),
+            Book(author=author, rank=1, title="David Copperfield"),
+            Book(author=author, rank=1, title="Our Mutual Friend"),
+        ]
+        for book in books:
+            book.save()
+
+        # check the current ordering: rank descending, title ascending
+        with self.assertNumQueries(0):
+            bs = author.cache.book_set
+        self.assertEqual([b.title for b in bs], [b.title for b in books])
+
+        # reorder the books: move book[1] to book[0]
+        books[1].rank = 3
+        books[1].save()
+        books[0], books[1] = books[1], books[0]
+
+        # check the current ordering: rank descending, title ascending
+        with self.assertNumQueries(0):
+            bs = author.cache.book_set
+        self.assertEqual([b.title for b in bs], [b.title for b in books])
+
+
+    def test_invalidations(self):
+        """
+        Test that changing a foreign key relationship correctly updates
+        both the cache it is moving into and the cache it is moving out of.
+        """
+        # save some authors
+        authors = [
+            Person(name="Charles Dickens"),
+            Person(name="Jane Austin"),
+        ]
+        for author in authors:
+            author.save()
+
+        # save some books
+        books = [
+            Book(author=authors[0], rank=1, title="Our Mutual Friend"),
+            Book(author=authors[0], rank=2, title="A Christmas Carol"),
+            Book(author=authors[1], rank=1, title="Sense and Sensibility"),
+        ]
+        for book in books:
+            book.save()
+
+        # change the author on a book.
+        books[0].author = authors[1]
+        books[0].save()
+
+        with self.assertNumQueries(0):
+            charles_books = authors[0].cache.book_set
+            jane_books = authors[1].cache.book_set
+
+        titles = ["Our Mutual Friend", "Sense and Sensibility"]
+        self.assertEqual([b.title for b in jane_books], titles)
+
+        titles = ["A Christmas Carol"]
+        self.assertEqual([b.title for b in charles_books], titles)
+
+
+class ChunkedRelatedCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+        Person.cache.chunk_size = 2
+
+        self.author = Person(name="Charles Dickens")
+        self.author.save()
+        for rank in range(1, 6):
+            Book(author=self.author, rank=rank, title="Book %s" % rank).save()
+        self.key = Person.cache.make_related_key(self.author.pk, 'book_set')
+
+    def tearDown(self):
+        Person.cache.chunk_size = None
+
+    def books(self):
+        return list(Book.objects.filter(author=self.author))
+
+    def tokens(self):
+        return [token for token, length in Person.cache._cache_get(self.key).chunks]
+
+    def test_chunked_read(self):
+        cache.delete(self.key)
+        self.assertEqual(list(self.author.cache.book_set), self.books())
+
+        header = Person.cache._cache_get(self.key)
+        self.assertTrue(isinstance(header, Chunks))
+        self.assertEqual([length for token, length in header.chunks], [2, 2, 1])
+
+        with self.assertNumQueries(0):
+            books = self.author.cache.book_set
+            self.assertTrue(isinstance(books, ChunkedList))
+            self.assertEqual(len(books), 5)
+            self.assertEqual(books[0].rank, 5)
+            self.assertEqual([b.rank for b in books[1:4]], [4, 3, 2])
+            self.assertEqual(books[-1].rank, 1)
+
+        # only the chunks a slice covers are read
+        cache.delete(Person.cache.make_chunk_key(self.key, header.chunks[2][0]))
+        with self.assertNumQueries(0):
+            self.assertEqual([b.rank for b in self.author.cache.book_set[:4]], [5, 4, 3, 2])
+        expected = self.books()
+        with self.assertNumQueries(1):
+            self.assertEqual(list(self.author.cache.book_set), expected)
+
+    def test_update_rewrites_changed_chunk(self):
+        cache.delete(self.key)
+        self.author.cache.book_set
+        tokens = self.tokens()
+
+        book = Book.objects.get(author=self.author, rank=1)
+        book.title = "Our Mutual Friend"
+        book.save()
+        self.assertEqual(self.tokens()[:2], tokens[:2])
+        self.assertNotEqual(self.tokens()[2], tokens[2])
+        self.assertEqual(self.author.cache.book_set[-1].title, "Our Mutual Friend")
+
+        tokens = self.tokens()
+        Book(author=self.author, rank=6, title="Book 6").save()
+        self.assertNotEqual(self.tokens()[0], tokens[0])
+        self.assertEqual(self.tokens()[1:], tokens[1:])
+
+        book.rank = 10
+        book.save()
+        Book.objects.get(author=self.author, rank=3).delete()
+        with self.assertNumQueries(0):
+            books = list(self.author.cache.book_set)
+        self.assertEqual(books, self.books())
+        self.assertEqual([b.rank for b in books], [10, 6, 5, 4, 2])
+        self.assertEqual(books[0].title, "Our Mutual Friend")
+
+    def test_update_reads_touched_chunks(self):
+        """
+        Tests that a save reads only the chunk that holds the object, or that it goes into.
+        """
+        cache.delete(self.key)
+        self.author.cache.book_set
+        tokens = self.tokens()
+
+        backend = Person.cache.cache
+        get_many = backend.get_many
+        read = []
+        def recording_get_many(keys, *args, **kwargs):
+            read.extend(keys)
+            return get_many(keys, *args, **kwargs)
+        backend.get_many = recording_get_many
+        try:
+            book = Book.objects.get(author=self.author, rank=1)
+            book.title = "Our Mutual Friend"
+            book.save()
+            chunks = [k for k in read if k.startswith(self.key + ':chunk:') and not k.endswith(':summary')]
+            self.assertEqual(chunks, [Person.cache.make_chunk_key(self.key, tokens[2])])
+
+            tokens = self.tokens()
+            del read[:]
+            Book(author=self.author, rank=6, title="Book 6").save()
+            chunks = [k for k in read if k.startswith(self.key + ':chunk:') and not k.endswith(':summary')]
+            self.assertEqual(chunks, [Person.cache.make_chunk_key(self.key, tokens[0])])
+        finally:
+            backend.__dict__.pop('get_many', None)
+
+        expected = self.books()
+        with self.assertNumQueries(0):
+            self.assertEqual(list(self.author.cache.book_set), expected)
+
+    def test_header_rewrite_refreshes_old_chunks(self):
+        """
+        Tests that chunks written longer ago than the timeout are written again along with the header.
+        """
+        cache.delete(self.key)
+        self.author.cache.book_set
+        tokens = self.tokens()
+
+        summary_key = Person.cache.make_summary_key(self.key, tokens[0])
+        summary = Person.cache._cache_get(summary_key)
+        summary.written -= Person.cache.timeout + 1
+        Person.cache._cache_set(summary_key, summary)
+
+        book = Book.objects.get(author=self.author, rank=1)
+        book.title = "Our Mutual Friend"
+        book.save()
+        self.assertNotEqual(self.tokens()[0], tokens[0])
+        self.assertEqual(self.tokens()[1], tokens[1])
+        self.assertNotEqual(self.tokens()[2], tokens[2])
+
+        expected = self.books()
+        with self.assertNumQueries(0):
+            self.assertEqual(list(self.author.cache.book_set), expected)
+
+    def test_batched_updates(self):
+        cache.delete(self.key)
+        self.author.cache.book_set
+
+        with batch():
+            for book in Book.objects.filter(author=self.author):
+                book.rank = 10 - book.rank
+                book.save()
+        self.assertEqual(list(self.author.cache.book_set), self.books())
+
+    def test_short_list(self):
+        Book.objects.filter(author=self.author, rank__gt=2).delete()
+        cache.delete(self.key)
+        self.assertEqual(self.author.cache.book_set, self.books())
+
+
+class ChangeTests(TestCase):
+
+    def books(self, *values):
+        return [Book(pk=pk, rank=rank, title=title) for pk, rank, title in values]
+
+    def test_upsert_keeps_order(self):
+        ordering = Book._meta.ordering
+        books = self.books((1, 3, "C"), (2, 2, "A"), (3, 2, "B"), (4, 1, "D"))
+
+        change = Change(upsert=self.books((3, 2, "Z")), ordering=ordering)
+        self.assertEqual([b.pk for b in change(books)], [1, 2, 3, 4])
+
+        change = Change(upsert=self.books((4, 2, "AA"), (5, 5, "E")), ordering=ordering)
+        self.assertEqual([b.pk for b in change(books)], [5, 1, 2, 4, 3])
+
+        change = Change(remove=[1, 3], upsert=self.books((2, 0, "A")), ordering=ordering)
+        self.assertEqual([b.pk for b in change(books)], [4, 2])
+
+    def test_unordered(self):
+        books = self.books((1, 3, "C"), (2, 2, "A"))
+        change = Change(remove=[1], upsert=self.books((2, 9, "A"), (3, 1, "B")))
+        self.assertEqual([(b.pk, b.rank) for b in change(books)], [(2, 9), (3, 1)])
+
+
+class LookupTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+
+        self.author = Person(name="Charles Dickens")
+        self.author.save()
+        self.other = Person(name="Wilkie Collins")
+        self.other.save()
+        for rank, title in ((1, "Bleak House"), (2, "Hard Times"), (3, "Little Dorrit"), (3, "Dombey")):
+            Book(author=self.author, rank=rank, title=title).save()
+        self.books = list(Book.objects.filter(author=self.author))
+        self.author.cache.book_set
+
+    def titles(self, books):
+        return [b.title for b in books]
+
+    def test_filter(self):
+        with self.assertNumQueries(0):
+            books = self.author.cache.book_set
+            self.assertEqual(self.titles(books.filter(rank__gt=1)), ["Dombey", "Little Dorrit", "Hard Times"])
+            self.assertEqual(self.titles(books.filter(rank=3, title__startswith="L")), ["Little Dorrit"])
+            self.assertEqual(self.titles(books.filter(rank__in=["1", 2])), ["Hard Times", "Bleak House"])
+            self.assertEqual(self.titles(books.filter(pk=self.books[0].pk)), ["Dombey"])
+            self.assertEqual(books.filter(author=self.author).count(), 4)
+            self.assertFalse(books.filter(author=self.other).exists())
+            self.assertEqual(books.filter(title__isnull=True).count(), 0)
+            self.assertEqual(self.titles(books.exclude(rank=3)), ["Hard Times", "Bleak House"])
+            self.assertEqual(self.titles(books.exclude(rank=3, title="Dombey")), self.titles(self.books[1:]))
+            self.assertEqual(self.titles(books.exclude()), self.titles(self.books))
+            self.assertFalse(books.exclude() is books)
+
+    def test_order_by(self):
+        with self.assertNumQueries(0):
+            books = self.author.cache.book_set
+            self.assertEqual(self.titles(books.order_by('title')),
+                             ["Bleak House", "Dombey", "Hard Times", "Little Dorrit"])
+            self.assertEqual(self.titles(books.filter(rank__lte=3).order_by('rank', '-title')),
+                             ["Bleak House", "Hard Times", "Little Dorrit", "Dombey"])
+        self.assertEqual(self.titles(books.order_by('rank', 'title')),
+                         self.titles(Book.objects.filter(author=self.author).order_by('rank', 'title')))
+
+    def test_invalid_lookups(self):
+        books = self.author.cache.book_set
+        self.assertRaises(FieldError, books.filter, author__name="Charles Dickens")
+        self.assertRaises(FieldError, books.filter, editors=self.other)
+        self.assertRaises(FieldError, books.order_by, 'publisher')
+
+    def test_predicates_are_reused(self):
+        books = self.author.cache.book_set
+        books.filter(rank__gte=1, title__startswith="B")
+        compiled = len(lookups._predicates)
+        books.filter(title__startswith="H", rank__gte=2)
+        self.assertEqual(len(lookups._predicates), compiled)
+
+    def test_chunked_list(self):
+        Person.cache.chunk_size = 2
+        try:
+            cache.clear()
+            self.author.cache.book_set
+            with self.assertNumQueries(0):
+                books = self.author.cache.book_set
+                self.assertTrue(isinstance(books, ChunkedList))
+                self.assertEqual(self.titles(books.filter(rank=3).order_by('title')), ["Dombey", "Little Dorrit"])
+                self.assertEqual(books.count(), 4)
+        finally:
+            Person.cache.chunk_size = None
+
+
+class AggregateTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+
+        self.author = Person(name="Charles Dickens")
+        self.author.save()
+        self.other = Person(name="Wilkie Collins")
+        self.other.save()
+        for rank in (1, 2, 3):
+            Book(author=self.author, rank=rank, title="Book %s" % rank).save()
+
+    def expected(self, person):
+        return Book.objects.filter(author=person).aggregate(Count('pk'), Sum('rank'), Max('rank'))
+
+    def cached(self, person, alias, name='book_set'):
+        return cache.get(Person.cache.make_aggregate_key(person.pk, name, alias))
+
+    def assertCounted(self, person):
+        """ The count, and where the backend allows it the sum, were kept up
+            to date in cache.
+        """
+        expected = self.expected(person)
+        self.assertEqual(self.cached(person, 'pk__count'), expected['pk__count'])
+        total = [a for a in Person.cache._aggregates['book_set'] if a.alias == 'rank__sum'][0]
+        if total.counter:
+            self.assertEqual(self.cached(person, 'rank__sum'), expected['rank__sum'] or 0)
+        else:
+            # memcached can't hold negative numbers, so sums of a field that
+            # may be negative are dropped when they change
+            self.assertTrue(self.cached(person, 'rank__sum') in (None, expected['rank__sum'] or 0))
+        self.assertEqual(person.cache.aggregate('book_set'), expected)
+
+    def test_read_without_list(self):
+        cache.clear()
+        expected = self.expected(self.author)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.author.cache.aggregate('book_set'), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.author.cache.aggregate('book_set'), expected)
+            self.assertEqual(self.author.cache.count('book_set'), 3)
+        self.assertEqual(cache.get(Person.cache.make_related_key(self.author.pk, 'book_set')), None)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.other.cache.aggregate('book_set'),
+                             {'pk__count': 0, 'rank__sum': 0, 'rank__max': None})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.other.cache.count('book_set'), 0)
+
+    def test_incremental_updates(self):
+        self.author.cache.aggregate('book_set')
+        self.other.cache.aggregate('book_set')
+
+        Book(author=self.author, rank=2, title="Hard Times").save()
+        self.assertCounted(self.author)
+
+        book = Book.objects.get(title="Book 1")
+        book.rank = 0
+        book.save()
+        self.assertCounted(self.author)
+
+        book.author = self.other
+        book.save()
+        self.assertCounted(self.author)
+        self.assertCounted(self.other)
+
+        Book.objects.get(title="Hard Times").delete()
+        self.assertCounted(self.author)
+
+    def test_decrement_with_decr(self):
+        """ Memcached clients refuse a negative delta to incr.
+        """
+        backend = Person.cache.cache
+        incr = backend.incr
+        def positive_incr(key, delta=1, version=None):
+            if delta < 0:
+                raise ValueError("delta must be positive")
+            return incr(key, delta, version=version)
+        def local_decr(key, delta=1, version=None):
+            # the local backends decrement through incr
+            return incr(key, -delta, version=version)
+
+        self.author.cache.aggregate('book_set')
+        backend.incr = positive_incr
+        if not isinstance(backend, BaseMemcachedCache):
+            backend.decr = local_decr
+        try:
+            Book.objects.get(title="Book 1").delete()
+            self.assertEqual(self.cached(self.author, 'pk__count'), 2)
+        finally:
+            backend.__dict__.pop('incr')
+            backend.__dict__.pop('decr', None)
+        self.assertCounted(self.author)
+
+    def test_extremes(self):
+        self.author.cache.aggregate('book_set')
+
+        # a change that can't move the maximum leaves it in place
+        Book.objects.get(title="Book 1").delete()
+        book = Book.objects.get(title="Book 2")
+        book.rank = 1
+        book.save()
+        self.assertEqual(self.cached(self.author, 'rank__max'), 3)
+
+        book.rank = 5
+        book.save()
+        self.assertEqual(self.cached(self.author, 'rank__max'), None)
+        self.assertCounted(self.author)
+        self.assertEqual(self.cached(self.author, 'rank__max'), 5)
+
+        Book.objects.get(title="Book 2").delete()
+        self.assertEqual(self.cached(self.author, 'rank__max'), None)
+        self.assertCounted(self.author)
+
+    def test_many_to_many(self):
+        books = list(Book.objects.all())
+        expected = lambda: Book.objects.filter(editors=self.other).aggregate(Count('pk'), Min('rank'))
+        self.assertEqual(self.other.cache.aggregate('edited'), {'pk__count': 0, 'rank__min': None})
+
+        books[1].editors.add(self.other)
+        self.other.edited.add(books[2], books[0])
+        self.assertEqual(self.cached(self.other, 'pk__count', 'edited'), 3)
+        self.assertEqual(self.other.cache.aggregate('edited'), expected())
+
+        self.other.edited.remove(books[1])
+        books[2].editors.remove(self.other)
+        self.assertEqual(self.cached(self.other, 'pk__count', 'edited'), 1)
+        self.assertEqual(self.other.cache.aggregate('edited'), expected())
+
+        self.other.edited.clear()
+        self.assertEqual(self.other.cache.count('edited'), 0)
+
+    def test_batch(self):
+        self.author.cache.aggregate('book_set')
+        with batch():
+            Book(author=self.author, rank=4, title="Book 4").save()
+            self.assertEqual(self.author.cache.count('book_set'), 4)
+            self.assertEqual(self.cached(self.author, 'pk__count'), 3)
+        self.assertCounted(self.author)
+
+        try:
+            with batch():
+                Book(author=self.author, rank=1, title="Unsaved").save()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.cached(self.author, 'pk__count'), 4)
+
+    def test_change_during_fill(self):
+        """
+        Tests that a fill doesn't cache a count read before a change that found the count missing.
+        """
+        cache.clear()
+        add = cache.add
+
+        def racing_add(key, *args, **kwargs):
+            if key.endswith(':pk__count') and not key.startswith('fill:') and not saved:
+                # the change lands between the aggregate query and the add
+                saved.append(Book(author=self.author, rank=4, title="Book 4"))
+                saved[0].save()
+            return add(key, *args, **kwargs)
+        saved = []
+        cache.add = racing_add
+        try:
+            self.assertEqual(self.author.cache.count('book_set'), 3)
+        finally:
+            del cache.add
+
+        self.assertEqual(self.cached(self.author, 'pk__count'), None)
+        self.assertEqual(self.author.cache.count('book_set'), 4)
+        self.assertEqual(self.cached(self.author, 'pk__count'), 4)
+
+    def test_undeclared(self):
+        self.assertRaises(TypeError, Book.objects.all()[0].cache.aggregate, 'editors')
+        self.assertRaises(AttributeError, self.author.cache.count, 'chapters')
+
+
+class QueryCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+
+        self.author = Person(name="Charles Dickens")
+        self.author.save()
+        self.editor = Person(name="John Forster")
+        self.editor.save()
+        for rank in (1, 2, 3, 4):
+            Book(author=self.author, rank=rank, title="Book %s" % rank).save()
+
+    def test_query(self):
+        queryset = Book.objects.filter(rank__gte=2).order_by('title')[:2]
+        expected = list(queryset.all())
+        with self.assertNumQueries(1):
+            self.assertEqual(Book.cache.query(queryset), expected)
+        with self.assertNumQueries(0):
+            books = Book.cache.query(queryset)
+        self.assertEqual([b.title for b in books], ["Book 2", "Book 3"])
+
+        # other parameters are another query
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Book.cache.query(Book.objects.filter(rank__gte=4))), 1)
+
+    def test_save_invalidates(self):
+        queryset = Book.objects.filter(rank__gte=3)
+        Book.cache.query(queryset)
+
+        book = Book.objects.get(title="Book 1")
+        book.rank = 5
+        book.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Book.cache.query(queryset)), 3)
+
+        Book.objects.get(title="Book 4").delete()
+        self.assertEqual(len(Book.cache.query(queryset)), 2)
+
+        Book.objects.filter(title="Book 3").update(rank=0)
+        self.assertEqual(len(Book.cache.query(queryset)), 1)
+
+    def test_joined_tables(self):
+        by_name = Book.objects.filter(author__name="Charles Dickens")
+        edited = Book.objects.filter(editors=self.editor)
+        self.assertEqual(len(Book.cache.query(by_name)), 4)
+        self.assertEqual(Book.cache.query(edited), [])
+
+        self.author.name = "Boz"
+        self.author.save()
+        self.assertEqual(Book.cache.query(by_name), [])
+
+        self.editor.edited.add(Book.objects.get(title="Book 2"))
+        self.assertEqual([b.title for b in Book.cache.query(edited)], ["Book 2"])
+
+    def test_batch(self):
+        queryset = Book.objects.filter(rank=1)
+        Book.cache.query(queryset)
+        with batch():
+            Book(author=self.author, rank=1, title="Book 0").save()
+            self.assertEqual(len(Book.cache.query(queryset)), 2)
+        # the result read inside the batch was cached for the new generation
+        with self.assertNumQueries(0):
+            self.assertEqual(len(Book.cache.query(queryset)), 2)
+
+    def test_empty_and_invalid(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(Book.cache.query(Book.objects.filter(pk__in=[])), [])
+        self.assertRaises(TypeError, Book.cache.query, Person.objects.all())
+
+    def test_controller_tables_are_watched(self):
+        """
+        Tests that writes move on the generations of the tables of models with a controller, and
+        of the many to many relations between them, before any cached query has read them.
+        """
+        tags = queries.get_tags('default', cache)
+        tables = [Publisher._meta.db_table, Book._meta.db_table, Book.editors.through._meta.db_table]
+        watched = set(queries._watched)
+        queries._watched.clear()
+        try:
+            generations = tags.generations(tables)
+            Publisher(name="Chapman & Hall", slug="chapman").save()
+            book = Book.objects.all()[0]
+            book.save()
+            self.author.edited.add(book)
+            self.assertEqual(tags.generations(tables), [generation + 1 for generation in generations])
+        finally:
+            queries._watched.update(watched)
+
+    def test_watch(self):
+        """
+        Tests that tables named with watch() are watched even where no model writing them has a
+        controller.
+        """
+        table = Volume._meta.db_table
+        del registry[Volume]
+        try:
+            tags = queries.get_tags('default', cache)
+            generation = tags.generations([table])[0]
+            books = Book.objects.all()
+            Volume(book=books[0]).save()
+            self.assertEqual(tags.generations([table])[0], generation)
+
+            queries.watch(Volume)
+            Volume(book=books[1]).save()
+            self.assertEqual(tags.generations([table])[0], generation + 1)
+        finally:
+            registry[Volume] = Volume.cache
+            queries._watched.discard(table)
+
+
+class IdentityMapTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+        stats.default_collector.reset()
+
+        self.author = Person(name="Charles Dickens")
+        self.author.save()
+        for rank in (1, 2):
+            Book(author=self.author, rank=rank, title="Book %s" % rank).save()
+
+    def reads(self):
+        counters = stats.default_collector.stats()
+        return counters.get('cache_get', {}).get('count', 0) + counters.get('cache_get_many', {}).get('count', 0)
+
+    def test_repeated_reads(self):
+        self.assertFalse(Person.cache.get(self.author.pk) is Person.cache.get(self.author.pk))
+
+        with identity_map():
+            author = Person.cache.get(self.author.pk)
+            reads = self.reads()
+            self.assertTrue(Person.cache.get(self.author.pk) is author)
+            self.assertTrue(Person.cache.get_many([self.author.pk])[0] is author)
+
+            books = list(Book.objects.all())
+            self.assertTrue(books[0].author is books[1].author)
+            self.assertTrue(self.author.cache.book_set[0] is self.author.cache.book_set[0])
+            self.assertEqual(self.reads(), reads + 1)
+        self.assertEqual(identity.current(), None)
+
+    def test_writes(self):
+        with identity_map():
+            author = Person.cache.get(self.author.pk)
+            author.name = "Boz"
+            author.save()
+            self.assertEqual(Person.cache.get(self.author.pk).name, "Boz")
+
+            with batch():
+                author.name = "Charles Dickens"
+                author.save()
+            self.assertEqual(Person.cache.get(self.author.pk).name, "Charles Dickens")
+
+            author.delete()
+            self.assertRaises(Person.DoesNotExist, Person.cache.get, self.author.pk)
+
+    def test_scoped_to_thread(self):
+        seen = []
+        with identity_map() as active:
+            thread = threading.Thread(target=lambda: seen.append(identity.current()))
+            thread.start()
+            thread.join()
+            self.assertTrue(identity.current() is active)
+            with identity_map() as inner:
+                self.assertTrue(inner.objects is active.objects)
+            self.assertTrue(identity.current() is active)
+        self.assertEqual(seen, [None])
+
+    def test_middleware(self):
+        def view(request):
+            return Person.cache.get(self.author.pk) is Person.cache.get(self.author.pk)
+        self.assertTrue(IdentityMapMiddleware(view)(object()))
+        self.assertEqual(identity.current(), None)
+
+        class Request(object):
+            pass
+        request = Request()
+        middleware = IdentityMapMiddleware()
+        middleware.process_request(request)
+        self.assertTrue(view(request))
+        self.assertEqual(middleware.process_response(request, 'response'), 'response')
+        self.assertEqual(identity.current(), None)
+
+    def test_middleware_leaves_map_on_exception(self):
+        class Request(object):
+            pass
+        request = Request()
+        middleware = IdentityMapMiddleware()
+        middleware.process_request(request)
+        middleware.process_exception(request, ValueError())
+        self.assertEqual(identity.current(), None)
+
+        # a response middleware that runs afterwards finds nothing to leave
+        self.assertEqual(middleware.process_response(request, 'response'), 'response')
+        self.assertEqual(identity.current(), None)
+
+    def test_middleware_leaves_map_when_request_finishes(self):
+        """
+        Tests that a map the response never passed through is left when the request finishes.
+        """
+        from django.core import signals
+
+        class Request(object):
+            pass
+        middleware = IdentityMapMiddleware()
+        middleware.process_request(Request())
+        self.assertNotEqual(identity.current(), None)
+        signals.request_finished.send(sender=self.__class__)
+        self.assertEqual(identity.current(), None)
+
+        # nor is it shared with the next request on the thread
+        first, second = Request(), Request()
+        middleware.process_request(first)
+        leaked = identity.current()
+        middleware.process_request(second)
+        self.assertFalse(identity.current() is leaked)
+        middleware.process_response(second, 'response')
+        self.assertEqual(identity.current(), None)
+
+
+class NormalizedRelatedCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+        Person.cache.normalized = True
+
+    def tearDown(self):
+        Person.cache.normalized = False
+
+    def test_stores_pk_list(self):
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        books = [
+            Book(author=author, rank=1, title="Our Mutual Friend"),
+            Book(author=author, rank=2, title="A Christmas Carol"),
+        ]
+        for book in books:
+            book.save()
+
+        key = Person.cache.make_related_key(author.pk, 'book_set')
+        self.assertEqual(Person.cache._cache_get(key), [books[1].pk, books[0].pk])
+
+        with self.assertNumQueries(0):
+            titles = [b.title for b in author.cache.book_set]
+        self.assertEqual(titles, ["A Christmas Carol", "Our Mutual Friend"])
+
+    def test_child_save_without_reorder(self):
+        """
+        Tests that a child save which doesn't move the child leaves the parent's pk list alone.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        books = [
+            Book(author=author, rank=1, title="Our Mutual Friend"),
+            Book(author=author, rank=2, title="A Christmas Carol"),
+        ]
+        for book in books:
+            book.save()
+
+        writes = Person.cache.codec.encoded
+        books[0].title = "Our Mutual Friends"
+        books[0].save()
+        self.assertEqual(Person.cache.codec.encoded, writes)
+
+        with self.assertNumQueries(0):
+            titles = [b.title for b in author.cache.book_set]
+        self.assertEqual(titles, ["A Christmas Carol", "Our Mutual Friends"])
+
+        books[0].rank = 3
+        books[0].save()
+        self.assertEqual(Person.cache.codec.encoded, writes + 1)
+
+        with self.assertNumQueries(0):
+            titles = [b.title for b in author.cache.book_set]
+        self.assertEqual(titles, ["Our Mutual Friends", "A Christmas Carol"])
+
+    def test_many_to_many(self):
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        books = [
+            Book(author=author, rank=1, title="Our Mutual Friend"),
+            Book(author=author, rank=2, title="A Christmas Carol"),
+        ]
+        for book in books:
+            book.save()
+
+        author.edited.add(books[0])
+        author.edited.add(books[1])
+        author.edited.remove(books[0])
+
+        with self.assertNumQueries(0):
+            edited = author.cache.edited
+        self.assertEqual(edited, list(author.edited.all()))
+
+
+class ConcurrentUpdateTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+        self.key = Person.cache.make_related_key(1, 'book_set')
+        Person.cache._set_objects(self.key, Book, [])
+
+    def append(self, book):
+        def update(objects):
+            objects.append(book)
+            return objects
+        Person.cache._update_objects(self.key, Book, update, lambda: [])
+
+    def test_no_lost_updates(self):
+        def work(offset):
+            for pk in range(offset, offset + 10):
+                self.append(Book(pk=pk, author_id=1, rank=0, title="Book"))
+
+        threads = [threading.Thread(target=work, args=(n * 10,)) for n in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        books = Person.cache._get_objects(self.key, Book)
+        self.assertEqual(sorted(b.pk for b in books), range(50))
+
+    def test_contention_drops_key(self):
+        """
+        Tests that a related list which can't be locked is deleted rather than left stale.
+        """
+        cache.add('lock:' + self.key, 1)
+        Person.cache._uses_cas = lambda: False
+        retries, Person.cache.UPDATE_RETRIES = Person.cache.UPDATE_RETRIES, 2
+        try:
+            self.append(Book(pk=1, author_id=1, rank=0, title="Book"))
+        finally:
+            Person.cache.UPDATE_RETRIES = retries
+            del Person.cache._uses_cas
+
+        self.assertEqual(cache.get(self.key), None)
+
+    def test_give_up_while_locked(self):
+        """
+        Tests that a list written back by the lock holder after another update gave up is dropped.
+        """
+        database = [Book(pk=1, author_id=1, rank=0, title="Book"), Book(pk=2, author_id=1, rank=0, title="Book")]
+        holding, release = threading.Event(), threading.Event()
+
+        def slow(objects):
+            holding.set()
+            release.wait()
+            return objects + database[:1]
+        holder = threading.Thread(target=Person.cache._update_objects,
+                                  args=(self.key, Book, slow, lambda: list(database)))
+        Person.cache._uses_cas = lambda: False
+        Person.cache.UPDATE_RETRIES = 2
+        try:
+            holder.start()
+            holding.wait()
+            self.append(database[1])
+        finally:
+            release.set()
+            holder.join()
+            del Person.cache.UPDATE_RETRIES
+            del Person.cache._uses_cas
+
+        self.assertEqual(cache.get(self.key), None)
+
+    def test_cas_conflict(self):
+        """
+        Tests that a list written by someone else between gets and cas is read again, and
+        deleted if that keeps happening.
+        """
+        if not Person.cache._uses_cas():
+            self.skipTest("needs pylibmc with the cas behavior")
+        database = [Book(pk=1, author_id=1, rank=0, title="Book"), Book(pk=2, author_id=1, rank=0, title="Book")]
+        calls = []
+
+        def update(objects):
+            if not calls:
+                # another process writes the list after we read it
+                Person.cache._set_objects(self.key, Book, database[:1])
+            calls.append(list(objects))
+            return objects + database[1:]
+        Person.cache._update_objects(self.key, Book, update, lambda: list(database))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([b.pk for b in Person.cache._get_objects(self.key, Book)], [1, 2])
+
+        def conflicting(objects):
+            Person.cache._set_objects(self.key, Book, [])
+            return objects + database[:1]
+        Person.cache.UPDATE_RETRIES = 2
+        try:
+            Person.cache._update_objects(self.key, Book, conflicting, lambda: list(database))
+        finally:
+            del Person.cache.UPDATE_RETRIES
+        self.assertEqual(cache.get(self.key), None)
+
+    def test_no_lost_updates_under_contention(self):
+        database = []
+        lock = threading.Lock()
+
+        def load():
+            with lock:
+                return list(database)
+
+        def work(offset):
+            for pk in range(offset, offset + 10):
+                book = Book(pk=pk, author_id=1, rank=0, title="Book")
+                with lock:
+                    database.append(book)
+
+                def update(objects, book=book):
+                    # hold the lock long enough for other updates to give up
+                    time.sleep(0.002)
+                    return objects + [book]
+                Person.cache._update_objects(self.key, Book, update, load)
+
+        Person.cache.UPDATE_RETRIES = 2
+        try:
+            threads = [threading.Thread(target=work, args=(n * 10,)) for n in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            del Person.cache.UPDATE_RETRIES
+
+        books = Person.cache._get_objects(self.key, Book)
+        if books is None:
+            books = load()
+        lost = set(b.pk for b in database) - set(b.pk for b in books)
+        self.assertEqual(len(lost), 0)
+
+
+class BatchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+
+    def test_writes_land_on_exit(self):
+        """
+        Tests that writes made in a batch are coalesced and only reach the cache when it exits.
+        """
+        with batch():
+            author = Person(name="Charles Dickens")
+            author.save()
+            author.name = "Boz"
+            author.save()
+            self.assertEqual(cache.get(Person.cache.make_key(author.pk)), None)
+
+            # reads see the pending value
+            with self.assertNumQueries(0):
+                self.assertEqual(Person.cache.get(author.pk).name, "Boz")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Person.cache.get(author.pk).name, "Boz")
+
+    def test_exception_drops_writes(self):
+        author = Person(name="Charles Dickens")
+        author.save()
+
+        try:
+            with batch():
+                author.name = "Boz"
+                author.save()
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertEqual(Person.cache.get(author.pk).name, "Charles Dickens")
+
+    def test_nested(self):
+        """
+        Tests that an inner batch which raises only drops its own writes.
+        """
+        first = Person(name="Charles Dickens")
+        second = Person(name="Jane Austen")
+        with batch():
+            first.save()
+            try:
+                with batch():
+                    second.save()
+                    raise ValueError
+            except ValueError:
+                pass
+
+        self.assertEqual(Person.cache.get(first.pk).name, "Charles Dickens")
+        self.assertEqual(cache.get(Person.cache.make_key(second.pk)), None)
+
+    def test_related_list_updates(self):
+        """
+        Tests that related list updates made in a batch are replayed on the cached list.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+        Book(title="Bleak House", author=author, rank=1).save()
+        books = list(author.cache.book_set)
+
+        with batch():
+            Book(title="Hard Times", author=author, rank=2).save()
+            Book(title="Little Dorrit", author=author, rank=3).save()
+            with self.assertNumQueries(0):
+                self.assertEqual(len(author.cache.book_set), 3)
+
+            # another process appends to the list before we flush
+            key = Person.cache.make_related_key(author.pk, 'book_set')
+            books.append(Book(pk=99, title="Oliver Twist", author=author, rank=0))
+            cache.set(key, Person.cache._encode(Person.cache._pack_objects(Book, books)))
+
+        with self.assertNumQueries(0):
+            titles = [book.title for book in author.cache.book_set]
+        self.assertEqual(titles, ["Little Dorrit", "Hard Times", "Bleak House", "Oliver Twist"])
+
+    def test_commit_on_success(self):
+        """
+        Tests that writes made in a transaction reach the cache after it commits, and not if it rolls back.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+        key = Person.cache.make_key(author.pk)
+
+        with commit_on_success():
+            author.name = "Boz"
+            author.save()
+            self.assertEqual(Person.cache._decode(cache.get(key))[0].name, "Charles Dickens")
+        self.assertEqual(Person.cache.get(author.pk).name, "Boz")
+
+        @commit_on_success
+        def rename(name):
+            author.name = name
+            author.save()
+            raise ValueError
+        self.assertRaises(ValueError, rename, "Charles Dickens")
+        self.assertEqual(Person.cache.get(author.pk).name, "Boz")
+
+    def test_commit_manually(self):
+        """
+        Tests that the batch's commit() writes what was cached since, and rollback() drops it.
+        """
+        author = Person(name="Charles Dickens")
+        author.save()
+        key = Person.cache.make_key(author.pk)
+
+        with commit_manually() as txn:
+            author.name = "Boz"
+            author.save()
+            self.assertEqual(Person.cache._decode(cache.get(key))[0].name, "Charles Dickens")
+            txn.commit()
+            self.assertEqual(Person.cache._decode(cache.get(key))[0].name, "Boz")
+
+            author.name = "Charles Dickens"
+            author.save()
+            txn.rollback()
+        self.assertEqual(Person.cache._decode(cache.get(key))[0].name, "Boz")
+
+    def test_transaction_middleware(self):
+        """
+        Tests that the writes of a request reach the cache once it responds, and not if it raises.
+        """
+        class Request(object):
+            pass
+
+        author = Person(name="Charles Dickens")
+        author.save()
+        key = Person.cache.make_key(author.pk)
+        middleware = TransactionMiddleware()
+
+        request = Request()
+        middleware.process_request(request)
+        author.name = "Boz"
+        author.save()
+        self.assertEqual(Person.cache._decode(cache.get(key))[0].name, "Charles Dickens")
+        response = object()
+        self.assertTrue(middleware.process_response(request, response) is response)
+        self.assertEqual(Person.cache._decode(cache.get(key))[0].name, "Boz")
+
+        request = Request()
+        middleware.process_request(request)
+        author.name = "Charles Dickens"
+        author.save()
+        middleware.process_exception(request, ValueError())
+        middleware.process_response(request, response)
+        self.assertEqual(batching.current(), None)
+        self.assertEqual(Person.cache._decode(cache.get(key))[0].name, "Boz")
+
+
+class BulkOperationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        other_cache.clear()
+        self.authors = [Person(name="Charles Dickens"), Person(name="Jane Austen")]
+        for author in self.authors:
+            author.save()
+        self.books = [
+            Book(author=self.authors[0], rank=1, title="Our Mutual Friend"),
+            Book(author=self.authors[0], rank=2, title="A Christmas Carol"),
+        ]
+        for book in self.books:
+            book.save()
+
+    def test_update(self):
+        author = self.authors[0]
+        self.assertEqual(len(author.cache.book_set), 2)
+        Book.cache.get(self.books[0].pk)
+
+        Book.objects.filter(author=author).update(rank=5)
+
+        self.assertEqual(Book.cache.get(self.books[0].pk).rank, 5)
+        self.assertEqual([b.rank for b in author.cache.book_set], [5, 5])
+
+    def test_update_moves_foreign_key(self):
+        """
+        Tests that the lists of both the old and new parents are dropped.
+        """
+        old, new = self.authors
+        self.assertEqual(len(old.cache.book_set), 2)
+        self.assertEqual(len(new.cache.book_set), 0)
+
+        Book.objects.filter(pk=self.books[0].pk).update(author=new)
+
+        self.assertEqual([b.title for b in old.cache.book_set], ["A Christmas Carol"])
+        self.assertEqual([b.title for b in new.cache.book_set], ["Our Mutual Friend"])
+
+    def test_update_m2m_lists(self):
+        author = self.authors[0]
+        author.edited.add(self.books[0])
+        self.assertEqual(author.cache.edited[0].rank, 1)
+
+        Book.objects.filter(pk=self.books[0].pk).update(rank=3)
+
+        self.assertEqual(author.cache.edited[0].rank, 3)
+
+    def test_delete(self):
+        author = self.authors[0]
+        author.edited.add(self.books[0])
+        self.assertEqual(len(author.cache.book_set), 2)
+        self.assertEqual(len(author.cache.edited), 1)
+
+        Book.objects.filter(author=author).delete()
+
+        self.assertRaises(Book.DoesNotExist, Book.cache.get, self.books[0].pk)
+        self.assertEqual(author.cache.book_set, [])
+        self.assertEqual(author.cache.edited, [])
+
+    def test_clear(self):
+        book = self.books[0]
+        book.editors.add(*self.authors)
+        self.assertEqual(len(book.cache.editors), 2)
+        self.assertEqual(len(self.authors[0].cache.edited), 1)
+
+        book.editors.clear()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get(Person.cache.make_related_key(self.authors[0].pk, 'edited')), None)
+        self.assertEqual(book.cache.editors, [])
+        self.assertEqual(self.authors[0].cache.edited, [])
+        self.assertEqual(self.authors[1].cache.edited, [])
+
+    def test_clear_reverse(self):
+        author = self.authors[0]
+        author.edited.add(*self.books)
+        self.assertEqual(len(author.cache.edited), 2)
+        self.assertEqual(len(self.books[0].cache.editors), 1)
 
-from .models import Person, Book, Volume
+        author.edited.clear()
 
-other_cache = get_cache('other')
+        self.assertEqual(author.cache.edited, [])
+        self.assertEqual(self.books[0].cache.editors, [])
+        self.assertEqual(self.books[1].cache.editors, [])
 
-class CacheControllerTests(TestCase):
+
+class NamespaceTests(TestCase):
 
     def setUp(self):
         cache.clear()
         other_cache.clear()
+        Person.cache._namespaces_expire = 0
 
-    def test_save(self):
-        """
-        Tests that objects which are saved get cached correctly and are retrievable via CacheController.get.
-        """
+    def test_invalidate_all(self):
         author = Person(name="Charles Dickens")
         author.save()
+        Book(author=author, rank=1, title="Our Mutual Friend").save()
+        author.cache.book_set
 
-        author_id = author.id
+        Person.cache.invalidate_all()
 
-        with self.assertNumQueries(0):
-            person = Person.cache.get(author_id)
+        with self.assertNumQueries(1):
+            Person.cache.get(author.pk)
+        with self.assertNumQueries(1):
+            author.cache.book_set
 
-    def test_delete_invalidate(self):
-        """
-        Tests that objects which are deleted get invalidated in cache.
-        """
+    def test_invalidate_relation(self):
         author = Person(name="Charles Dickens")
         author.save()
+        Book(author=author, rank=1, title="Our Mutual Friend").save()
+        author.cache.book_set
 
-        author_id = author.id
-
-        author.delete()
+        Person.cache.invalidate_all('book_set')
 
         with self.assertNumQueries(0):
-            with self.assertRaises(Person.DoesNotExist):
-                Person.cache.get(author_id)
+            Person.cache.get(author.pk)
+        with self.assertNumQueries(1):
+            author.cache.book_set
 
-    def test_save_updated_value(self):
+    def test_generation_read_once_per_interval(self):
         """
-        Tests that objects which are saved update cache correctly.
+        Tests that other processes pick up a new namespace after NAMESPACE_INTERVAL.
         """
         author = Person(name="Charles Dickens")
         author.save()
-        author_id = author.id
+        Person.cache.get(author.pk)
 
-        author.name = "Jane Austin"
-        author.save()
+        # another process moves to a new namespace
+        cache.incr(Person.cache.make_namespace_key())
 
         with self.assertNumQueries(0):
-            person = Person.cache.get(author_id)
-
-        self.assertEquals(person.name, "Jane Austin")
+            Person.cache.get(author.pk)
 
+        Person.cache._namespaces_expire = 0
+        with self.assertNumQueries(1):
+            Person.cache.get(author.pk)
 
-    def test_save_cache_miss(self):
+    def test_evicted_counters_move_forward(self):
         """
-        Tests that objects which are not in cache are retreived correctly via CacheController.get.
+        Tests that a counter missing from cache never restarts at a value that was used before.
         """
-        author = Person(name="Charles Dickens")
-        author.save()
-
-        author_id = author.id
+        key = Person.cache.make_namespace_key()
+        generation = counters.read(cache, [key], 60)[key]
+        cache.delete(key)
+        self.assertEqual(counters.read(cache, [key], 60, {key: generation})[key], generation)
+        cache.delete(key)
+        self.assertEqual(counters.incr(cache, key, 60, generation), generation + 1)
 
-        cache_key = Person.cache.make_key(author.id)
-        cache.delete(cache_key)
 
-        with self.assertNumQueries(1):
-            person = Person.cache.get(author_id)
-        self.assertEquals(person.name, author.name)
+class WarmCommandTests(TestCase):
 
+    def setUp(self):
+        self.authors = [Person(name="Charles Dickens"), Person(name="Jane Austen")]
+        for author in self.authors:
+            author.save()
+        self.books = [
+            Book(author=self.authors[0], rank=1, title="Our Mutual Friend"),
+            Book(author=self.authors[0], rank=2, title="A Christmas Carol"),
+            Book(author=self.authors[1], rank=1, title="Emma"),
+        ]
+        for book in self.books:
+            book.save()
+        self.books[0].editors.add(*self.authors)
+        Volume(book=self.books[0]).save()
+        cache.clear()
+        other_cache.clear()
 
-    def test_delete_cache_miss(self):
-        """
-        Tests that CacheController.get properly raises a DoesNotExist when an object is neither in cache nor the database.
-        """
-        author = Person(name="Charles Dickens")
-        author.save()
+    def warm(self, *args, **kwargs):
+        output = StringIO()
+        call_command('autocache_warm', *args, stdout=output, **kwargs)
+        return output.getvalue()
 
-        author_id = author.id
+    def test_warm_instances(self):
+        output = self.warm(chunk_size=1)
+        self.assertTrue("Warmed sample_app.Person (2 rows)" in output)
 
-        author.delete()
+        with self.assertNumQueries(0):
+            Person.cache.get_many([a.pk for a in self.authors])
+            Book.cache.get(self.books[2].pk)
+        with self.assertNumQueries(1):
+            self.authors[0].cache.book_set
 
-        cache_key = Person.cache.make_key(author_id)
-        cache.delete(cache_key)
+    def test_warm_related(self):
+        self.warm('sample_app.Person', 'sample_app.Book', related=True)
 
-        with self.assertNumQueries(1):
-            with self.assertRaises(Person.DoesNotExist):
-                person = Person.cache.get(author_id)
+        with self.assertNumQueries(0):
+            titles = [b.title for b in self.authors[0].cache.book_set]
+            edited = self.authors[1].cache.edited
+            editors = self.books[0].cache.editors
+            volume = self.books[0].cache.volume
+            self.assertRaises(Volume.DoesNotExist, getattr, self.books[1].cache, 'volume')
+        self.assertEqual(titles, ["A Christmas Carol", "Our Mutual Friend"])
+        self.assertEqual(edited, [self.books[0]])
+        self.assertEqual(sorted(e.pk for e in editors), sorted(a.pk for a in self.authors))
+        self.assertEqual(volume.book_id, self.books[0].pk)
 
 
-class RelatedCacheTests(TestCase):
+class StatsTests(TestCase):
 
     def setUp(self):
         cache.clear()
         other_cache.clear()
+        stats.default_collector.reset()
 
-    def test_create_ordering(self):
-        """
-        Tests that objects created out of order get cached in the correct
-        order.
-        """
-
-        # save an author
+    def test_instance_counters(self):
         author = Person(name="Charles Dickens")
         author.save()
-
-        # save some books
-        books = [
-            Book(author=author, rank=1, title="Our Mutual Friend"),
-            Book(author=author, rank=1, title="David Copperfield"),
-            Book(author=author, rank=2, title="A Christmas Carol"),
-        ]
-        for book in books:
-            book.save()
-
-        with self.assertNumQueries(0):
-            bs = author.cache.book_set
-
-        # Books should be ordered by rank descending, title ascending
-        titles = [
-            "A Christmas Carol",
-            "David Copperfield",
-            "Our Mutual Friend"
-        ]
-        self.assertEqual([b.title for b in bs], titles)
-
-
-    def test_update_ordering(self):
-        """
-        Tests that objects updated get cached in the correct order.
-        """
-
-        # save an author
+        cache.delete(Person.cache.make_key(author.pk))
+
+        Person.cache.get(author.pk)
+        Person.cache.get(author.pk)
+        self.assertRaises(Person.DoesNotExist, Person.cache.get, 1000)
+        self.assertRaises(Person.DoesNotExist, Person.cache.get, 1000)
+        Person.cache.get_many([author.pk, 1001])
+
+        counters = Person.cache.stats()
+        self.assertEqual(counters['hit'], 2)
+        self.assertEqual(counters['miss'], 3)
+        self.assertEqual(counters['dne'], 1)
+        self.assertEqual(counters['fill'], 3)
+        self.assertEqual(counters['db']['count'], 3)
+        self.assertEqual(counters['cache_get']['count'], 4)
+
+    def test_relation_counters(self):
         author = Person(name="Charles Dickens")
         author.save()
+        book = Book(author=author, rank=1, title="Our Mutual Friend")
+        book.save()
+        cache.delete(Person.cache.make_related_key(author.pk, 'book_set'))
 
-        # save some books
-        books = [
-            Book(author=author, rank=2, title="A Christmas Carol"),
-            Book(author=author, rank=1, title="David Copperfield"),
-            Book(author=author, rank=1, title="Our Mutual Friend"),
-        ]
-        for book in books:
-            book.save()
-
-        # check the current ordering: rank descending, title ascending
-        with self.assertNumQueries(0):
-            bs = author.cache.book_set
-        self.assertEqual([b.title for b in bs], [b.title for b in books])
+        author.cache.book_set
+        author.cache.book_set
+        Book.objects.get(pk=book.pk).author
 
-        # reorder the books: move book[1] to book[0]
-        books[1].rank = 3
-        books[1].save()
-        books[0], books[1] = books[1], books[0]
+        self.assertEqual(Person.cache.stats('book_set')['hit'], 1)
+        self.assertEqual(Person.cache.stats('book_set')['miss'], 1)
+        self.assertEqual(Person.cache.stats('author')['hit'], 1)
+        self.assertEqual(stats.default_collector.stats(backend='default')['fill'], 1)
 
-        # check the current ordering: rank descending, title ascending
-        with self.assertNumQueries(0):
-            bs = author.cache.book_set
-        self.assertEqual([b.title for b in bs], [b.title for b in books])
+    def test_slow_fills(self):
+        collector = MemoryStats(slow_fill_threshold=0)
+        collector.fill('some:key', 0.5, Person, 'book_set', 'default')
+        collector.fill('other:key', 0.05, Person)
 
+        self.assertEqual([f['key'] for f in collector.slow_fills], ['some:key', 'other:key'])
+        self.assertEqual(collector.stats(Person, 'book_set')['db']['max'], 0.5)
+        self.assertEqual(collector.stats('sample_app.Person')['fill'], 2)
 
-    def test_invalidations(self):
-        """
-        Test that changing a foreign key relationship correctly updates
-        both the cache it is moving into and the cache it is moving out of.
-        """
-        # save some authors
-        authors = [
-            Person(name="Charles Dickens"),
-            Person(name="Jane Austin"),
-        ]
+    def test_bulk_fill_reports_every_key(self):
+        authors = [Person(name="Charles Dickens"), Person(name="Jane Austen")]
         for author in authors:
             author.save()
+        cache.clear()
+        collector, Person.cache.collector = Person.cache.collector, MemoryStats(slow_fill_threshold=0)
+        try:
+            Person.cache.get_many([author.pk for author in authors])
+            slow_fills = list(Person.cache.collector.slow_fills)
+        finally:
+            Person.cache.collector = collector
 
-        # save some books
-        books = [
-            Book(author=authors[0], rank=1, title="Our Mutual Friend"),
-            Book(author=authors[0], rank=2, title="A Christmas Carol"),
-            Book(author=authors[1], rank=1, title="Sense and Sensibility"),
-        ]
-        for book in books:
-            book.save()
+        self.assertEqual(slow_fills[0]['key'], sorted(Person.cache.make_key(author.pk) for author in authors))
+        self.assertEqual(slow_fills[0]['count'], 2)
 
-        # change the author on a book.
-        books[0].author = authors[1]
-        books[0].save()
+
+class UniqueIndexTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        Publisher.cache._namespaces_expire = 0
+
+    def test_get_by(self):
+        publisher = Publisher(name="Chapman & Hall", slug="chapman")
+        publisher.save()
 
         with self.assertNumQueries(0):
-            charles_books = authors[0].cache.book_set
-            jane_books = authors[1].cache.book_set
+            self.assertEqual(Publisher.cache.get_by(slug="chapman"), publisher)
 
-        titles = ["Our Mutual Friend", "Sense and Sensibility"]
-        self.assertEqual([b.title for b in jane_books], titles)
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(Publisher.cache.get_by(slug="chapman"), publisher)
+        with self.assertNumQueries(0):
+            self.assertEqual(Publisher.cache.get_by(slug="chapman"), publisher)
 
-        titles = ["A Christmas Carol"]
-        self.assertEqual([b.title for b in charles_books], titles)
+        self.assertRaises(Publisher.DoesNotExist, Publisher.cache.get_by, slug="missing")
+        with self.assertNumQueries(0):
+            self.assertRaises(Publisher.DoesNotExist, Publisher.cache.get_by, slug="missing")
+        self.assertRaises(TypeError, Publisher.cache.get_by, name="Chapman & Hall")
+
+    def test_changed_value(self):
+        publisher = Publisher(name="Chapman & Hall", slug="chapman")
+        publisher.save()
+        publisher = Publisher.objects.get(pk=publisher.pk)
+        Publisher.cache.get_by(slug="chapman")
+
+        publisher.slug = "chapman-hall"
+        publisher.save()
+        self.assertEqual(cache.get(Publisher.cache.make_index_key('slug', "chapman")), None)
+        with self.assertNumQueries(0):
+            self.assertEqual(Publisher.cache.get_by(slug="chapman-hall").name, "Chapman & Hall")
+        self.assertRaises(Publisher.DoesNotExist, Publisher.cache.get_by, slug="chapman")
+
+        publisher.delete()
+        with self.assertNumQueries(0):
+            self.assertRaises(Publisher.DoesNotExist, Publisher.cache.get_by, slug="chapman-hall")
+
+    def test_bulk_update(self):
+        publisher = Publisher(name="Chapman & Hall", slug="chapman")
+        publisher.save()
+        Publisher.cache.get_by(slug="chapman")
+        self.assertRaises(Publisher.DoesNotExist, Publisher.cache.get_by, slug="macmillan")
+
+        Publisher.objects.filter(pk=publisher.pk).update(slug="macmillan")
+        self.assertEqual(Publisher.cache.get_by(slug="macmillan").pk, publisher.pk)
+        self.assertRaises(Publisher.DoesNotExist, Publisher.cache.get_by, slug="chapman")
+
+    def test_stale_index(self):
+        first = Publisher(name="Chapman & Hall", slug="chapman")
+        first.save()
+        second = Publisher(name="Macmillan", slug="macmillan")
+        second.save()
+
+        # an index entry that points at the wrong row is noticed and reloaded
+        cache.set(Publisher.cache.make_index_key('slug', "chapman"), Publisher.cache._encode(second.pk))
+        self.assertEqual(Publisher.cache.get_by(slug="chapman"), first)
+        with self.assertNumQueries(0):
+            self.assertEqual(Publisher.cache.get_by(slug="chapman"), first)
 
 
 class OneToOneTests(TestCase):
@@ -282,7 +1941,7 @@ class OneToOneTests(TestCase):
         volume = Volume(book=book, order_in_series=1)
         volume.save()
 
-        cache_key = ':'.join((Book.cache.make_key(book.id), 'volume'))
+        cache_key = Book.cache.make_related_key(book.id, 'volume')
         other_cache.delete(cache_key)
 
         with self.assertNumQueries(1):
@@ -308,7 +1967,7 @@ class OneToOneTests(TestCase):
 
         volume.delete()
 
-        cache_key = ':'.join((Book.cache.make_key(book.id), 'volume'))
+        cache_key = Book.cache.make_related_key(book.id, 'volume')
         other_cache.delete(cache_key)
 
         with self.assertNumQueries(1):
@@ -356,6 +2015,48 @@ class ManyToManyTest(TestCase):
         cache.clear()
         other_cache.clear()
 
+    def backend_calls(self, func, *args):
+        """ Calls ``func`` with lists updated under locks, and returns the
+            (method, key or keys) pairs of the calls it made to Person's
+            cache backend.
+        """
+        backend = Person.cache.cache
+        calls = []
+        nested = []
+        def record(name):
+            method = getattr(backend, name)
+            def recorded(arg, *args, **kwargs):
+                # the local backends' get_many and set_many call get and set
+                if not nested:
+                    calls.append((name, arg))
+                nested.append(name)
+                try:
+                    return method(arg, *args, **kwargs)
+                finally:
+                    nested.pop()
+            return recorded
+        names = ('add', 'get', 'set', 'get_many', 'set_many')
+        for name in names:
+            setattr(backend, name, record(name))
+        Person.cache._uses_cas = lambda: False
+        try:
+            func(*args)
+        finally:
+            for name in names:
+                delattr(backend, name)
+            del Person.cache._uses_cas
+        return calls
+
+    def assertLockedAtOnce(self, calls, keys):
+        """ The lists under ``keys`` were locked one by one, then read and
+            written all at once.
+        """
+        locks = set(Person.cache.make_lock_key(key) for key in keys)
+        self.assertEqual(locks, set(arg for name, arg in calls if name == 'add') & locks)
+        self.assertEqual([arg for name, arg in calls if name in ('get', 'set') and arg in keys], [])
+        self.assertEqual(len([arg for name, arg in calls if name == 'get_many' and keys <= set(arg)]), 1)
+        self.assertEqual(len([arg for name, arg in calls if name == 'set_many' and keys <= set(arg)]), 1)
+
     def test_create(self):
 
         # save some authors
@@ -498,6 +2199,157 @@ class ManyToManyTest(TestCase):
             self.assertEquals(books[0].cache.editors[0].name, 'Kelly Clarkson')
 
 
+    def test_save_updates_lists_together(self):
+        people = [Person(name="Editor %s" % i) for i in range(6)]
+        for person in people:
+            person.save()
+        book = Book(author=people[0], rank=1, title="Our Mutual Friend")
+        book.save()
+        book.editors.add(*people[:5])
+        other = Book(author=people[0], rank=2, title="A Christmas Carol")
+        other.save()
+        other.editors.add(people[5])
+
+        for person in people[:3]:
+            person.cache.edited
+
+        def save_queries(book):
+            from django.db import connection
+            from django.conf import settings
+            debug, settings.DEBUG = settings.DEBUG, True
+            try:
+                start = len(connection.queries)
+                book.save()
+                return len(connection.queries) - start
+            finally:
+                settings.DEBUG = debug
+
+        book.rank = 3
+        # the queries don't depend on the number of editors
+        self.assertEqual(save_queries(book), save_queries(other))
+
+        with self.assertNumQueries(0):
+            for person in people[:5]:
+                self.assertEqual([b.rank for b in person.cache.edited], [3])
+
+    def test_save_writes_locked_lists_at_once(self):
+        """
+        Tests that the lists holding a saved instance are locked one by one, then read and written
+        all at once.
+        """
+        people = [Person(name="Editor %s" % i) for i in range(5)]
+        for person in people:
+            person.save()
+        book = Book(author=people[0], rank=1, title="Our Mutual Friend")
+        book.save()
+        book.editors.add(*people)
+        for person in people:
+            person.cache.edited
+        keys = set(Person.cache.make_related_key(person.pk, 'edited') for person in people)
+
+        book.rank = 3
+        self.assertLockedAtOnce(self.backend_calls(book.save), keys)
+        with self.assertNumQueries(0):
+            for person in people:
+                self.assertEqual([b.rank for b in person.cache.edited], [3])
+
+    def test_save_in_batch_keeps_concurrent_changes(self):
+        """
+        Tests that list updates made by a save in a batch are replayed on the lists in cache.
+        """
+        editor = Person(name="Editor")
+        editor.save()
+        book = Book(author=editor, rank=1, title="Our Mutual Friend")
+        book.save()
+        book.editors.add(editor)
+        editor.cache.edited
+
+        with batch():
+            book.rank = 3
+            book.save()
+
+            # another process adds a book to the list before we flush
+            key = Person.cache.make_related_key(editor.pk, 'edited')
+            books = [Book.objects.get(pk=book.pk), Book(pk=99, author=editor, rank=0, title="Oliver Twist")]
+            books[0].rank = 1
+            cache.set(key, Person.cache._encode(Person.cache._pack_objects(Book, books)))
+
+        with self.assertNumQueries(0):
+            self.assertEqual([(b.pk, b.rank) for b in editor.cache.edited], [(book.pk, 3), (99, 0)])
+
+    def test_remote_add_remove(self):
+        people = [Person(name="Editor %s" % i) for i in range(3)]
+        for person in people:
+            person.save()
+        books = [Book(author=people[0], rank=i, title="Book %s" % i) for i in range(2)]
+        for book in books:
+            book.save()
+
+        for person in people:
+            self.assertEqual(person.cache.edited, [])
+        books[1].cache.editors
+
+        # the lists of the other end are updated, not the manager's own
+        books[0].editors.add(*people)
+        people[2].edited.add(books[1])
+        with self.assertNumQueries(0):
+            self.assertEqual([p.cache.edited for p in people], [[books[0]], [books[0]], [books[1], books[0]]])
+            self.assertEqual(books[1].cache.editors, [people[2]])
+
+        books[0].editors.remove(people[0], people[1])
+        people[2].edited.remove(books[1])
+        with self.assertNumQueries(0):
+            self.assertEqual([p.cache.edited for p in people], [[], [], [books[0]]])
+            self.assertEqual(books[1].cache.editors, [])
+
+    def test_remote_add_remove_write_lists_at_once(self):
+        people = [Person(name="Editor %s" % i) for i in range(5)]
+        for person in people:
+            person.save()
+        book = Book(author=people[0], rank=1, title="Our Mutual Friend")
+        book.save()
+        for person in people:
+            person.cache.edited
+        keys = set(Person.cache.make_related_key(person.pk, 'edited') for person in people)
+
+        self.assertLockedAtOnce(self.backend_calls(book.editors.add, *people), keys)
+        with self.assertNumQueries(0):
+            self.assertEqual([p.cache.edited for p in people], [[book]] * 5)
+
+        self.assertLockedAtOnce(self.backend_calls(book.editors.remove, *people), keys)
+        with self.assertNumQueries(0):
+            self.assertEqual([p.cache.edited for p in people], [[]] * 5)
+
+    def test_remote_add_remove_take_the_lock(self):
+        """
+        Tests that adding to and removing from lists at the other end waits for their locks.
+        """
+        people = [Person(name="Editor %s" % i) for i in range(2)]
+        for person in people:
+            person.save()
+        book = Book(author=people[0], rank=1, title="Our Mutual Friend")
+        book.save()
+        for person in people:
+            person.cache.edited
+
+        # another process is updating the first list
+        key = Person.cache.make_related_key(people[0].pk, 'edited')
+        cache.add(Person.cache.make_lock_key(key), 1)
+        Person.cache._uses_cas = lambda: False
+        Person.cache.UPDATE_RETRIES = 1
+        try:
+            book.editors.add(*people)
+            self.assertEqual(cache.get(key), None)
+            self.assertEqual(people[1].cache.edited, [book])
+
+            self.assertEqual(people[0].cache.edited, [book])
+            book.editors.remove(*people)
+            self.assertEqual(cache.get(key), None)
+            self.assertEqual(people[1].cache.edited, [])
+        finally:
+            del Person.cache.UPDATE_RETRIES
+            del Person.cache._uses_cas
+
 class RelatedForeignKeyTests(TestCase):
 
     def setUp(self):
@@ -517,3 +2369,98 @@ class RelatedForeignKeyTests(TestCase):
         with self.assertNumQueries(0):
             b.author
 
+
+    def test_foreign_key_cache_miss(self):
+        p = Person(name="Charles Dickens")
+        p.save()
+
+        b = Book(author_id=p.id, rank=1, title="Our Mutual Friend")
+        b.save()
+
+        cache.delete(Person.cache.make_key(p.id))
+
+        b = Book.objects.get(pk=b.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(b.author.name, "Charles Dickens")
+
+        b = Book.objects.get(pk=b.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(b.author.name, "Charles Dickens")
+
+    def test_prefetch_cached(self):
+        authors = [
+            Person(name="Charles Dickens"),
+            Person(name="Jane Austin"),
+        ]
+        for author in authors:
+            author.save()
+
+        books = [
+            Book(author=authors[0], rank=1, title="Our Mutual Friend"),
+            Book(author=authors[0], rank=2, title="A Christmas Carol"),
+            Book(author=authors[1], rank=1, title="Sense and Sensibility"),
+        ]
+        for book in books:
+            book.save()
+
+        for author in authors:
+            cache.delete(Person.cache.make_key(author.pk))
+
+        books = list(Book.objects.all())
+        with self.assertNumQueries(1):
+            prefetch_cached(books, 'author')
+
+        with self.assertNumQueries(0):
+            names = [b.author.name for b in books]
+        self.assertEqual(names, ["Charles Dickens", "Charles Dickens", "Jane Austin"])
+
+    def test_queryset_prefetch_cached(self):
+        p = Person(name="Charles Dickens")
+        p.save()
+
+        for rank in range(3):
+            Book(author=p, rank=rank, title="Book %s" % rank).save()
+
+        with self.assertNumQueries(1):
+            names = [b.author.name for b in Book.objects.prefetch_cached('author')]
+        self.assertEqual(names, ["Charles Dickens"] * 3)
+
+    def test_prefetch_path(self):
+        authors = [Person(name="Charles Dickens"), Person(name="Jane Austin")]
+        for author in authors:
+            author.save()
+        volumes = []
+        for i in range(6):
+            book = Book(author=authors[i % 2], rank=i, title="Book %s" % i)
+            book.save()
+            volume = Volume(book=book, order_in_series=i)
+            volume.save()
+            volumes.append(volume.pk)
+
+        stats.default_collector.reset()
+        with self.assertNumQueries(0):
+            loaded = prefetch_cached(Volume.cache.get_many(volumes), 'book__author')
+            names = [v.book.author.name for v in loaded]
+        self.assertEqual(names, ["Charles Dickens", "Jane Austin"] * 3)
+
+        # one round trip for the volumes, one per hop
+        timings = stats.default_collector.stats()
+        self.assertEqual(timings['cache_get_many']['count'], 3)
+        self.assertFalse('cache_get' in timings)
+
+    def test_get_related(self):
+        author = Person(name="Charles Dickens")
+        author.save()
+        book = Book(author=author, rank=1, title="Bleak House")
+        book.save()
+        volume = Volume(book=book)
+        volume.save()
+        cache.delete(Person.cache.make_key(author.pk))
+
+        with self.assertNumQueries(1):
+            volume = Volume.cache.get_related(volume.pk, 'book__author')
+        with self.assertNumQueries(0):
+            self.assertEqual(volume.book.author.name, "Charles Dickens")
+            self.assertEqual(Volume.cache.get_related(volume.pk, 'book__author').book.author, author)
+
+        self.assertRaises(ValueError, Book.cache.get_related, book.pk, 'editors')
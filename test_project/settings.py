@@ -21,6 +21,7 @@ SECRET_KEY = '))&_fn7otvb(o(t$1#dt+&0$drsyo%h+h-*7#5bo*1y5-zmlob'
 ROOT_URLCONF = 'test_project.urls'
 
 INSTALLED_APPS = (
+    'autocache',
     'test_project.sample_app',
 )
 
@@ -29,9 +30,11 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache',
         'LOCATION': '127.0.0.1:11211',
+        'OPTIONS': {'cas': True},
     },
     'other': {
         'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache',
         'LOCATION': '127.0.0.1:11212',
+        'OPTIONS': {'cas': True},
     }
 }